@@ -3,9 +3,9 @@
 
 import numpy as np
 import os
-from tqdm import tqdm
 
-from scipy.stats import mode
+from .Common import record_acquisition,mc_predictions,keep_scores
+from .Scoring import VarRatiosScorer,BALDScorer
 
 __doc__ = """
 All acquisition functions should receive:
@@ -32,6 +32,7 @@ def bayesian_varratios(pred_model,generator,data_size,**kwargs):
     gpu_count <int>: number of gpus available
     verbose <int>: verbosity level
     pbar <boolean>: user progress bars
+    single_pass <boolean>: load each pool batch once and run all dropout iterations over it
     """
     from Utils import CacheManager
     cache_m = CacheManager()
@@ -59,59 +60,31 @@ def bayesian_varratios(pred_model,generator,data_size,**kwargs):
             fidp = 'al-probs-{1}-r{0}.pik'.format(r,config.ac_function)
             cache_m.registerFile(os.path.join(config.logdir,fidp),fidp)
         
-    All_Dropout_Classes = np.zeros(shape=(data_size,1))
-
-    if pbar:
-        l = tqdm(range(mc_dp), desc="MC Dropout",position=0)
-    else:
-        if config.info:
-            print("Starting MC dropout sampling...")
-        l = range(mc_dp)
+    scorer = VarRatiosScorer(data_size,generator.classes,mc_dp,query,keep_scores=keep_scores(kwargs))
 
     #Keep probabilities for analysis
     all_probs = None
     if config.debug:
         all_probs = np.zeros(shape=(mc_dp,data_size,generator.classes))
-        
-    for d in l:
-        if not pbar and config.info:
-            print("Step {0}/{1}".format(d+1,mc_dp))
-           
-        #Keep verbosity in 0 to gain speed 
-        proba = pred_model.predict_generator(generator,
-                                                workers=5*cpu_count,
-                                                max_queue_size=100*gpu_count,
-                                                verbose=0)
 
+    for d,start,proba in mc_predictions(pred_model,generator,mc_dp,single_pass=config.single_pass,
+                                            workers=5*cpu_count,
+                                            pbar=pbar,info=config.info):
+        end = start + proba.shape[0]
         if config.debug:
-            all_probs[d] = proba
+            all_probs[d,start:end] = proba
             
-        dropout_classes = proba.argmax(axis=-1)    
-        dropout_classes = np.array([dropout_classes]).T
-        All_Dropout_Classes = np.append(All_Dropout_Classes, dropout_classes, axis=1)
+        scorer.update(d,start,proba)
 
-    if verbose > 0:
-        print("All dropout {0}:".format(All_Dropout_Classes.shape))
-        for i in np.random.choice(All_Dropout_Classes.shape[0],100,replace=False):
-            print("Predictions for image ({0}): {1}".format(i,All_Dropout_Classes[i]))
-    
-    Variation = np.zeros(shape=(data_size))
-
-    for t in range(data_size):
-        L = np.array([0])
-        for d_iter in range(mc_dp):
-            L = np.append(L, All_Dropout_Classes[t, d_iter+1])
-        Predicted_Class, Mode = mode(L[1:])
-        v = np.array(  [1 - Mode/float(mc_dp)])
-        Variation[t] = v
+    x_pool_index,s_scores = scorer.result()
+    #Only the best items are scored unless all scores are needed (see Common.keep_scores)
+    a_1d = scorer.scores
+    record_acquisition(kwargs,scores=a_1d,acquired_scores=s_scores)
     
     if verbose > 1:
         print("Variation {0}:".format(data_size))
         for i in np.random.choice(data_size,100,replace=False):
-            print("Variation for image ({0}): {1}".format(i,Variation[i]))
-        
-    a_1d = Variation.flatten()
-    x_pool_index = a_1d.argsort()[-query:][::-1]
+            print("Variation for image ({0}): {1}".format(i,a_1d[i]))
 
     if config.debug:
         from .Common import debug_acquisition
@@ -125,8 +98,8 @@ def bayesian_varratios(pred_model,generator,data_size,**kwargs):
         
     if verbose > 0:
         #print("Selected item indexes: {0}".format(x_pool_index))
-        print("Selected item's variation: {0}".format(a_1d[x_pool_index]))
-        print("Maximum variation in pool: {0}".format(a_1d.max()))
+        print("Selected item's variation: {0}".format(s_scores))
+        print("Maximum variation in pool: {0}".format(scorer.max_score))
     
     return x_pool_index
 
@@ -157,62 +130,24 @@ def bayesian_bald(pred_model,generator,data_size,**kwargs):
         fid = 'al-uncertainty-{1}-r{0}.pik'.format(r,config.ac_function)
         cache_m.registerFile(os.path.join(config.logdir,fid),fid)
 
-    All_Entropy_Dropout = np.zeros(shape=data_size)
-    score_All = np.zeros(shape=(data_size, generator.classes))
-    
-    if pbar:
-        l = tqdm(range(mc_dp), desc="MC Dropout",position=0)
-    else:
-        if config.info:
-            print("Starting MC dropout sampling...")
-        l = range(mc_dp)
-                
-    for d in l:
-        if not pbar and config.info:
-            print("Step {0}/{1}".format(d+1,mc_dp))
-
-        dropout_score = pred_model.predict_generator(generator,
-                                                        workers=5*cpu_count,
-                                                        max_queue_size=100*gpu_count,
-                                                        verbose=0)
-        #computing G_X
-        score_All = score_All + dropout_score
-
-        #computing F_X
-        dropout_score_log = np.log2(dropout_score)
-        Entropy_Compute = - np.multiply(dropout_score, dropout_score_log)
-        Entropy_Per_Dropout = np.sum(Entropy_Compute, axis=1)
-        
-        All_Entropy_Dropout = All_Entropy_Dropout + Entropy_Per_Dropout 
-
-
-    Avg_Pi = np.divide(score_All, mc_dp)
-    Log_Avg_Pi = np.log2(Avg_Pi)
-    Entropy_Avg_Pi = - np.multiply(Avg_Pi, Log_Avg_Pi)
-    Entropy_Average_Pi = np.sum(Entropy_Avg_Pi, axis=1)
-
-    G_X = Entropy_Average_Pi
-    
-    Average_Entropy = np.divide(All_Entropy_Dropout, mc_dp)
-
-    F_X = Average_Entropy
-
-    U_X = G_X - F_X
-
-    # THIS FINDS THE MINIMUM INDEX 
-    # a_1d = U_X.flatten()
-    # x_pool_index = a_1d.argsort()[-Queries:]
+    scorer = BALDScorer(data_size,generator.classes,mc_dp,query,keep_scores=keep_scores(kwargs))
+    for d,start,dropout_score in mc_predictions(pred_model,generator,mc_dp,single_pass=config.single_pass,
+                                                    workers=5*cpu_count,
+                                                    pbar=pbar,info=config.info):
+        scorer.update(d,start,dropout_score)
 
-    a_1d = U_X.flatten()
-    x_pool_index = a_1d.argsort()[-query:][::-1]    
+    x_pool_index,s_scores = scorer.result()
+    #Only the best items are scored unless all scores are needed (see Common.keep_scores)
+    a_1d = scorer.scores
+    record_acquisition(kwargs,scores=a_1d,acquired_scores=s_scores)
 
     if save_var:
         cache_m.dump((x_pool_index,a_1d),fid)
         
     if verbose > 0:
         #print("Selected item indexes: {0}".format(x_pool_index))
-        print("Selected item's average entropy: {0}".format(a_1d[x_pool_index]))
-        print("Maximum entropy in pool: {0}".format(a_1d.max()))
+        print("Selected item's average entropy: {0}".format(s_scores))
+        print("Maximum entropy in pool: {0}".format(scorer.max_score))
     
     return x_pool_index
     
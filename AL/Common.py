@@ -3,10 +3,39 @@
 
 import numpy as np
 import os
+import concurrent.futures
+from tqdm import tqdm
 
 __doc__ = """
 Utility functions for acquisition functions and independent functions
 """
+def record_acquisition(kwargs,scores=None,clusters=None,acquired_scores=None):
+    """
+    Makes pool aligned acquisition scores and/or cluster ids available to the trainer, which keeps them in
+    the acquisition log. Trainers pass a dictionary as the 'record' keyword argument.
+
+    @param acquired_scores <ndarray>: scores of the returned items only (in returned order), recorded if pool
+    aligned scores were not kept (see keep_scores)
+    """
+    record = kwargs.get('record')
+    if record is None:
+        return
+    if not scores is None:
+        record['scores'] = scores
+    elif not acquired_scores is None:
+        record['acquired_scores'] = acquired_scores
+    if not clusters is None:
+        record['clusters'] = clusters
+
+def keep_scores(kwargs):
+    """
+    True if the score of every scored item is needed: saved uncertainties, debugging, detailed verbosity or
+    a trainer that logs the scores of all candidates ('all_scores' keyword argument). Otherwise scorers only
+    keep the best items (see Scoring.StreamingScorer).
+    """
+    config = kwargs['config']
+    return config.save_var or config.debug or config.verbose > 1 or kwargs.get('all_scores',False)
+
 def random_sample(pred_model,generator,data_size,**kwargs):
     """
     Returns a random list of indexes from the given dataset
@@ -39,14 +68,16 @@ def oracle_sample(pred_model,generator,data_size,**kwargs):
                                              max_queue_size=100*gpu_count,
                                              verbose=0)
             
+    from .Scoring import top_k
+    
     pred_classes = proba.argmax(axis=-1)    
     expected = generator.returnLabelsFromIndex()
     miss = np.where(pred_classes != expected)[0]
     miss_prob = np.zeros(shape=expected.shape)
-    for k in range(miss.shape[0]):
-        miss_prob[miss[k]] = proba[miss[k]][pred_classes[miss[k]]]
+    miss_prob[miss] = proba[miss,pred_classes[miss]]
 
-    x_pool_idx = np.argsort(miss_prob)[-acquire:]
+    x_pool_idx = top_k(miss_prob,acquire)
+    record_acquisition(kwargs,scores=miss_prob)
     
     if kwargs['config'].verbose > 0:
         print('Misses ({}): {}'.format(miss.shape[0]/expected.shape[0],miss))
@@ -57,6 +88,237 @@ def oracle_sample(pred_model,generator,data_size,**kwargs):
     return x_pool_idx
 
 
+def prefetch_batches(generator,workers=1):
+    """
+    Yields generator batches in order. Batches are read ahead while the caller processes the current one, 
+    bounded by the number of workers.
+    """
+    steps = len(generator)
+    window = max(1,workers)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=window)
+    futures = {b:executor.submit(generator.__getitem__,b) for b in range(min(window,steps))}
+    try:
+        for b in range(steps):
+            batch = futures.pop(b).result()
+            if b + window < steps:
+                futures[b+window] = executor.submit(generator.__getitem__,b+window)
+            yield batch
+    finally:
+        executor.shutdown()
+
+def _pass_model(pred_model,d):
+    return pred_model[d] if isinstance(pred_model,(list,tuple)) else pred_model
+
+def batch_predictions(pred_model,generator,workers=1):
+    """
+    Predicts all generator data, batch by batch. Yields tuples (start,proba), where start is the position
+    of the first item in proba.
+    """
+    start = 0
+    for x,_ in prefetch_batches(generator,workers):
+        proba = pred_model.predict_on_batch(x)
+        yield (start,proba)
+        start += proba.shape[0]
+
+def mc_predictions(pred_model,generator,passes,single_pass=False,workers=1,pbar=False,info=False,desc="MC Dropout"):
+    """
+    Runs passes stochastic predictions over all generator data. Yields tuples (d,start,proba), where d is the pass number, 
+    start is the position of the first item in proba and proba are the predicted probabilities.
+
+    @param pred_model <keras.Model or list>: model, or a list of models (one per pass, e.g. ensemble members)
+    @param single_pass <boolean>: if False, each pass is a full sweep over the generator. If True, each batch is loaded 
+    once and all passes are run over the in memory batch, so data is read, decoded and standardized only once. In both 
+    modes proba has a batch of items.
+    @param workers <int>: number of batches prefetched
+    """
+    if passes < 1:
+        raise ValueError("[mc_predictions] At least one pass is needed ({} given)".format(passes))
+
+    if not single_pass:
+        if pbar:
+            l = tqdm(range(passes), desc=desc,position=0)
+        else:
+            if info:
+                print("Starting {} sampling...".format(desc))
+            l = range(passes)
+
+        for d in l:
+            if not pbar and info:
+                print("Step {0}/{1}".format(d+1,passes))
+            for start,proba in batch_predictions(_pass_model(pred_model,d),generator,workers):
+                yield (d,start,proba)
+        return
+
+    steps = len(generator)
+    if pbar:
+        l = tqdm(desc="{} (single pass)".format(desc),total=steps,position=0)
+    elif info:
+        print("Starting {} sampling, single pass over {} batches...".format(desc,steps))
+
+    start = 0
+    for x,_ in prefetch_batches(generator,workers):
+        for d in range(passes):
+            proba = _pass_model(pred_model,d).predict_on_batch(x)
+            yield (d,start,proba)
+        start += proba.shape[0]
+        if pbar:
+            l.update(1)
+
+    if pbar:
+        l.close()
+
+def vote_dtype(classes):
+    """
+    Smallest integer type able to hold class votes
+    """
+    return np.int8 if classes <= np.iinfo(np.int8).max else np.int16
+
+def varratios(votes,classes,chunk=65536):
+    """
+    Variation ratios computed from a preallocated vote matrix.
+
+    @param votes <ndarray>: (items x passes) matrix of predicted classes
+    @param classes <int>: number of classes
+    @param chunk <int>: rows processed at a time (bounds temporary memory)
+
+    Returns: ndarray of item variations (1 - mode count/passes)
+    """
+    items,passes = votes.shape
+    variation = np.zeros(shape=items,dtype=np.float32)
+    for start in range(0,items,chunk):
+        end = min(start+chunk,items)
+        #Each row gets its own range of bins, so a single bincount counts all rows at once
+        offsets = np.arange(end-start,dtype=np.int64)[:,None]*classes
+        counts = np.bincount((votes[start:end] + offsets).ravel(),minlength=(end-start)*classes)
+        counts = counts.reshape(end-start,classes)
+        variation[start:end] = 1.0 - counts.max(axis=1)/float(passes)
+
+    return variation
+
+def group_ranks(groups):
+    """
+    Rank of each item within its group, following item order (0 for the first item of a group).
+
+    @param groups <ndarray>: group id of each item
+    """
+    groups = np.asarray(groups)
+    n = groups.shape[0]
+    order = np.argsort(groups,kind='stable')
+    sg = groups[order]
+    starts = np.flatnonzero(np.r_[True,sg[1:] != sg[:-1]]) if n > 0 else np.zeros(0,dtype=np.intp)
+    counts = np.diff(np.r_[starts,n])
+    ranks = np.empty(n,dtype=np.int64)
+    ranks[order] = np.arange(n) - np.repeat(starts,counts)
+    return ranks
+
+def proportional_quotas(sizes,query):
+    """
+    Splits query items among groups proportionally to group sizes (largest remainder method), never
+    exceeding a group size.
+    """
+    sizes = np.asarray(sizes,dtype=np.int64)
+    query = min(query,int(sizes.sum()))
+    if query <= 0:
+        return np.zeros_like(sizes)
+    share = sizes * query / sizes.sum()
+    quotas = np.floor(share).astype(np.int64)
+    rest = query - quotas.sum()
+    if rest > 0:
+        quotas[np.argsort(quotas - share,kind='stable')[:rest]] += 1
+    return np.minimum(quotas,sizes)
+
+def stratified_select(ranked,groups,query,quotas=None,cap=0,cap_groups=None):
+    """
+    Stratified diversity selection: items are taken round-robin from groups (e.g. clusters), in ascending 
+    group order, each group contributing its best ranked remaining item per round. Exhausted groups are 
+    skipped. If groups can't provide query items (quotas or caps), remaining slots are filled with the
+    best ranked items not yet selected.
+
+    @param ranked <ndarray>: item indexes in descending priority (e.g. uncertainty)
+    @param groups <ndarray>: group of every item (indexed by item index)
+    @param query <int>: number of items to select
+    @param quotas <ndarray>: number of items to take from each group in the round-robin (None: unlimited)
+    @param cap <int>: maximum number of items from each cap group (0: unlimited), never exceeded
+    @param cap_groups <ndarray>: cap group of every item, e.g. its WSI (indexed by item index)
+    Returns: selected item indexes, in selection order
+    """
+    ranked = np.asarray(ranked)
+    g = np.asarray(groups)[ranked]
+    query = min(query,ranked.shape[0])
+
+    cid = None
+    if cap > 0 and not cap_groups is None:
+        _,cid = np.unique(np.asarray(cap_groups)[ranked],return_inverse=True)
+        pos = _capped_round_robin(g,query,quotas,cap,cid)
+    else:
+        r = group_ranks(g)
+        pos = np.arange(ranked.shape[0])
+        if not quotas is None:
+            keep = r < np.asarray(quotas)[g]
+            pos,g,r = pos[keep],g[keep],r[keep]
+        #Round (rank within group) first, then group
+        pos = pos[np.lexsort((g,r))[:query]]
+
+    if pos.shape[0] < query:
+        pos = np.concatenate((pos,_backfill(pos,ranked.shape[0],query,cap,cid)))
+    return ranked[pos]
+
+def _capped_round_robin(g,query,quotas,cap,cid):
+    """
+    Round-robin over groups where each group skips items whose cap group is full.
+    Returns positions (into the ranked array) of selected items, in selection order
+    """
+    order = np.argsort(g,kind='stable')
+    ug,starts = np.unique(g[order],return_index=True)
+    ends = np.r_[starts[1:],order.shape[0]]
+    limit = np.asarray(quotas)[ug] if not quotas is None else ends - starts
+    ptr = starts.copy()
+    taken = np.zeros(ug.shape[0],dtype=np.int64)
+    used = np.zeros(cid.max()+1 if cid.shape[0] > 0 else 0,dtype=np.int64)
+
+    selected = []
+    active = [k for k in range(ug.shape[0]) if limit[k] > 0]
+    while len(active) > 0 and len(selected) < query:
+        still = []
+        for k in active:
+            p = ptr[k]
+            while p < ends[k] and used[cid[order[p]]] >= cap:
+                p += 1
+            if p == ends[k]:
+                continue
+            selected.append(order[p])
+            used[cid[order[p]]] += 1
+            taken[k] += 1
+            ptr[k] = p + 1
+            if len(selected) == query:
+                break
+            if taken[k] < limit[k] and ptr[k] < ends[k]:
+                still.append(k)
+        active = still
+
+    return np.array(selected,dtype=np.int64)
+
+def _backfill(pos,n,query,cap,cid):
+    """
+    Best ranked positions not in pos, respecting cap groups (if cid is given), until query items are selected
+    """
+    free = np.ones(n,dtype=bool)
+    free[pos] = False
+    rest = np.flatnonzero(free)
+    missing = query - pos.shape[0]
+    if cid is None:
+        return rest[:missing]
+
+    used = np.bincount(cid[pos],minlength=cid.max()+1)
+    fill = []
+    for p in rest:
+        if used[cid[p]] < cap:
+            fill.append(p)
+            used[cid[p]] += 1
+            if len(fill) == missing:
+                break
+    return np.array(fill,dtype=np.int64)
+
 def debug_acquisition(s_expected,s_probs,classes,cache_m,config,fidp):
     from Utils import PrintConfusionMatrix
     
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import numpy as np
+import os
+
+from .Common import record_acquisition
+from .Features import pool_features,load_extractor,extract_features
+
+__doc__ = """
+All acquisition functions should receive:
+1 - numpy array of items
+2 - numpy array of labels
+3 - number of items to query
+4 - keyword arguments specific for each function (if needed)
+
+Returns: numpy array of element indexes
+"""
+
+def project_features(features,dims,path,block=65536,seed=173):
+    """
+    Gaussian random projection to dims dimensions (or a plain float32 copy if dims is 0), written block by
+    block to a float32 memory mapped file. Pool and labeled features must be projected with the same seed.
+
+    @param features <ndarray>: (items x features), usually memory mapped
+    @param path <str>: output file (overwritten)
+    Returns the memory mapped float32 array
+    """
+    n,dim = features.shape
+    if dims <= 0 and features.dtype == np.float32:
+        return features
+    out_dim = dim if dims <= 0 else dims
+    proj = None
+    if dims > 0:
+        rng = np.random.RandomState(seed)
+        proj = (rng.standard_normal((dim,dims)) / np.sqrt(dims)).astype(np.float32)
+
+    out = np.lib.format.open_memmap(path,mode='w+',dtype=np.float32,shape=(n,out_dim))
+    for s in range(0,n,block):
+        x = np.asarray(features[s:s+block],dtype=np.float32)
+        out[s:s+block] = x if proj is None else x.dot(proj)
+    out.flush()
+    return out
+
+class MinDistance(object):
+    """
+    Distance from each pool item to its closest center, updated incrementally and in blocks as centers
+    are added. Squared euclidean distances are computed as |x|^2 + |c|^2 - 2x.c, so each block update is
+    a matrix product.
+    """
+    def __init__(self,features,block=65536):
+        """
+        @param features <ndarray>: pool features (float32, may be memory mapped)
+        @param block <int>: pool rows processed at a time
+        """
+        self.features = features
+        self.block = block
+        n = features.shape[0]
+        self.sqnorm = np.zeros(n,dtype=np.float32)
+        for s in range(0,n,block):
+            x = np.asarray(features[s:s+block])
+            self.sqnorm[s:s+block] = np.einsum('ij,ij->i',x,x)
+        self.dist = np.full(n,np.inf,dtype=np.float32)
+
+    def add(self,centers):
+        """
+        Updates minimum distances with new centers (rows of a float32 array)
+        """
+        centers = np.asarray(centers,dtype=np.float32)
+        if centers.ndim == 1:
+            centers = centers.reshape(1,-1)
+        csq = np.einsum('ij,ij->i',centers,centers)
+        for s in range(0,self.dist.shape[0],self.block):
+            x = np.asarray(self.features[s:s+self.block])
+            d = self.sqnorm[s:s+self.block,None] + csq[None,:] - 2.0 * x.dot(centers.T)
+            np.minimum(self.dist[s:s+self.block],d.min(axis=1),out=self.dist[s:s+self.block])
+
+def kcenter_greedy(features,query,labeled=None,block=65536,center_block=256,seed=None):
+    """
+    k-center greedy: repeatedly selects the pool item farthest from all centers (labeled items and
+    items already selected).
+
+    @param features <ndarray>: pool features (float32, may be memory mapped)
+    @param labeled <ndarray>: labeled items features (None: first center is a random pool item)
+    @param center_block <int>: labeled items added at a time
+    Returns: (selected indexes,their distance to closest center when selected)
+    """
+    n = features.shape[0]
+    query = min(query,n)
+    md = MinDistance(features,block)
+    has_centers = not labeled is None and labeled.shape[0] > 0
+    if has_centers:
+        for s in range(0,labeled.shape[0],center_block):
+            md.add(labeled[s:s+center_block])
+
+    selected = np.zeros(query,dtype=np.int64)
+    dist = np.zeros(query,dtype=np.float32)
+    for i in range(query):
+        if i == 0 and not has_centers:
+            c = np.random.RandomState(seed).randint(n)
+        else:
+            c = int(np.argmax(md.dist))
+        selected[i] = c
+        dist[i] = md.dist[c]
+        md.add(features[c])
+        #Selected items are never chosen again
+        md.dist[c] = -1.0
+
+    return selected,np.sqrt(np.maximum(dist,0.0))
+
+def core_set(pred_model,generator,data_size,**kwargs):
+    """
+    Core-set selection (k-center greedy) over features produced by the model's feature extractor. As
+    defined in: Active Learning for Convolutional Neural Networks: A Core-Set Approach (Sener and Savarese)
+
+    Function needs to extract the following configuration parameters:
+    model <GenericModel>: model with a feature extractor (build_extractor)
+    generator <keras.Sequence>: data generator for predictions
+    data_size <int>: number of data samples
+    cs_proj <int>: random projection dimensions (0: use extracted features)
+    train_generator <keras.Sequence>: labeled (training) set generator, optional keyword argument
+    """
+    if 'config' in kwargs:
+        config = kwargs['config']
+        query = config.acquire
+    else:
+        return None
+
+    if 'model' in kwargs:
+        model = kwargs['model']
+    else:
+        print("[core_set] GenericModel is needed by core_set. Set model kw argument")
+        return None
+
+    #Models that take to long to save weights might not have finished
+    if 'sw_thread' in kwargs and hasattr(kwargs['sw_thread'],'is_alive'):
+        if config.ffeat is None and kwargs['sw_thread'].is_alive():
+            if config.info:
+                print("[core_set] Waiting for model weights to become available...")
+            kwargs['sw_thread'].join()
+
+    features = pool_features(model,generator,data_size,config,kwargs.get('pool_index'))
+    if features is None:
+        return None
+    features = project_features(features,config.cs_proj,os.path.join(config.logdir,'al-csfeatures-{}.npy'.format(model.name)))
+
+    labeled = None
+    if 'train_generator' in kwargs:
+        t_gen = kwargs['train_generator']
+        t_model = load_extractor(model,config)
+        labeled = extract_features(t_model,t_gen,t_gen.returnDataSize(),
+                                       os.path.join(config.logdir,'al-trfeatures-{}.npy'.format(model.name)),
+                                       dtype=np.dtype(config.fdtype),workers=config.cpu_count,info=config.info)
+        labeled = project_features(labeled,config.cs_proj,os.path.join(config.logdir,'al-cstrfeatures-{}.npy'.format(model.name)))
+    elif config.info:
+        print("[core_set] No labeled set generator, starting from a random pool item")
+
+    if config.info:
+        print("[core_set] Selecting {} centers from {} pool items...".format(query,data_size))
+    x_pool_index,dist = kcenter_greedy(features,query,labeled)
+    del features,labeled
+
+    scores = np.zeros(data_size,dtype=np.float32)
+    scores[x_pool_index] = dist
+    record_acquisition(kwargs,scores=scores)
+
+    if config.verbose > 0:
+        print("Selected items' distance to closest center: {}".format(dist))
+
+    return x_pool_index
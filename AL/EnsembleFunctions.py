@@ -5,7 +5,8 @@ import numpy as np
 import os
 from tqdm import tqdm
 
-from scipy.stats import mode
+from .Common import record_acquisition,mc_predictions,batch_predictions,keep_scores
+from .Scoring import VarRatiosScorer,BALDScorer
 
 __doc__ = """
 All acquisition functions should receive:
@@ -26,6 +27,11 @@ def _load_model_weights(config,single_m,spath,parallel_m,ppath,sw_threads,npfile
             pred_model.load_weights(config.ffeat,by_name=True)
             if config.info:
                 print("Model weights loaded from: {0}".format(config.ffeat))
+        elif npfile and (ppath is None or not os.path.isfile(ppath)):
+            #Members trained in separate processes with a single GPU only save single tower weights (shared by parallel_m)
+            single_m.set_weights(np.load(spath,allow_pickle=True))
+            if config.info:
+                print("Model weights loaded from: {0}".format(spath))
         elif npfile:
             pred_model.set_weights(np.load(ppath,allow_pickle=True))
             if config.info:
@@ -51,6 +57,62 @@ def _load_model_weights(config,single_m,spath,parallel_m,ppath,sw_threads,npfile
 
     return pred_model
 
+def _load_member(config,model,d,sw_thread):
+    """
+    Builds ensemble member d and loads its weights. Returns the model to use for predictions.
+    """
+    model.register_ensemble(d)
+    single,parallel = model.build(pre_load=False)
+
+    if hasattr(model,'get_npweights_cache'):
+        spath = model.get_npweights_cache(add_ext=True)
+        npfile = True
+    else:
+        spath = model.get_weights_cache()
+        npfile = False
+            
+    if hasattr(model,'get_npmgpu_weights_cache'):
+        ppath = model.get_npmgpu_weights_cache(add_ext=True)
+        npfile = True
+    else:
+        ppath = model.get_mgpu_weights_cache()
+        npfile = False
+            
+    return _load_model_weights(config,single,spath,parallel,ppath,sw_thread,npfile)
+
+def _ensemble_predictions(config,model,generator,sw_thread,desc):
+    """
+    Yields member predictions as tuples (d,start,proba), see Common.mc_predictions.
+
+    With config.single_pass, all members are loaded at once and each pool batch is read and decoded
+    only once, then fed to every member. Otherwise members are loaded one at a time and each one
+    sweeps the whole pool, batch by batch.
+    """
+    emodels = config.emodels
+    workers = 5*config.cpu_count
+    
+    if config.single_pass:
+        members = [_load_member(config,model,d,sw_thread) for d in range(emodels)]
+        for p in mc_predictions(members,generator,emodels,single_pass=True,workers=workers,
+                                    pbar=config.progressbar,info=config.info,desc=desc):
+            yield p
+        return
+    
+    if config.progressbar:
+        l = tqdm(range(emodels), desc=desc,position=0)
+    else:
+        if config.info:
+            print("Starting {}...".format(desc))
+        l = range(emodels)
+
+    for d in l:
+        if not config.progressbar and config.info:
+            print("Step {0}/{1}".format(d+1,emodels))
+
+        pred_model = _load_member(config,model,d,sw_thread)
+        for start,proba in batch_predictions(pred_model,generator,workers):
+            yield (d,start,proba)
+
 def ensemble_varratios(pred_model,generator,data_size,**kwargs):
     """
     Calculation as defined in paper:
@@ -103,7 +165,7 @@ def ensemble_varratios(pred_model,generator,data_size,**kwargs):
             fidp = 'al-probs-{1}-r{0}.pik'.format(r,config.ac_function)
             cache_m.registerFile(os.path.join(config.logdir,fidp),fidp)
         
-    All_Dropout_Classes = np.zeros(shape=(data_size,1))
+    scorer = VarRatiosScorer(data_size,generator.classes,emodels,query,keep_scores=keep_scores(kwargs))
 
     #If sw_thread was provided, we should check the availability of model weights
     if not sw_thread is None:
@@ -112,77 +174,26 @@ def ensemble_varratios(pred_model,generator,data_size,**kwargs):
                 print("Waiting ensemble model {} weights' to become available...".format(k))
                 sw_thread[k].join()
                 
-    if pbar:
-        l = tqdm(range(emodels), desc="Ensemble member predictions",position=0)
-    else:
-        if config.info:
-            print("Starting Ensemble sampling...")
-        l = range(emodels)
-
     #Keep probabilities for analysis
     all_probs = None
     if config.debug:
         all_probs = np.zeros(shape=(emodels,data_size,generator.classes))
 
-    for d in l:
-        if not pbar and config.info:
-            print("Step {0}/{1}".format(d+1,emodels))
-
-        model.register_ensemble(d)
-        single,parallel = model.build(pre_load=False)
-
-        if hasattr(model,'get_npweights_cache'):
-            spath = model.get_npweights_cache(add_ext=True)
-            npfile = True
-        else:
-            spath = model.get_weights_cache()
-            npfile = False
-            
-        if hasattr(model,'get_npmgpu_weights_cache'):
-            ppath = model.get_npmgpu_weights_cache(add_ext=True)
-            npfile = True
-        else:
-            ppath = model.get_mgpu_weights_cache()
-            npfile = False
-            
-        pred_model = _load_model_weights(config,single,spath,parallel,ppath,
-                                             sw_thread,npfile)
-        
-        #Keep verbosity in 0 to gain speed 
-        proba = pred_model.predict_generator(generator,
-                                                workers=5*cpu_count,
-                                                max_queue_size=100*gpu_count,
-                                                verbose=0)
-
+    for d,start,proba in _ensemble_predictions(config,model,generator,sw_thread,"Ensemble member predictions"):
         if config.debug:
-            all_probs[d] = proba
+            all_probs[d,start:start+proba.shape[0]] = proba
             
-        dropout_classes = proba.argmax(axis=-1)    
-        dropout_classes = np.array([dropout_classes]).T
-        All_Dropout_Classes = np.append(All_Dropout_Classes, dropout_classes, axis=1)
-
-    if verbose > 0:
-        print("All dropout {0}:".format(All_Dropout_Classes.shape))
-        for i in np.random.choice(All_Dropout_Classes.shape[0],100,replace=False):
-            print("Predictions for image ({0}): {1}".format(i,All_Dropout_Classes[i]))
-    
-    Variation = np.zeros(shape=(data_size))
+        scorer.update(d,start,proba)
 
-    for t in range(data_size):
-        L = np.array([0])
-        for d_iter in range(emodels):
-            L = np.append(L, All_Dropout_Classes[t, d_iter+1])
-        Predicted_Class, Mode = mode(L[1:])
-        v = np.array(  [1 - Mode/float(emodels)])
-        Variation[t] = v
+    x_pool_index,s_scores = scorer.result()
+    #Only the best items are scored unless all scores are needed (see Common.keep_scores)
+    a_1d = scorer.scores
+    record_acquisition(kwargs,scores=a_1d,acquired_scores=s_scores)
     
     if verbose > 1:
         print("Variation {0}:".format(data_size))
         for i in np.random.choice(data_size,100,replace=False):
-            print("Variation for image ({0}): {1}".format(i,Variation[i]))
-        
-    a_1d = Variation.flatten()
-    x_pool_index = a_1d.argsort()[-query:][::-1]
+            print("Variation for image ({0}): {1}".format(i,a_1d[i]))
 
     if config.debug:
         from .Common import debug_acquisition
@@ -196,8 +207,8 @@ def ensemble_varratios(pred_model,generator,data_size,**kwargs):
         
     if verbose > 0:
         #print("Selected item indexes: {0}".format(x_pool_index))
-        print("Selected item's variation: {0}".format(a_1d[x_pool_index]))
-        print("Maximum variation in pool: {0}".format(a_1d.max()))
+        print("Selected item's variation: {0}".format(s_scores))
+        print("Maximum variation in pool: {0}".format(scorer.max_score))
     
     return x_pool_index
 
@@ -246,81 +257,22 @@ def ensemble_bald(pred_model,generator,data_size,**kwargs):
         fid = 'al-uncertainty-{1}-r{0}.pik'.format(r,config.ac_function)
         cache_m.registerFile(os.path.join(config.logdir,fid),fid)
 
-    All_Entropy_Dropout = np.zeros(shape=data_size)
-    score_All = np.zeros(shape=(data_size, generator.classes))
+    scorer = BALDScorer(data_size,generator.classes,emodels,query,keep_scores=keep_scores(kwargs))
     
-    if pbar:
-        l = tqdm(range(emodels), desc="Ensemble member predictions",position=0)
-    else:
-        if config.info:
-            print("Starting ensemble sampling...")
-        l = range(emodels)
-                
-    for d in l:
-        if not pbar and config.info:
-            print("Step {0}/{1}".format(d+1,emodels))
-            
-        model.register_ensemble(d)
-        single,parallel = model.build(pre_load=False)
-
-        if hasattr(model,'get_npweights_cache'):
-            spath = model.get_npweights_cache(add_ext=True)
-            npfile = True
-        else:
-            spath = model.get_weights_cache()
-            npfile = False
-            
-        if hasattr(model,'get_npmgpu_weights_cache'):
-            ppath = model.get_npmgpu_weights_cache(add_ext=True)
-            npfile = True
-        else:
-            ppath = model.get_mgpu_weights_cache()
-            npfile = False
-            
-        pred_model = _load_model_weights(config,single,spath,parallel,ppath,
-                                             sw_thread,npfile)
-        
-        dropout_score = pred_model.predict_generator(generator,
-                                                        workers=5*cpu_count,
-                                                        max_queue_size=100*gpu_count,
-                                                        verbose=0)
-        #computing G_X
-        score_All = score_All + dropout_score
-
-        #computing F_X
-        dropout_score_log = np.log2(dropout_score)
-        Entropy_Compute = - np.multiply(dropout_score, dropout_score_log)
-        Entropy_Per_Dropout = np.sum(Entropy_Compute, axis=1)
-        
-        All_Entropy_Dropout = All_Entropy_Dropout + Entropy_Per_Dropout 
-
-
-    Avg_Pi = np.divide(score_All, emodels)
-    Log_Avg_Pi = np.log2(Avg_Pi)
-    Entropy_Avg_Pi = - np.multiply(Avg_Pi, Log_Avg_Pi)
-    Entropy_Average_Pi = np.sum(Entropy_Avg_Pi, axis=1)
-
-    G_X = Entropy_Average_Pi
-    
-    Average_Entropy = np.divide(All_Entropy_Dropout, emodels)
-
-    F_X = Average_Entropy
-
-    U_X = G_X - F_X
-
-    # THIS FINDS THE MINIMUM INDEX 
-    # a_1d = U_X.flatten()
-    # x_pool_index = a_1d.argsort()[-Queries:]
+    for d,start,proba in _ensemble_predictions(config,model,generator,sw_thread,"Ensemble member predictions"):
+        scorer.update(d,start,proba)
 
-    a_1d = U_X.flatten()
-    x_pool_index = a_1d.argsort()[-query:][::-1]    
+    x_pool_index,s_scores = scorer.result()
+    #Only the best items are scored unless all scores are needed (see Common.keep_scores)
+    a_1d = scorer.scores
+    record_acquisition(kwargs,scores=a_1d,acquired_scores=s_scores)
 
     if save_var:
         cache_m.dump((x_pool_index,a_1d),fid)
         
     if verbose > 0:
         #print("Selected item indexes: {0}".format(x_pool_index))
-        print("Selected item's average entropy: {0}".format(a_1d[x_pool_index]))
-        print("Maximum entropy in pool: {0}".format(a_1d.max()))
+        print("Selected item's average entropy: {0}".format(s_scores))
+        print("Maximum entropy in pool: {0}".format(scorer.max_score))
     
     return x_pool_index
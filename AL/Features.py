@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import numpy as np
+import os
+import hashlib
+from tqdm import tqdm
+
+from .Common import prefetch_batches
+
+__doc__ = """
+Scalable feature extraction and clustering for similarity based acquisition functions. Features are
+extracted batch by batch into a memory mapped npy file, optionally reduced with incremental PCA and
+clustered with mini-batch k-means. Memory use is bounded by batch/chunk sizes instead of pool size.
+"""
+
+def extract_features(pred_model,generator,size,path,dtype=np.float32,workers=1,pbar=False,info=False):
+    """
+    Runs a feature extractor over all generator data. Features are flattened and written to a memory
+    mapped npy file as batches are predicted.
+
+    @param size <int>: number of items produced by the generator
+    @param path <str>: features file (overwritten)
+    @param dtype <np.dtype>: storage type (float16 halves disk usage)
+    Returns the memory mapped array (items x features)
+    """
+    if size == 0:
+        return np.zeros((0,int(np.prod(pred_model.output_shape[1:]))),dtype=dtype)
+
+    if pbar:
+        l = tqdm(desc="Feature extraction",total=len(generator),position=0)
+    elif info:
+        print("Starting feature extraction ({} batches)...".format(len(generator)))
+
+    features = None
+    start = 0
+    for x,_ in prefetch_batches(generator,workers):
+        f = pred_model.predict_on_batch(x)
+        f = f.reshape(f.shape[0],-1)
+        if features is None:
+            features = np.lib.format.open_memmap(path,mode='w+',dtype=dtype,shape=(size,f.shape[1]))
+        features[start:start+f.shape[0]] = f
+        start += f.shape[0]
+        if pbar:
+            l.update(1)
+
+    if pbar:
+        l.close()
+
+    if start != size:
+        raise ValueError("[Features] Generator produced {} items, expected {}".format(start,size))
+    features.flush()
+    return features
+
+def load_extractor(model,config):
+    """
+    Builds the feature extractor of model (GenericModel) and loads its weights, from a fixed extractor
+    (-ffeat) or from the current acquisition's model. Returns None if model has no feature extractor.
+    """
+    if hasattr(model,'build_extractor'):
+        single_m,parallel_m = model.build_extractor(training=False,feature=True,parallel=False)
+    else:
+        if config.info:
+            print("[Features] Model is not prepared to produce features. No feature extractor")
+        return None
+
+    #Model can be loaded from previous acquisition train or from a fixed final model
+    if config.gpu_count > 1 and not parallel_m is None:
+        pred_model = parallel_m
+        if not config.ffeat is None and os.path.isfile(config.ffeat):
+            pred_model.load_weights(config.ffeat,by_name=True)
+            if config.info:
+                print("Model weights loaded from: {0}".format(config.ffeat))
+        else:
+            pred_model.load_weights(model.get_mgpu_weights_cache(),by_name=True)
+            if config.info:
+                print("Model weights loaded from: {0}".format(model.get_mgpu_weights_cache()))
+    else:
+        pred_model = single_m
+        if not config.ffeat is None and os.path.isfile(config.ffeat):
+            pred_model.load_weights(config.ffeat,by_name=True)
+            if config.info:
+                print("Model weights loaded from: {0}".format(config.ffeat))
+        else:
+            pred_model.load_weights(model.get_weights_cache(),by_name=True)
+            if config.info:
+                print("Model weights loaded from: {0}".format(model.get_weights_cache()))
+
+    return pred_model
+
+def extractor_weights(model,config):
+    """
+    Weights file used by the feature extractor (a fixed extractor or the current acquisition's model)
+    """
+    if not config.ffeat is None and os.path.isfile(config.ffeat):
+        return config.ffeat
+    elif config.gpu_count > 1 and os.path.isfile(model.get_mgpu_weights_cache()):
+        return model.get_mgpu_weights_cache()
+    else:
+        return model.get_weights_cache()
+
+def pool_features(model,generator,data_size,config,pool_index=None):
+    """
+    Features of all pool items. If pool_index (tile ids of pool items) is given, features are kept in an
+    EmbeddingCache: only items not in the cache are extracted, as long as the extractor weights don't change.
+    Returns memory mapped features or None if model has no feature extractor.
+    """
+    wpath = extractor_weights(model,config)
+    if pool_index is None or not os.path.isfile(wpath):
+        pred_model = load_extractor(model,config)
+        if pred_model is None:
+            return None
+        return extract_features(pred_model,generator,data_size,os.path.join(config.logdir,'al-features-{}.npy'.format(model.name)),
+                                    dtype=np.dtype(config.fdtype),workers=config.cpu_count,pbar=config.progressbar,info=config.info)
+
+    cache = EmbeddingCache(os.path.join(config.logdir,'al-embeddings-{}'.format(model.name)),
+                               "{}-{}".format(weights_hash(wpath),config.fdtype),verbose=config.verbose)
+    pool_index = np.asarray(pool_index,dtype=np.int64)
+    missing = cache.missing(pool_index)
+    if config.info:
+        print("[Features] {} of {} pool items found in embedding cache".format(data_size-missing.shape[0],data_size))
+
+    if missing.shape[0] > 0:
+        pred_model = load_extractor(model,config)
+        if pred_model is None:
+            return None
+        batches = generator if missing.shape[0] == data_size else SubsetBatches(generator,missing)
+        features = extract_features(pred_model,batches,missing.shape[0],cache.new_file(),dtype=np.dtype(config.fdtype),
+                                        workers=config.cpu_count,pbar=config.progressbar,info=config.info)
+        cache.add(pool_index[missing],features)
+
+    return cache.features(pool_index)
+
+class SubsetBatches(object):
+    """
+    Batches of a subset of generator items, in the given order. Only needs len() and indexing, like the
+    generators consumed by prefetch_batches.
+    """
+    def __init__(self,generator,positions):
+        """
+        @param positions <ndarray>: positions of items in generator data
+        """
+        self.generator = generator
+        self.positions = np.asarray(positions)
+        self.batch_size = generator.batch_size
+
+    def __len__(self):
+        return (self.positions.shape[0] + self.batch_size - 1) // self.batch_size
+
+    def __getitem__(self,b):
+        return self.generator._get_batches_of_transformed_samples(self.positions[self.batch_size*b:self.batch_size*(b+1)])
+
+def _chunks(n,chunk,minimum):
+    """
+    Chunk boundaries over n items. A last chunk smaller than minimum is merged into the previous one.
+    """
+    bounds = list(range(0,n,chunk)) + [n]
+    if len(bounds) > 2 and (bounds[-1] - bounds[-2]) < minimum:
+        del bounds[-2]
+    return list(zip(bounds[:-1],bounds[1:]))
+
+def reduce_features(features,components,chunk=4096,info=False):
+    """
+    Incremental PCA: fitted chunk by chunk and then applied chunk by chunk, so the full feature
+    matrix is never loaded.
+
+    @param features <ndarray>: (items x features), usually memory mapped
+    @param components <int>: number of components to keep
+    Returns float32 array (items x components)
+    """
+    from sklearn.decomposition import IncrementalPCA
+
+    n,dim = features.shape
+    components = min(components,n,dim)
+    chunks = _chunks(n,max(chunk,components),components)
+    if info:
+        print("[Features] Incremental PCA to {} components ({} chunks)...".format(components,len(chunks)))
+
+    ipca = IncrementalPCA(n_components=components)
+    for s,e in chunks:
+        ipca.partial_fit(np.asarray(features[s:e],dtype=np.float32))
+
+    reduced = np.zeros((n,components),dtype=np.float32)
+    for s,e in chunks:
+        reduced[s:e] = ipca.transform(np.asarray(features[s:e],dtype=np.float32))
+
+    return reduced
+
+def cluster_features(features,clusters,init=None,batch_size=4096,epochs=3,seed=None,info=False):
+    """
+    Mini-batch k-means. Each epoch visits all items in random mini-batches; only one batch is
+    loaded at a time.
+
+    @param features <ndarray>: (items x features), in memory or memory mapped
+    @param init <ndarray>: initial centroids (e.g. from previous acquisition). k-means++ is used if None or
+    if shape does not match
+    Returns (labels <int32 ndarray>,centroids <float32 ndarray>)
+    """
+    from sklearn.cluster import MiniBatchKMeans
+
+    n,dim = features.shape
+    if n < clusters:
+        raise ValueError("[Features] Can't form {} clusters from {} items".format(clusters,n))
+
+    #The first batch initializes centroids, it needs at least one item per cluster
+    batch_size = max(batch_size,clusters)
+    if not init is None and init.shape == (clusters,dim):
+        if info:
+            print("[Features] Warm start from previous centroids")
+        km = MiniBatchKMeans(n_clusters=clusters,init=np.asarray(init,dtype=np.float32),n_init=1,
+                                 batch_size=batch_size,random_state=seed)
+    else:
+        km = MiniBatchKMeans(n_clusters=clusters,init='k-means++',n_init=3,
+                                 batch_size=batch_size,random_state=seed)
+
+    rng = np.random.RandomState(seed)
+    for e in range(epochs):
+        perm = rng.permutation(n)
+        for s,t in _chunks(n,batch_size,1):
+            #Sorted indexes keep memory mapped reads sequential
+            idx = np.sort(perm[s:t])
+            km.partial_fit(np.asarray(features[idx],dtype=np.float32))
+        if info:
+            print("[Features] Mini-batch k-means epoch {}/{} done".format(e+1,epochs))
+
+    labels = np.zeros(n,dtype=np.int32)
+    for s,t in _chunks(n,batch_size,1):
+        labels[s:t] = km.predict(np.asarray(features[s:t],dtype=np.float32))
+
+    return labels,km.cluster_centers_.astype(np.float32)
+
+def weights_hash(path,block=1<<22):
+    """
+    SHA1 of a weights file contents
+    """
+    sha = hashlib.sha1()
+    with open(path,'rb') as fd:
+        for b in iter(lambda: fd.read(block),b''):
+            sha.update(b)
+    return sha.hexdigest()
+
+class EmbeddingCache(object):
+    """
+    Persistent feature store indexed by tile id (master table index, see Trainers.PoolManager) and keyed
+    by a hash of the extractor weights. Stored features are valid only for the same key; a new key
+    invalidates them.
+
+    The store only grows: features of tiles not yet stored are extracted and merged in (see add), so
+    rotating candidate subsets (-candidates) are served from features extracted in previous acquisitions.
+
+    Files: <prefix>.npy (features, one row per stored tile), <prefix>-ids.npy (sorted tile ids),
+    <prefix>.key (written last, so an interrupted update leaves an invalid cache) and <prefix>-sel.npy
+    (features of the last requested subset).
+    """
+    def __init__(self,prefix,key,chunk=4096,verbose=0):
+        """
+        @param prefix <str>: path prefix of cache files
+        @param key <str>: extractor identification (e.g. weights_hash)
+        @param chunk <int>: rows copied at a time when merging or selecting
+        """
+        self.fpath = prefix + '.npy'
+        self.ipath = prefix + '-ids.npy'
+        self.kpath = prefix + '.key'
+        self.spath = prefix + '-sel.npy'
+        self.npath = prefix + '-new.npy'
+        self.key = key
+        self.chunk = chunk
+        self._verbose = verbose
+
+    def valid(self):
+        if not (os.path.isfile(self.fpath) and os.path.isfile(self.ipath) and os.path.isfile(self.kpath)):
+            return False
+        with open(self.kpath,'r') as fd:
+            return fd.read().strip() == self.key
+
+    def stored(self):
+        """
+        Sorted ids of stored tiles (empty if the cache is invalid)
+        """
+        if not self.valid():
+            return np.zeros(0,dtype=np.int64)
+        return np.load(self.ipath)
+
+    def missing(self,ids):
+        """
+        Returns the positions (in ids) of tiles that are not stored
+        """
+        ids = np.asarray(ids,dtype=np.int64)
+        stored = self.stored()
+        if stored.shape[0] == 0 and self._verbose > 0:
+            print("[EmbeddingCache] No valid features for key {}".format(self.key))
+        return np.flatnonzero(~np.isin(ids,stored))
+
+    def features(self,ids):
+        """
+        Returns memory mapped features of tiles ids, in the given order, or None if some tile is not stored.
+        If ids are not the whole store, their rows are copied to the selection file.
+
+        @param ids <ndarray>: sorted tile ids
+        """
+        ids = np.asarray(ids,dtype=np.int64)
+        stored = self.stored()
+        if np.array_equal(stored,ids):
+            return np.load(self.fpath,mmap_mode='r')
+
+        pos = np.searchsorted(stored,ids)
+        if stored.shape[0] == 0 or np.any(pos >= stored.shape[0]) or not np.array_equal(stored[np.minimum(pos,stored.shape[0]-1)],ids):
+            return None
+
+        src = np.load(self.fpath,mmap_mode='r')
+        dst = np.lib.format.open_memmap(self.spath,mode='w+',dtype=src.dtype,shape=(pos.shape[0],src.shape[1]))
+        for s in range(0,pos.shape[0],self.chunk):
+            dst[s:s+self.chunk] = src[pos[s:s+self.chunk]]
+        dst.flush()
+        return dst
+
+    def new_file(self):
+        """
+        File where features of tiles to be added should be written (see extract_features and add)
+        """
+        return self.npath
+
+    def add(self,ids,features):
+        """
+        Merges features of new tiles into the store. An invalid store (e.g. new key) is discarded.
+
+        @param ids <ndarray>: sorted ids of tiles not stored yet
+        @param features <ndarray>: their features, one row per id
+        """
+        ids = np.asarray(ids,dtype=np.int64)
+        stored = self.stored()
+        if os.path.isfile(self.kpath):
+            os.remove(self.kpath)
+
+        if stored.shape[0] == 0:
+            del features
+            os.replace(self.npath,self.fpath)
+            self._commit(ids)
+            return
+
+        merged = np.union1d(stored,ids)
+        src = np.load(self.fpath,mmap_mode='r')
+        tmp = self.fpath + '.tmp.npy'
+        dst = np.lib.format.open_memmap(tmp,mode='w+',dtype=src.dtype,shape=(merged.shape[0],src.shape[1]))
+        for a,b in ((stored,src),(ids,features)):
+            pos = np.searchsorted(merged,a)
+            for s in range(0,pos.shape[0],self.chunk):
+                dst[pos[s:s+self.chunk]] = b[s:s+self.chunk]
+        dst.flush()
+        if self._verbose > 0:
+            print("[EmbeddingCache] Store grew from {} to {} items".format(src.shape[0],dst.shape[0]))
+        del src,dst,features
+        os.replace(tmp,self.fpath)
+        if os.path.isfile(self.npath):
+            os.remove(self.npath)
+        self._commit(merged)
+
+    def _commit(self,ids):
+        """
+        Marks the features file as valid for tiles ids
+        """
+        np.save(self.ipath,ids)
+        with open(self.kpath,'w') as fd:
+            fd.write(self.key)
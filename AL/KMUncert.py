@@ -7,6 +7,9 @@ from tqdm import tqdm
 
 from scipy.stats import mode
 
+from .Common import record_acquisition,stratified_select,proportional_quotas
+from .Features import pool_features,reduce_features,cluster_features
+
 __doc__ = """
 All acquisition functions should receive:
 1 - numpy array of items
@@ -17,6 +20,33 @@ All acquisition functions should receive:
 Returns: numpy array of element indexes
 """
 
+#clusters.pik format: {'version','index','labels','centroids'}, where index holds the master indexes (tile ids)
+#of clustered items (None if not available) and labels their cluster ids. Files of other versions are ignored.
+_clusters_version = 2
+
+def _stored_labels(previous,pool_index):
+    """
+    Cluster labels of the current pool items, looked up by master index. None if some item was not clustered.
+    """
+    if previous['index'] is None or pool_index is None:
+        return None
+    order = np.argsort(previous['index'],kind='stable')
+    index = previous['index'][order]
+    pool_index = np.asarray(pool_index)
+    pos = np.minimum(np.searchsorted(index,pool_index),max(0,index.shape[0]-1))
+    if index.shape[0] == 0 or not np.array_equal(index[pos],pool_index):
+        return None
+    return previous['labels'][order[pos]]
+
+def _wsi_groups(X):
+    """
+    WSI (origin) id of each pool item
+    """
+    if hasattr(X,'columns'):
+        return X.columns()['origin_id']
+    _,ids = np.unique([str(x.getOrigin()) for x in X],return_inverse=True)
+    return ids
+
 def km_uncert(bayesian_model,generator,data_size,**kwargs):
     """
     Cluster in K centroids and extract N samples from each cluster, based on maximum bayesian_varratios
@@ -33,8 +63,6 @@ def km_uncert(bayesian_model,generator,data_size,**kwargs):
     pbar <boolean>: user progress bars
     sw_threads <thread Object>: if a thread object is passed, you must wait its conclusion before loading weights
     """
-    from sklearn.cluster import KMeans
-    from sklearn.decomposition import PCA
     import importlib
     import copy
     import time
@@ -87,78 +115,56 @@ def km_uncert(bayesian_model,generator,data_size,**kwargs):
             print("[km_uncert] No trained model or weights file found")
         return None
 
-    if config.recluster > 0 and acq > 0 and (acq % config.recluster) != 0:
-        km,acquired = cache_m.load('clusters.pik')
+    #Previous clustering (plain arrays, no KMeans objects)
+    previous = None
+    if acq > 0 and cache_m.checkFileExistence('clusters.pik'):
+        previous = cache_m.load('clusters.pik')
+        if not isinstance(previous,dict) or previous.get('version') != _clusters_version:
+            previous = None
+            
+    #Stored labels are only reusable if they cover every current pool item (not a candidate subset, see -candidates)
+    pool_index = kwargs.get('pool_index')
+    labels = None
+    if not previous is None:
+        labels = _stored_labels(previous,pool_index)
+
+    clustered = False
+    if config.recluster > 0 and acq > 0 and (acq % config.recluster) != 0 and not labels is None:
+        centroids = previous['centroids']
         if config.info:
             print("[km_uncert] Loaded clusters from previous acquisition")
-            #TODO: REMOVE
-            print("Previous cluster size: {};\nAcquired: {}".format(km.labels_.shape,acquired.shape))
-        km.labels_ = np.delete(km.labels_,acquired)
     else:
-        #Run feature extraction and clustering
-        if hasattr(model,'build_extractor'):
-            single_m,parallel_m = model.build_extractor(training=False,feature=True,parallel=False)
-        else:
-            if config.info:
-                print("[km_uncert] Model is not prepared to produce features. No feature extractor")
+        #Features are reused from the embedding cache while extractor weights don't change (e.g. -ffeat)
+        features = pool_features(model,generator,data_size,config,kwargs.get('pool_index'))
+        if features is None:
             return None
 
-        #Model can be loaded from previous acquisition train or from a fixed final model
-        if gpu_count > 1 and not parallel_m is None:
-            pred_model = parallel_m
-            if not config.ffeat is None and os.path.isfile(config.ffeat):
-                pred_model.load_weights(config.ffeat,by_name=True)
-                if config.info:
-                    print("Model weights loaded from: {0}".format(config.ffeat))
-            else:
-                pred_model.load_weights(model.get_mgpu_weights_cache(),by_name=True)
-                if config.info:
-                    print("Model weights loaded from: {0}".format(model.get_mgpu_weights_cache()))
-        else:
-            pred_model = single_m
-            if not config.ffeat is None and os.path.isfile(config.ffeat):
-                pred_model.load_weights(config.ffeat,by_name=True)
-                if config.info:
-                    print("Model weights loaded from: {0}".format(config.ffeat))
-            else:
-                pred_model.load_weights(model.get_weights_cache(),by_name=True)
-                if config.info:
-                    print("Model weights loaded from: {0}".format(model.get_weights_cache()))
-                    
-        #Extract features for all images in the pool
-        if config.info:
-            print("Starting feature extraction ({} batches)...".format(len(generator)))        
-        features = pred_model.predict_generator(generator,
-                                                workers=4*cpu_count,
-                                                max_queue_size=100*gpu_count,
-                                                verbose=0)
-        features = features.reshape(features.shape[0],np.prod(features.shape[1:]))
-
         if config.pca > 0:
-            if config.info:
-                print("Starting PCA decomposition...")
-
-            pca = PCA(n_components = config.pca)
-            features = pca.fit_transform(features)
+            features = reduce_features(features,config.pca,info=config.info)
             
         stime = None
         etime = None
         if config.verbose > 0:
-            print("Done extraction...starting KMeans")
+            print("Done extraction...starting mini-batch KMeans")
             stime = time.time()
-        
-        km = KMeans(n_clusters = clusters, init='k-means++',n_jobs=int(cpu_count/2)).fit(features)
+
+        #Warm start from previous acquisition's centroids
+        init = None if previous is None else previous['centroids']
+        labels,centroids = cluster_features(features,clusters,init=init,info=config.info)
+        clustered = True
+        del features
         
         if config.verbose > 0:
             etime = time.time()
             td = timedelta(seconds=(etime-stime))
             print("KMeans took {}".format(td))
 
-    un_clusters = {k:[] for k in range(config.clusters)}
-
-    #Distributes items in clusters in descending order of uncertainty
-    for iid in un_indexes:
-        un_clusters[km.labels_[iid]].append(iid)
+    #Pool items grouped by cluster, each group in descending order of uncertainty
+    un_indexes = np.asarray(un_indexes)
+    sizes = np.bincount(labels[un_indexes],minlength=clusters)
+    if config.save_var or config.debug:
+        order = np.argsort(labels[un_indexes],kind='stable')
+        un_clusters = dict(enumerate(np.split(un_indexes[order],np.cumsum(sizes)[:-1])))
 
     #Save clusters
     if config.save_var:
@@ -169,15 +175,13 @@ def km_uncert(bayesian_model,generator,data_size,**kwargs):
     #If debug
     if config.debug:
         expected = generator.returnLabelsFromIndex()
+        #Position of each item in the uncertainty ranking
+        un_pos = np.empty(data_size,dtype=np.int64)
+        un_pos[un_indexes] = np.arange(un_indexes.shape[0])
         for k in range(len(un_clusters)):
-            ind = np.asarray(un_clusters[k])
+            ind = un_clusters[k]
             print("Cluster {}, # of items: {}".format(k,ind.shape[0]))
-            posa = np.ndarray(shape=(1,),dtype=np.int32)
-            for ii in range(min(ind.shape[0],30)):
-                if ii == 0:
-                    posa[0] = np.where(un_indexes == ind[ii])[0]
-                else:
-                    posa = np.hstack((posa,np.where(un_indexes == ind[ii])[0]))
+            posa = un_pos[ind[:30]]
             print("Cluster {} first items positions in index array (at most 30): {}".format(k,posa))
             #Check % of items of each class in cluster k
             c_labels = expected[ind]
@@ -190,24 +194,24 @@ def km_uncert(bayesian_model,generator,data_size,**kwargs):
                 if c_labels.shape[0] == 1:
                     l_count[c_labels[0] ^ 1] = 0
                 print("Cluster {3} labels: {0} are 0; {1} are 1;\n - {2:.2f} are positives".format(l_count[0],l_count[1],(l_count[1]/(l_count[0]+l_count[1])),k))            
-            
-    ac_count = 0
-    acquired = []
-    j = 0
-    while ac_count < query:
-        cln = (ac_count+j) % clusters
-        q = un_clusters[cln]
-        if len(q) > 0:
-            acquired.append(q.pop(0))
-            ac_count += 1
-        else:
-            if verbose > 0:
-                print("[km_uncert] Cluster {} exausted, will try to acquire image from cluster {}".format(cln,(cln+1)%clusters))
-            j += 1
-            continue
-
-    acquired = np.asarray(acquired)
-    if config.recluster > 0:
-        cache_m.dump((km,acquired),'clusters.pik')
+
+    #Stratified selection: round-robin over clusters, optionally with proportional quotas and per WSI caps
+    quotas = None
+    if config.kmstrat == 'prop':
+        quotas = proportional_quotas(sizes,query)
+    cap_groups = None
+    if config.wsicap > 0:
+        cap_groups = _wsi_groups(generator.data[0])
+    acquired = stratified_select(un_indexes,labels,query,quotas=quotas,cap=config.wsicap,cap_groups=cap_groups)
+    if verbose > 0 and acquired.shape[0] < query:
+        print("[km_uncert] Clusters exausted, acquired {} of {} items".format(acquired.shape[0],query))
+
+    record_acquisition(kwargs,clusters=labels)
+    #Reused clusters are looked up by master index, so the file only changes when clustering runs
+    if clustered:
+        cache_m.dump({'version':_clusters_version,
+                      'index':None if pool_index is None else np.asarray(pool_index),
+                      'labels':labels,
+                      'centroids':centroids},'clusters.pik')
     
     return acquired
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import numpy as np
+
+__doc__ = """
+Streaming uncertainty scoring. Scorers consume prediction blocks (d,start,proba) as produced by
+AL.Common.mc_predictions or by one ensemble member at a time. Accumulators (rows x classes) are kept
+only for the blocks that still wait for predictions, and a block is scored and released as soon as all
+of its passes were seen. Top k selection is done by partial sorting (argpartition).
+
+Memory is O(batch + k) only when all passes of a batch arrive together (-sp, single pass mode). In sweep
+mode every block waits for the last pass, so accumulators of the whole pool are alive at once
+(O(pool x classes)).
+"""
+
+def top_k(scores,k):
+    """
+    Returns the indexes of the k highest scores, in descending score order.
+    """
+    k = min(k,scores.shape[0])
+    if k <= 0:
+        return np.zeros(0,dtype=np.int64)
+    idx = np.argpartition(scores,-k)[-k:]
+    return idx[np.argsort(scores[idx],kind='stable')[::-1]]
+
+class TopK(object):
+    """
+    Keeps the k highest scores seen so far (and their global indexes).
+    """
+    def __init__(self,k):
+        self.k = k
+        self.idx = np.zeros(0,dtype=np.int64)
+        self.scores = np.zeros(0,dtype=np.float32)
+
+    def push(self,scores,start):
+        """
+        @param scores <ndarray>: scores of items start...start+len(scores)
+        """
+        scores = np.asarray(scores,dtype=np.float32)
+        idx = np.concatenate((self.idx,np.arange(start,start+scores.shape[0],dtype=np.int64)))
+        scores = np.concatenate((self.scores,scores))
+        sel = top_k(scores,self.k)
+        self.idx = idx[sel]
+        self.scores = scores[sel]
+
+    def result(self):
+        """
+        Returns (indexes,scores) in descending score order
+        """
+        return self.idx,self.scores
+
+class StreamingScorer(object):
+    """
+    Base class of streaming scorers. Subclasses define the accumulators of a block of items and how
+    a block is scored once all passes were accumulated.
+    """
+    def __init__(self,size,classes,passes,query,keep_scores=True):
+        """
+        @param size <int>: number of items in the pool
+        @param classes <int>: number of classes
+        @param passes <int>: number of stochastic passes (dropout iterations or ensemble members)
+        @param query <int>: number of items to select
+        @param keep_scores <boolean>: keep the score of every item (float32 per item), needed for saved
+        uncertainties and pool aligned acquisition records (see Common.keep_scores). Always kept if all
+        items are to be selected.
+        """
+        self.size = size
+        self.classes = classes
+        self.passes = passes
+        self.query = query
+        self._blocks = {}
+        #Selection is done over the score array if it's kept, else over a running top k
+        keep_scores = keep_scores or query >= size
+        self.scores = np.zeros(size,dtype=np.float32) if keep_scores else None
+        self._topk = None if keep_scores else TopK(query)
+        self.max_score = -np.inf
+
+    def _new_block(self,rows):
+        raise NotImplementedError
+
+    def _accumulate(self,acc,d,proba):
+        raise NotImplementedError
+
+    def _score(self,acc):
+        raise NotImplementedError
+
+    def update(self,d,start,proba):
+        """
+        Accumulates pass d predictions of items start...start+proba.shape[0]
+        """
+        key = (start,proba.shape[0])
+        if not key in self._blocks:
+            self._blocks[key] = [self._new_block(proba.shape[0]),0]
+        block = self._blocks[key]
+        self._accumulate(block[0],d,proba)
+        block[1] += 1
+
+        if block[1] == self.passes:
+            s = self._score(block[0])
+            del self._blocks[key]
+            if s.shape[0] > 0:
+                self.max_score = max(self.max_score,float(s.max()))
+            if self.scores is None:
+                self._topk.push(s,start)
+            else:
+                self.scores[start:start+s.shape[0]] = s
+
+    def result(self):
+        """
+        Returns (selected indexes,their scores) in descending score order
+        """
+        if len(self._blocks) > 0:
+            raise ValueError("[StreamingScorer] {} blocks did not receive all passes".format(len(self._blocks)))
+        if self.scores is None:
+            return self._topk.result()
+        idx = top_k(self.scores,self.query)
+        return idx,self.scores[idx]
+
+class VarRatiosScorer(StreamingScorer):
+    """
+    Variation ratios: 1 - (votes of the mode class)/passes. Blocks keep running vote counts per class
+    (rows x classes), not the votes of each pass.
+    """
+    def _new_block(self,rows):
+        return np.zeros((rows,self.classes),dtype=np.uint8 if self.passes <= np.iinfo(np.uint8).max else np.int32)
+
+    def _accumulate(self,acc,d,proba):
+        acc[np.arange(acc.shape[0]),proba.argmax(axis=-1)] += 1
+
+    def _score(self,acc):
+        return 1.0 - acc.max(axis=1).astype(np.float32)/float(self.passes)
+
+class BALDScorer(StreamingScorer):
+    """
+    BALD: entropy of the mean prediction minus the mean entropy of the predictions
+    """
+    def _new_block(self,rows):
+        return [np.zeros((rows,self.classes),dtype=np.float32),np.zeros(rows,dtype=np.float32)]
+
+    def _accumulate(self,acc,d,proba):
+        proba = proba.astype(np.float32,copy=False)
+        acc[0] += proba
+        acc[1] += entropy(proba)
+
+    def _score(self,acc):
+        return entropy(acc[0]/self.passes) - acc[1]/self.passes
+
+def entropy(proba):
+    """
+    Base 2 entropy of each row (0*log(0) is taken as 0)
+    """
+    logp = np.log2(np.where(proba > 0,proba,1.0))
+    return -np.einsum('ij,ij->i',proba,logp)
@@ -7,3 +7,4 @@ from .BayesianFunctions import bayesian_varratios,bayesian_bald
 from .EnsembleFunctions import ensemble_varratios,ensemble_bald
 from .Common import random_sample,oracle_sample
 from .KMUncert import km_uncert
+from .CoreSet import core_set
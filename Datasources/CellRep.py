@@ -27,10 +27,11 @@ class CellRep(gd.GenericDS):
 
     def _load_metadata_from_dir(self,d):
         """
-        Create SegImages from a directory
+        Create SegImages from a directory (or a directory inside an archive)
         """
         class_set = set()
-        labels = open(os.path.join(d,'label.txt'),'r')
+        labels = self._read_lines(os.path.join(d,'label.txt'))
+        factory = self._view_factory()
 
         t_x,t_y = ([],[])
         for f in labels:
@@ -46,8 +47,8 @@ class CellRep(gd.GenericDS):
             if len(tmp) > 4:
                 coord = (tmp[3],tmp[4])
             t_path = os.path.join(d,f_name)
-            if os.path.isfile(t_path):
-                seg = PImage(t_path,keepImg=self._keep,origin=origin,coord=coord,verbose=self._verbose)
+            if self._isfile(t_path):
+                seg = factory(t_path,origin,coord)
                 t_x.append(seg)
                 t_y.append(label)
                 class_set.add(label)
@@ -5,11 +5,34 @@ from abc import ABC,abstractmethod
 from tqdm import tqdm
 
 import concurrent.futures
+import multiprocessing as mp
+import hashlib
 import numpy as np
 import os
 import random
+import tempfile
+from collections import deque
 
 from Utils import CacheManager,multiprocess_run
+from .MetadataIndex import MetadataIndex,to_columns,concat_columns,empty_columns
+from .TileTable import TileTable,PImageFactory
+from Preprocessing.ArchiveStore import is_archive,open_archive
+from Preprocessing.ArchImage import ArchImageFactory
+from Preprocessing.TileCache import tile_cache
+
+def _read_chunk(items,img_dim,keepImg,verbose,toFloat):
+    """
+    Reads a chunk of images into an array (see GenericDS.iter_data). Module level, so it can run in
+    worker processes.
+    """
+    #Batch readable sources (packed stores) are read with fancy indexing, no per file decoding
+    if hasattr(items[0],'readBatch'):
+        return items[0].readBatch([items[k] for k in range(len(items))],size=img_dim,verbose=verbose,toFloat=toFloat)
+
+    data = np.zeros((len(items),)+tuple(img_dim),dtype=np.float32 if toFloat else np.uint8)
+    for k in range(len(items)):
+        data[k] = items[k].readImage(keepImg,img_dim,verbose,toFloat)
+    return data
 
 class GenericDS(ABC):
     """
@@ -17,8 +40,13 @@ class GenericDS(ABC):
     """
     def __init__(self,data_path,keepImg=False,config=None,name='Generic'):
         self.path = None
+        #Data may be read directly from a tar or zip archive (see Preprocessing.ArchiveStore)
+        self.archive = None
         if isinstance(data_path,str) and os.path.isdir(data_path):
             self.path = data_path
+        elif is_archive(data_path):
+            self.path = data_path
+            self.archive = data_path
         else:
             raise ValueError("[GenericImage] Path does not correspond to a file ({0}).".format(data_path))
 
@@ -47,17 +75,27 @@ class GenericDS(ABC):
 
     def check_paths(self,imgv,path):
 
+        if isinstance(imgv,TileTable):
+            imgv.change_root(self.change_root,path)
+            return
+        
         for s in imgv:
             s.setPath(self.change_root(s.getPath(),path))
             
     def get_dataset_dimensions(self,X = None):
         """
         Returns the dimensions of the images in the dataset. It's possible to have different image dimensions.
-        WARNING: big datasets will take forever to run. For now, checks a sample of the images.
-        TODO: Reimplement this function to be fully parallel (threads in case).
+        Dimensions of TileTable items are recorded in the metadata index, other items have their headers read
+        by a thread pool (see _probe_dims).
 
         Return: SORTED list of tuples (# samples,width,height,channels)
         """
+        if X is None:
+            X = self.X
+
+        #Exact and instant for tables with recorded dimensions, no caching needed
+        if isinstance(X,TileTable) and np.all(X.dims[:,0] >= 0):
+            return self._dims_list(X.dims,len(X))
 
         cache_m = CacheManager()
         reload_data = False
@@ -72,26 +110,57 @@ class GenericDS(ABC):
             reload_data = True
                 
         if reload_data:
-            dims = set()
-            if X is None and self.X is None:
+            if X is None:
                 return None
-            elif X is None:
-                X = self.X
         
-            samples = len(X)            
             if self._config.info:
-                print("Checking a sample of dataset images for different dimensions...")
+                print("Checking dataset images for different dimensions...")
 
-            s_number = int(0.02*samples)
-            upper_limit = 5000 if s_number > 5000 else s_number
-            for seg in random.sample(X,upper_limit):
-                dims.add((samples,) + seg.getImgDim())
+            if isinstance(X,TileTable):
+                d = X.dims.copy()
+                missing = np.flatnonzero(d[:,0] < 0)
+                d[missing] = self._probe_dims(X[missing])
+            else:
+                d = self._probe_dims(X)
+            dims = self._dims_list(d,len(X))
             cache_m.dump((dims,self.name),'data_dims.pik')
 
         l = list(dims)
         l.sort()
         return l
 
+    def _dims_list(self,dims,samples):
+        """
+        Sorted list of distinct dimensions, as returned by get_dataset_dimensions
+        """
+        dims = dims[dims[:,0] >= 0]
+        return sorted([(samples,) + tuple(d) for d in np.unique(dims,axis=0).tolist()])
+
+    def _probe_dims(self,X,workers=8,chunk=1024):
+        """
+        Dimensions (width,height,channels) of every item in X, read by a thread pool. SegImages read only file
+        headers when possible (see Preprocessing.ImageHeader).
+        Returns an int32 array, -1 rows for items that could not be read.
+        """
+        def probe(start):
+            d = np.full((min(chunk,len(X)-start),3),-1,dtype=np.int32)
+            for k in range(d.shape[0]):
+                try:
+                    dim = tuple(X[start+k].getImgDim())
+                except Exception as e:
+                    #Decoders raise all sorts of errors on corrupted files
+                    if self._verbose > 0:
+                        print("[GenericDatasource] Could not read dimensions of {} ({})".format(X[start+k],e))
+                    continue
+                #Slides report (width,height) and are read as RGB
+                d[k] = dim[:3] if len(dim) >= 3 else dim + (3,)
+            return d
+
+        if len(X) == 0:
+            return np.zeros((0,3),dtype=np.int32)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            return np.concatenate(list(executor.map(probe,range(0,len(X),chunk))))
+
     def _run_multiprocess(self,data):
         """
         This method should not be called directly. It's intended
@@ -105,6 +174,78 @@ class GenericDS(ABC):
 
         return (X,Y)
 
+    def _run_multiprocess_index(self,data):
+        """
+        This method should not be called directly. It's intended
+        only for multiprocess metadata index updates: returns metadata of each directory as columns.
+        """
+        dirs,cols = ([],[])
+        for item in data:
+            t_x,t_y = self._load_metadata_from_dir(item)
+            dirs.append(item)
+            c = to_columns(t_x,t_y)
+            c['dims'] = self._probe_dims(t_x)
+            cols.append(c)
+
+        return (dirs,cols)
+
+    def _view_factory(self):
+        """
+        Returns the callable that creates SegImage views of TileTable items (see TileTable). Datasources that
+        use the metadata index with other image types should override this.
+        """
+        if not self.archive is None:
+            return ArchImageFactory(self.archive,self._archive_index(),self._keep,self._verbose)
+        return PImageFactory(self._keep,self._verbose)
+
+    def _archive_index(self):
+        """
+        Member index file of the archive datasource, kept with the other metadata caches
+        """
+        loc = self._index_location(self.archive)
+        if loc is None:
+            return None
+        base,ext = os.path.splitext(loc)
+        return "{0}-archive{1}".format(base,ext)
+
+    def _open_archive(self):
+        return open_archive(self.archive,self._archive_index(),self._verbose)
+
+    def _read_lines(self,path):
+        """
+        Lines of a text file (e.g. label files), from the file system or from the archive
+        """
+        if self.archive is None:
+            with open(path,'r') as fd:
+                return fd.readlines()
+        store = self._open_archive()
+        return store.read(store.member_path(path)).decode().splitlines()
+
+    def _isfile(self,path):
+        if self.archive is None:
+            return os.path.isfile(path)
+        store = self._open_archive()
+        return store.has(store.member_path(path))
+
+    def _archive_dirs(self):
+        """
+        Directories (as <archive>/<dir> paths) of archive members
+        """
+        store = self._open_archive()
+        dirs = set([os.path.dirname(n) for n in store.members()])
+        dirs.discard('')
+        return sorted([os.path.join(self.archive,d) for d in dirs])
+
+    def _index_location(self,path):
+        """
+        Metadata index file for the given root dir (one index per root)
+        """
+        loc = self._cache.fileLocation('metadata_index.npz')
+        if loc is None:
+            return None
+        base,ext = os.path.splitext(loc)
+        return "{0}-{1}{2}".format(base,hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:8],ext)
+
     def _split_data(self,split,X,Y):
         """
         Split data in at most N sets. Returns a tuple (set1,set2,set3,setN) with the divided
@@ -127,29 +268,66 @@ class GenericDS(ABC):
     def _run_dir(self,path):
 
         dlist = []
-        files = os.listdir(path)
         X,Y = ([],[])
 
-        if self.multi_dir:
+        if self.multi_dir and not self.archive is None:
+            #Archive members are listed from the member index, no file system access
+            dlist = self._archive_dirs()
+            pdata = multiprocess_run(self._run_multiprocess_index,tuple(),dlist,
+                                        self._cpu_count,self._pbar,
+                                        step_size=1,output_dim=2,txt_label='directories',verbose=self._verbose)
+            parsed = dict(zip(*pdata))
+            cols = [parsed[d] for d in dlist if d in parsed]
+            X = TileTable(concat_columns(cols) if len(cols) > 0 else empty_columns(),self._view_factory())
+            Y = X.labels
+            if self._config.info:
+                print("[GenericDatasource] Archive {}: {} directories parsed".format(self.archive,len(dlist)))
+                
+        elif self.multi_dir:
+            files = os.listdir(path)
             for f in files:
                 item = os.path.join(path,f)
                 if os.path.isdir(item):
                     dlist.append(item)
+            dlist.sort()
+
+            #Only new or modified directories are parsed, everything else comes from the metadata index
+            index = MetadataIndex(path,self._index_location(path),self._verbose)
+            changed,signatures = index.changed(dlist)
+            parsed = {}
+            if len(changed) > 0:
+                pdata = multiprocess_run(self._run_multiprocess_index,tuple(),changed,
+                                            self._cpu_count,self._pbar,
+                                            step_size=1,output_dim=2,txt_label='directories',verbose=self._verbose)
+                parsed = dict(zip(*pdata))
+            index.update(dlist,parsed,signatures)
+            index.save()
+            if self._config.info:
+                print("[GenericDatasource] Metadata index: {} of {} directories parsed".format(len(changed),len(dlist)))
 
-            mdata = multiprocess_run(self._run_multiprocess,tuple(),dlist,
-                                        self._cpu_count,self._pbar,
-                                        step_size=1,output_dim=2,txt_label='directories',verbose=self._verbose)
+            X = TileTable(index.columns(),self._view_factory())
+            Y = X.labels
 
         else:
             mdata = self._load_metadata_from_dir(self.path)
-
-        X.extend(mdata[0]) #samples
-        Y.extend(mdata[1]) #labels
+            #Array shaped datasources return a TileTable (see Preprocessing.PackedStore)
+            if isinstance(mdata[0],TileTable):
+                X = mdata[0]
+                Y = X.labels
+            else:
+                X.extend(mdata[0]) #samples
+                Y.extend(mdata[1]) #labels
 
         X,Y = self._shuffle(X,Y)
         return X,Y
 
     def _shuffle(self,X,Y):
+        #Tables are shuffled by a single permutation of all columns (labels included)
+        if isinstance(X,TileTable):
+            perm = np.random.permutation(len(X))
+            X = X[perm]
+            return X,X.labels
+        
         #Shuffle samples and labels maintaining relative order
         combined = list(zip(X,Y))
         random.shuffle(combined)
@@ -198,7 +376,14 @@ class GenericDS(ABC):
                 
         if self._cache.checkFileExistence(metadata_file) and not reload_data:
             try:
-                X,Y,name = self._cache.load(metadata_file)
+                data = self._cache.load(metadata_file)
+                #Metadata of index based datasources is stored as columns (see MetadataIndex)
+                if len(data) == 2:
+                    cols,name = data
+                    X = TileTable(cols,self._view_factory())
+                    Y = X.labels
+                else:
+                    X,Y,name = data
             except ValueError:
                 name = ''
                 reload_data = True
@@ -218,7 +403,10 @@ class GenericDS(ABC):
             X,Y = self._run_dir(self.path)
 
         if reload_data or reshuffle:
-            self._cache.dump((X,Y,self.name),metadata_file)
+            if isinstance(X,TileTable):
+                self._cache.dump((X.columns(),self.name),metadata_file)
+            else:
+                self._cache.dump((X,Y,self.name),metadata_file)
             self._cache.dump(tuple(self._config.split),'split_ratio.pik')
             
         self.X = X.copy()
@@ -259,30 +447,24 @@ class GenericDS(ABC):
         else:    
             samples = len(X)
         y = np.array(Y[:samples], dtype=np.int32)
-        if not self._config.tdim is None and len(self._config.tdim) == 2:
-            img_dim = tuple(self._config.tdim) + (3,)
+        img_dim = self._load_dims(X)
+        #With -u8, images are kept as uint8 and converted to float by generators (4x less memory)
+        dtype = np.uint8 if self._config.uint8 else np.float32
+        if self._config.load_mmap:
+            #Disk backed and anonymous: the file is removed as soon as the array is released
+            X_data = np.memmap(tempfile.TemporaryFile(dir=self._config.logdir),dtype=dtype,mode='w+',shape=(samples,)+img_dim)
         else:
-            dataset_dim = self.get_dataset_dimensions(X)[0]
-            img_dim = dataset_dim[1:]
-        X_data = np.zeros(shape=(samples,)+img_dim, dtype=np.float32)
-        
-        counter = 0
-        futures = []
-
-        executor = concurrent.futures.ThreadPoolExecutor(max_workers=7)
-        for i in range(samples):
-            futures.append(executor.submit(X[i].readImage,keepImg,img_dim,self._verbose))
+            X_data = np.zeros(shape=(samples,)+img_dim, dtype=dtype)
 
         if self._pbar:
             l = tqdm(desc="Reading images...",total=samples,position=0)
         elif self._config.info:
             print("Reading images...")
         
-        #for future in concurrent.futures.as_completed(futures):
-        for i in range(samples):
-            X_data[i] = futures[i].result()
+        for start,data in self.iter_data(X[:samples],img_dim,keepImg):
+            X_data[start:start+data.shape[0]] = data
             if self._pbar:
-                l.update(1)
+                l.update(data.shape[0])
             elif self._verbose > 0:
                 print(".",end='')
             
@@ -296,6 +478,60 @@ class GenericDS(ABC):
         else:
             return self._split_data(split,X_data,y)
 
+    def _load_dims(self,X):
+        """
+        Dimensions images are read with: -tdim if given, else the smallest dataset dimensions
+        """
+        if not self._config.tdim is None and len(self._config.tdim) == 2:
+            return tuple(self._config.tdim) + (3,)
+        else:
+            dataset_dim = self.get_dataset_dimensions(X)[0]
+            return dataset_dim[1:]
+
+    def iter_data(self,X,img_dim=None,keepImg=False,chunk=64):
+        """
+        Reads images of X in order, chunk by chunk, for consumers that don't need all data at once. Chunks are
+        read by -lworkers threads (or processes, with -lproc) and at most two chunks per worker are read ahead,
+        so memory use does not depend on the size of X.
+
+        @param X <list or TileTable>: image metadata
+        @param img_dim <tuple>: images are resized to img_dim (Default: see _load_dims)
+        @param keepImg <bool>: keep image data in memory (ignored by worker processes)
+        Yields tuples (start,data): data is an array with images start...start+chunk
+        """
+        samples = len(X)
+        if samples == 0:
+            return
+        if img_dim is None:
+            img_dim = self._load_dims(X)
+        to_float = not self._config.uint8
+        workers = max(1,self._config.load_workers)
+        window = 2*workers
+
+        if self._config.load_procs:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers,mp_context=mp.get_context('spawn'))
+            keepImg = False
+            if not tile_cache() is None and self._config.info:
+                print("[GenericDatasource] Tile cache is not used by load worker processes (-lproc)")
+        else:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+        pending = deque()
+        try:
+            for i in range(0,samples,chunk):
+                pending.append((i,executor.submit(_read_chunk,X[i:i+chunk],img_dim,keepImg,self._verbose,to_float)))
+                if len(pending) >= window:
+                    start,future = pending.popleft()
+                    yield start,future.result()
+            while pending:
+                start,future = pending.popleft()
+                yield start,future.result()
+        finally:
+            #Consumer may stop early
+            for _,future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
     def sample_metadata(self,k):
         """
         Produces a sample of the full metadata with k items. Returns a cached sample if one exists
@@ -346,8 +582,12 @@ class GenericDS(ABC):
             
             samples = np.random.choice(range(len(self.X)),k,replace=False)
             
-            s_x = [self.X[s] for s in samples]
-            s_y = [self.Y[s] for s in samples]
+            if isinstance(self.X,TileTable):
+                s_x = self.X[samples]
+                s_y = s_x.labels
+            else:
+                s_x = [self.X[s] for s in samples]
+                s_y = [self.Y[s] for s in samples]
 
         #Save last generated sample
         self._cache.dump((s_x,s_y,self.name),'sampled_metadata.pik')
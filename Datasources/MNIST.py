@@ -7,11 +7,12 @@ import random
 
 #Keras MNIST
 from keras.datasets import mnist
-import keras.backend as K
 
 #Local modules
 from Datasources import GenericDatasource as gd
-from Preprocessing import NPImage
+from Datasources.TileTable import TileTable
+from Preprocessing.MMImage import MMImageFactory
+from Preprocessing.PackedStore import PackedStore,open_store,write_store
 from Utils import CacheManager
 
 class MNIST(gd.GenericDS):
@@ -36,47 +37,32 @@ class MNIST(gd.GenericDS):
         
     def _load_metadata_from_dir(self,d):
         """
-        Create NPImages from KERAS MNIST
+        MNIST is served from a packed store (see Preprocessing.PackedStore), created from KERAS MNIST on first
+        use. Samples are memory mapped and sliced by index; returns a TileTable.
         """
-        class_set = set()
-        t_x,t_y = ([],[])
+        dst = os.path.join(d,'mnist-store')
+        if not PackedStore.exists(dst):
+            (x_train, y_train), (x_test, y_test) = mnist.load_data()
 
-        (x_train, y_train), (x_test, y_test) = mnist.load_data()
-        
-        # input image dimensions
-        img_rows, img_cols = 28, 28
-        
-        if K.image_data_format() == 'channels_first':
-            x_train = x_train.reshape(x_train.shape[0], 1, img_rows, img_cols)
-            x_test = x_test.reshape(x_test.shape[0], 1, img_rows, img_cols)
-        else:
-            x_train = x_train.reshape(x_train.shape[0], img_rows, img_cols, 1)
-            x_test = x_test.reshape(x_test.shape[0], img_rows, img_cols, 1)
-
-        #Normalize
-        x_train = x_train.astype('float32')
-        x_test = x_test.astype('float32')
-        x_train /= 255
-        x_test /= 255       
-        tr_size = x_train.shape[0]
-        test_size = x_test.shape[0]
+            #Stores are channels last, uint8 (normalized to [0,1] when read)
+            img_rows, img_cols = 28, 28
+            data = np.concatenate((x_train,x_test)).reshape(-1, img_rows, img_cols, 1)
+            labels = np.concatenate((y_train,y_test))
+            origin = np.concatenate((np.zeros(x_train.shape[0],dtype=np.int32),np.ones(x_test.shape[0],dtype=np.int32)))
+            write_store(dst,data,labels,origin,['x_train','x_test'],nclasses=self.nclasses,verbose=self._verbose)
 
-        f_path = os.path.join(self.path,'mnist.npz')
-        for s in range(tr_size):
-            t_x.append(NPImage(f_path,x_train[s],True,'x_train',s,self._verbose))
-            t_y.append(y_train[s])
-            class_set.add(y_train[s])
+        X = TileTable(open_store(dst).columns(),self._view_factory())
+        return X,X.labels
 
-        for i in range(test_size):
-            t_x.append(NPImage(f_path,x_test[i],True,'x_test',i,self._verbose))
-            t_y.append(y_test[i])
-            class_set.add(y_test[i])
-
-        return t_x,t_y
-            
+    def _view_factory(self):
+        return MMImageFactory(self._keep,self._verbose)
 
     def check_paths(self,imgv,path):
 
+        if isinstance(imgv,TileTable):
+            imgv.change_root(self.change_root,path)
+            return
+
         for s in imgv:
             s.setPath(self.change_root(s.getPath(),path))
             
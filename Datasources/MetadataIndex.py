@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import os
+import numpy as np
+
+#Columnar representation of dataset metadata. A set of columns is a dictionary of arrays:
+# - prefixes <str array>: unique directories;
+# - prefix_id <int32 array>: directory of each item (index into prefixes);
+# - names <bytes array>: file names;
+# - labels <uint8 array>: int16 if there are labels outside the uint8 range;
+# - origins <str array>: unique origins;
+# - origin_id <int32 array>: origin of each item (index into origins);
+# - coords <int32 array (N,2)>: coordinates in original image, -1 if not available;
+# - dims <int32 array (N,3)>: image dimensions (width,height,channels), -1 if not known.
+_column_keys = ('prefixes','prefix_id','names','labels','origins','origin_id','coords','dims')
+
+def label_array(Y):
+    """
+    Labels are stored as uint8 whenever possible
+    """
+    y = np.asarray(Y)
+    if y.size == 0 or (y.min() >= 0 and y.max() <= 255):
+        return y.astype(np.uint8)
+    return y.astype(np.int16)
+
+def to_columns(X,Y):
+    """
+    Builds columns from lists of SegImages (X) and labels (Y)
+    """
+    n = len(X)
+    prefixes,origins = {},{}
+    prefix_id = np.empty(n,dtype=np.int32)
+    origin_id = np.empty(n,dtype=np.int32)
+    coords = np.full((n,2),-1,dtype=np.int32)
+    dims = np.full((n,3),-1,dtype=np.int32)
+    names = []
+    for i in range(n):
+        d,f = os.path.split(X[i].getPath())
+        prefix_id[i] = prefixes.setdefault(d,len(prefixes))
+        names.append(f.encode())
+        o = X[i].getOrigin()
+        origin_id[i] = origins.setdefault('' if o is None else o,len(origins))
+        c = X[i].getCoord() if hasattr(X[i],'getCoord') else None
+        if not c is None:
+            coords[i] = c
+
+    return {'prefixes':np.array(list(prefixes.keys()),dtype=str),
+            'prefix_id':prefix_id,
+            'names':np.array(names,dtype=bytes) if n > 0 else np.zeros(0,dtype='S1'),
+            'labels':label_array(Y),
+            'origins':np.array(list(origins.keys()),dtype=str),
+            'origin_id':origin_id,
+            'coords':coords,
+            'dims':dims}
+
+def empty_columns():
+    return to_columns([],[])
+
+def column_size(cols):
+    return cols['labels'].shape[0]
+
+def take_columns(cols,idx):
+    """
+    Returns the columns of items selected by idx (slice, index array or boolean mask). Lookup tables are shared.
+    """
+    sel = {k:cols[k][idx] for k in ('prefix_id','names','labels','origin_id','coords','dims')}
+    sel['prefixes'] = cols['prefixes']
+    sel['origins'] = cols['origins']
+    return sel
+
+def _merge_table(tables):
+    """
+    Union of lookup tables. Returns (merged table, list of id remapping arrays)
+    """
+    merged,remap = {},[]
+    for t in tables:
+        remap.append(np.array([merged.setdefault(v,len(merged)) for v in t.tolist()],dtype=np.int32))
+    return np.array(list(merged.keys()),dtype=str),remap
+
+def concat_columns(cols_list):
+    """
+    Concatenates sets of columns, merging their lookup tables.
+    """
+    cols_list = [c for c in cols_list if column_size(c) > 0]
+    if len(cols_list) == 0:
+        return empty_columns()
+    elif len(cols_list) == 1:
+        return cols_list[0]
+
+    prefixes,p_remap = _merge_table([c['prefixes'] for c in cols_list])
+    origins,o_remap = _merge_table([c['origins'] for c in cols_list])
+    return {'prefixes':prefixes,
+            'prefix_id':np.concatenate([p_remap[i][c['prefix_id']] for i,c in enumerate(cols_list)]),
+            'names':np.concatenate([c['names'] for c in cols_list]),
+            'labels':np.concatenate([c['labels'] for c in cols_list]),
+            'origins':origins,
+            'origin_id':np.concatenate([o_remap[i][c['origin_id']] for i,c in enumerate(cols_list)]),
+            'coords':np.concatenate([c['coords'] for c in cols_list]),
+            'dims':np.concatenate([c['dims'] for c in cols_list])}
+
+def dir_signature(d):
+    """
+    A directory changes when entries are added/removed (its own mtime), when any of its subdirectories
+    change or when its label file is rewritten. Returns the most recent of these modification times.
+    """
+    sig = os.stat(d).st_mtime
+    with os.scandir(d) as it:
+        for e in it:
+            if e.is_dir() or e.name == 'label.txt':
+                sig = max(sig,e.stat().st_mtime)
+    return sig
+
+class MetadataIndex(object):
+    """
+    Persistent per directory metadata index. Directory signatures (see dir_signature) are stored with the
+    metadata columns, so only new or modified directories need to be parsed again.
+    """
+    def __init__(self,root,index_file=None,verbose=0):
+        """
+        @param root <str>: dataset root directory
+        @param index_file <str>: index location (npz). If None, index is not persisted
+        """
+        self.root = root
+        self.index_file = index_file
+        self._verbose = verbose
+        self.dirs = []
+        self.signatures = np.zeros(0,dtype=np.float64)
+        self.offsets = np.zeros(1,dtype=np.int64)
+        self.cols = empty_columns()
+
+        if not index_file is None and os.path.isfile(index_file):
+            self._load()
+
+    def _load(self):
+        try:
+            with np.load(self.index_file) as data:
+                if str(data['root']) != self.root:
+                    return
+                self.dirs = data['dirs'].tolist()
+                self.signatures = data['signatures']
+                self.offsets = data['offsets']
+                self.cols = {k:data[k] for k in _column_keys}
+        except (IOError,ValueError,KeyError) as e:
+            if self._verbose > 0:
+                print("[MetadataIndex] Could not load index ({}), rebuilding".format(e))
+
+    def save(self):
+        if self.index_file is None:
+            return
+        index_dir = os.path.dirname(self.index_file)
+        if index_dir != '' and not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        tmp = self.index_file + '.tmp.npz'
+        np.savez(tmp,root=np.array(self.root),dirs=np.array(self.dirs,dtype=str),signatures=self.signatures,
+                     offsets=self.offsets,**self.cols)
+        os.replace(tmp,self.index_file)
+
+    def changed(self,dirs):
+        """
+        Returns (changed dirs, current signatures) for the given directory list
+        """
+        known = dict(zip(self.dirs,self.signatures.tolist()))
+        sigs = [dir_signature(d) for d in dirs]
+        return [d for d,s in zip(dirs,sigs) if known.get(d) != s],sigs
+
+    def update(self,dirs,parsed,signatures):
+        """
+        Rebuilds index for the given directory list.
+
+        @param dirs <list>: all current directories
+        @param parsed <dict>: directory -> columns of new or modified directories
+        @param signatures <list>: current signature of each directory in dirs
+
+        Directories missing from parsed (unchanged or that could not be parsed) keep their previous
+        entries, along with their previous signature, so that a failed parse is retried next time.
+        Directories that are neither parsed nor indexed are left out of the index.
+        """
+        position = {d:i for i,d in enumerate(self.dirs)}
+        chunks,offsets = [],[0]
+        i_dirs,i_sigs = [],[]
+        for d,s in zip(dirs,signatures):
+            if d in parsed:
+                c = parsed[d]
+            elif d in position:
+                i = position[d]
+                c = take_columns(self.cols,slice(self.offsets[i],self.offsets[i+1]))
+                s = self.signatures[i]
+            else:
+                if self._verbose > 0:
+                    print("[MetadataIndex] Directory not parsed, skipping: {}".format(d))
+                continue
+            chunks.append(c)
+            offsets.append(offsets[-1] + column_size(c))
+            i_dirs.append(d)
+            i_sigs.append(s)
+
+        self.dirs = i_dirs
+        self.signatures = np.array(i_sigs,dtype=np.float64)
+        self.offsets = np.array(offsets,dtype=np.int64)
+        self.cols = concat_columns(chunks)
+
+    def columns(self):
+        return self.cols
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import numpy as np
+import os
+
+#Local modules
+from Datasources import GenericDatasource as gd
+from Datasources.TileTable import TileTable
+from Preprocessing.MMImage import MMImageFactory
+from Preprocessing.PackedStore import open_store
+
+class Packed(gd.GenericDS):
+    """
+    Class that serves tiles from a PackedStore (see Preprocessing.PackedStore). Stores are built with
+    the -pack preprocessing option from any other Datasource.
+    """
+
+    def __init__(self,data_path,keepImg=False,config=None):
+        """
+        @param data_path <str>: path to directory where the store is kept
+        @param config <argparse>: configuration object
+        @param keepImg <boolean>: keep image data in memory
+        """
+        super().__init__(data_path,keepImg,config,name='Packed')
+        self.nclasses = int(open_store(self.path).index['nclasses'])
+
+        #Store is a single file
+        self.multi_dir = False
+
+    def _load_metadata_from_dir(self,d):
+        """
+        Tiles are served by a TileTable over the store index, no per tile objects are created
+        """
+        store = open_store(d)
+        X = TileTable(store.columns(),self._view_factory())
+
+        if self._verbose > 1:
+            print("On store {2}:\n - Number of classes: {0};\n - Classes: {1}".format(self.nclasses,np.unique(X.labels),d))
+
+        return X,X.labels
+
+    def _view_factory(self):
+        return MMImageFactory(self._keep,self._verbose)
+
+    def check_paths(self,imgv,path):
+
+        #Table items are <store path>/<tile position>, see MMImageFactory
+        if isinstance(imgv,TileTable):
+            imgv.change_root(lambda s,d: os.path.join(d,os.path.basename(s)),path)
+            return
+
+        super().check_paths(imgv,path)
+
+    def change_root(self,s,d):
+        """
+        s -> original path
+        d -> change location to d
+
+        Store path is the root itself
+        """
+        return d
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import os
+import numpy as np
+from collections.abc import Sequence
+
+from .MetadataIndex import to_columns,take_columns,concat_columns,column_size
+
+class PImageFactory(object):
+    """
+    Default view factory: creates PImage instances from table rows. Picklable, so tables can be
+    shipped to worker processes.
+    """
+    def __init__(self,keepImg=False,verbose=0):
+        self.keepImg = keepImg
+        self.verbose = verbose
+
+    def __call__(self,path,origin,coord):
+        from Preprocessing import PImage
+        return PImage(path,keepImg=self.keepImg,origin=origin,coord=coord,verbose=self.verbose)
+
+class TileTable(Sequence):
+    """
+    Struct of arrays representation of dataset metadata (see MetadataIndex for the columns). Items are
+    SegImage views created on access, so a table of millions of tiles costs a few bytes per tile instead
+    of one Python object per tile.
+
+    Indexing with an int returns a view; slices, index arrays and boolean masks return a new TileTable.
+
+    If the factory keeps images in memory (keepImg), views are retained by path once created and shared
+    by all tables derived from this one, so image data read through them stays in memory.
+    """
+    def __init__(self,cols,factory=None,kept=None):
+        """
+        @param cols <dict>: metadata columns
+        @param factory <callable>: factory(path,origin,coord) returns a SegImage (default: PImageFactory)
+        @param kept <dict>: path -> retained view, shared with the table this one derives from
+        """
+        #Tables stored before image dimensions were recorded
+        if not 'dims' in cols:
+            cols = dict(cols,dims=np.full((column_size(cols),3),-1,dtype=np.int32))
+        self.cols = cols
+        self.factory = PImageFactory() if factory is None else factory
+        self._kept = {} if kept is None else kept
+
+    def __getstate__(self):
+        """
+        Retained views (and their image data) are not shipped to other processes
+        """
+        state = self.__dict__.copy()
+        state['_kept'] = {}
+        return state
+
+    @classmethod
+    def from_images(cls,X,Y,factory=None):
+        """
+        Builds a table from lists of SegImages (X) and labels (Y)
+        """
+        return cls(to_columns(X,Y),factory)
+
+    def __len__(self):
+        return column_size(self.cols)
+
+    def __getitem__(self,idx):
+        if isinstance(idx,(int,np.integer)):
+            n = len(self)
+            if idx < 0:
+                idx += n
+            if idx < 0 or idx >= n:
+                raise IndexError("[TileTable] Index out of range ({} items)".format(n))
+            path = self.path(idx)
+            if not getattr(self.factory,'keepImg',False):
+                return self.factory(path,self.origin(idx),self.coord(idx))
+            view = self._kept.get(path)
+            if view is None:
+                view = self.factory(path,self.origin(idx),self.coord(idx))
+                self._kept[path] = view
+            return view
+        elif isinstance(idx,slice):
+            return TileTable(take_columns(self.cols,idx),self.factory,self._kept)
+        else:
+            idx = np.asarray(idx)
+            if idx.dtype != bool:
+                idx = idx.astype(np.intp)
+            return TileTable(take_columns(self.cols,idx),self.factory,self._kept)
+
+    def __repr__(self):
+        return "TileTable({} items, {} dirs, {} origins)".format(len(self),self.cols['prefixes'].shape[0],
+                                                                  self.cols['origins'].shape[0])
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    @property
+    def labels(self):
+        return self.cols['labels']
+
+    @property
+    def dims(self):
+        """
+        Image dimensions (width,height,channels) of every item, -1 rows if not known
+        """
+        return self.cols['dims']
+
+    def columns(self):
+        return self.cols
+
+    def copy(self):
+        return TileTable(dict(self.cols),self.factory,self._kept)
+
+    def path(self,i):
+        return os.path.join(str(self.cols['prefixes'][self.cols['prefix_id'][i]]),self.cols['names'][i].decode())
+
+    def paths(self):
+        """
+        Returns the list of all item paths
+        """
+        prefixes = self.cols['prefixes'].tolist()
+        return [os.path.join(prefixes[p],n.decode()) for p,n in zip(self.cols['prefix_id'].tolist(),self.cols['names'].tolist())]
+
+    def origin(self,i):
+        o = str(self.cols['origins'][self.cols['origin_id'][i]])
+        return None if o == '' else o
+
+    def coord(self,i):
+        """
+        Coordinates are returned as strings, as parsed from label files. None if not available.
+        """
+        c = self.cols['coords'][i]
+        return None if c[0] < 0 else (str(c[0]),str(c[1]))
+
+    def delete(self,idx):
+        """
+        Returns a new table without the items in idx (index array or boolean mask)
+        """
+        keep = np.ones(len(self),dtype=bool)
+        keep[idx] = False
+        return self[keep]
+
+    @staticmethod
+    def concat(tables):
+        """
+        Concatenates tables. Views are created by the factory of the first table.
+        """
+        kept = tables[0]._kept
+        for t in tables[1:]:
+            if not t._kept is kept:
+                kept = dict(kept)
+                kept.update(t._kept)
+        return TileTable(concat_columns([t.cols for t in tables]),tables[0].factory,kept)
+
+    def change_root(self,fn,path):
+        """
+        Relocates all items in place. fn(original path,path) returns the new path of an item (see
+        GenericDS.change_root); it's applied once per directory. Retained views (old paths) are dropped.
+        """
+        self._kept = {}
+        self.cols['prefixes'] = np.array([os.path.dirname(fn(os.path.join(p,'_'),path)) for p in self.cols['prefixes'].tolist()],dtype=str)
+
+#Helpers that accept both TileTables and SegImage lists/arrays
+def take_items(X,idx):
+    if isinstance(X,TileTable):
+        return X[idx]
+    return np.asarray(X)[idx]
+
+def delete_items(X,idx):
+    if isinstance(X,TileTable):
+        return X.delete(idx)
+    return np.delete(np.asarray(X),idx)
+
+def concat_items(X1,X2):
+    if isinstance(X1,TileTable) and isinstance(X2,TileTable):
+        return TileTable.concat([X1,X2])
+    return np.concatenate((np.asarray(X1),np.asarray(X2)),axis=0)
@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 #-*- coding: utf-8
 
-__all__ = ['CellRep','LDir','MNIST']
+__all__ = ['CellRep','LDir','MNIST','Packed']
 
 from .CellRep import CellRep
 from .LDir import LDir
 from .MNIST import MNIST
+from .Packed import Packed
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import io
+import numpy as np
+
+from .PImage import PImage
+from .ArchiveStore import open_archive
+
+class ArchImage(PImage):
+    """
+    Represents an image kept inside a tar or zip archive (see ArchiveStore). Paths are of the form 
+    <archive path>/<member name>; images are decoded from archive members without extraction.
+    """
+    def __init__(self,path,archive,index_path=None,keepImg=False,origin=None,coord=None,verbose=0):
+        """
+        @param path <str>: <archive path>/<member name>
+        @param archive <str>: archive file
+        @param index_path <str>: archive member index file (see ArchiveStore)
+        """
+        super().__init__(path,keepImg,origin,coord,verbose)
+        self._archive = archive
+        self._index_path = index_path
+
+    def _open_file(self):
+        store = open_archive(self._archive,self._index_path)
+        return io.BytesIO(store.read(store.member_path(self._path)))
+
+    def _read_file(self):
+        from PIL import Image
+        with Image.open(self._open_file()) as img:
+            return np.asarray(img)
+
+class ArchImageFactory(object):
+    """
+    TileTable view factory for archive datasources (see Datasources.TileTable)
+    """
+    def __init__(self,archive,index_path=None,keepImg=False,verbose=0):
+        self.archive = archive
+        self.index_path = index_path
+        self.keepImg = keepImg
+        self.verbose = verbose
+
+    def __call__(self,path,origin,coord):
+        return ArchImage(path,self.archive,self.index_path,keepImg=self.keepImg,origin=origin,coord=coord,verbose=self.verbose)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import os
+import threading
+import tarfile
+import zipfile
+import numpy as np
+
+def is_archive(path):
+    """
+    True if path is a tar or zip file
+    """
+    if not isinstance(path,str) or not os.path.isfile(path):
+        return False
+    return zipfile.is_zipfile(path) or tarfile.is_tarfile(path)
+
+class ArchiveStore(object):
+    """
+    Read only access to members of an uncompressed tar or a zip archive, without extraction. A member index
+    (names, data offsets and sizes) is built once by scanning member headers and kept in an npz file,
+    which is rebuilt if the archive changes (size or modification time).
+
+    Tar members are read by seeking to their data offset; zip members through zipfile (deflated members
+    are supported). Each thread keeps its own file handle.
+    """
+    def __init__(self,path,index_path=None,verbose=0):
+        """
+        @param path <str>: archive file
+        @param index_path <str>: member index file (Default: <path>.idx.npz)
+        @param verbose <int>: verbosity level
+        """
+        if not is_archive(path):
+            raise ValueError("[ArchiveStore] Not a tar or zip archive ({0}).".format(path))
+
+        self.path = path
+        self.index_path = path + '.idx.npz' if index_path is None else index_path
+        self._verbose = verbose
+        self._zip = zipfile.is_zipfile(path)
+        self._local = threading.local()
+        self._load_index()
+
+    def __len__(self):
+        return self.names.shape[0]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _signature(self):
+        st = os.stat(self.path)
+        return np.array([st.st_size,st.st_mtime_ns],dtype=np.int64)
+
+    def _load_index(self):
+        sig = self._signature()
+        if os.path.isfile(self.index_path):
+            with np.load(self.index_path) as f:
+                if np.array_equal(f['signature'],sig):
+                    self.names = f['names']
+                    self.offsets = f['offsets']
+                    self.sizes = f['sizes']
+                    self._positions = None
+                    return
+
+        if self._verbose > 0:
+            print("[ArchiveStore] Building member index of {}...".format(self.path))
+
+        names,offsets,sizes = [],[],[]
+        if self._zip:
+            with zipfile.ZipFile(self.path,'r') as zf:
+                for info in zf.infolist():
+                    if not info.is_dir():
+                        names.append(os.path.normpath(info.filename))
+                        offsets.append(info.header_offset)
+                        sizes.append(info.file_size)
+        else:
+            with tarfile.open(self.path,'r:') as tf:
+                for info in tf:
+                    if info.isfile():
+                        names.append(os.path.normpath(info.name))
+                        offsets.append(info.offset_data)
+                        sizes.append(info.size)
+
+        self.names = np.array(names,dtype=str) if len(names) > 0 else np.zeros(0,dtype='U1')
+        self.offsets = np.array(offsets,dtype=np.int64)
+        self.sizes = np.array(sizes,dtype=np.int64)
+        self._positions = None
+
+        idx_dir = os.path.dirname(os.path.abspath(self.index_path))
+        if not os.path.isdir(idx_dir):
+            os.makedirs(idx_dir)
+        tmp = self.index_path + '.tmp.npz'
+        np.savez(tmp,signature=sig,names=self.names,offsets=self.offsets,sizes=self.sizes)
+        os.replace(tmp,self.index_path)
+
+        if self._verbose > 0:
+            print("[ArchiveStore] Indexed {} members".format(len(names)))
+
+    @property
+    def positions(self):
+        """
+        Member name -> index position, created on first use
+        """
+        if self._positions is None:
+            self._positions = {n:i for i,n in enumerate(self.names.tolist())}
+        return self._positions
+
+    def has(self,member):
+        return os.path.normpath(member) in self.positions
+
+    def members(self,prefix=''):
+        """
+        Names of members in directory prefix (recursively)
+        """
+        if prefix == '':
+            return self.names.tolist()
+        prefix = os.path.normpath(prefix) + '/'
+        return [n for n in self.names.tolist() if n.startswith(prefix)]
+
+    def _handle(self):
+        fd = getattr(self._local,'fd',None)
+        if fd is None:
+            fd = zipfile.ZipFile(self.path,'r') if self._zip else open(self.path,'rb')
+            self._local.fd = fd
+        return fd
+
+    def read(self,member):
+        """
+        Returns member contents (bytes)
+        """
+        member = os.path.normpath(member)
+        i = self.positions.get(member)
+        if i is None:
+            raise KeyError("[ArchiveStore] No such member in {}: {}".format(self.path,member))
+        fd = self._handle()
+        if self._zip:
+            return fd.read(member)
+        fd.seek(int(self.offsets[i]))
+        return fd.read(int(self.sizes[i]))
+
+    def member_path(self,path):
+        """
+        Member name of a path of the form <archive path>/<member>
+        """
+        return os.path.relpath(path,self.path)
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def open_archive(path,index_path=None,verbose=0):
+    """
+    Returns an ArchiveStore, one instance per archive and process
+    """
+    with _stores_lock:
+        if not path in _stores:
+            _stores[path] = ArchiveStore(path,index_path,verbose)
+        return _stores[path]
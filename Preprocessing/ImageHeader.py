@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import struct
+
+__doc__ = """
+Image dimensions from file headers, without decoding pixel data. PNG headers (IHDR chunk) are parsed
+directly; other formats (TIFF tags, JPEG frame headers, etc) are identified by PIL, which only reads
+headers when opening a file.
+"""
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+#Channels of decoded images, as returned by PImage.readImage (alpha channels are removed)
+_png_channels = {0:1,2:3,3:3,4:2,6:3}
+_mode_channels = {'1':1,'L':1,'I':1,'F':1,'I;16':1,'LA':2,'P':3,'RGB':3,'RGBA':3,'YCbCr':3,'CMYK':3}
+
+def image_dims(fd):
+    """
+    Dimensions of an image from its header.
+
+    @param fd <file>: binary file object, positioned at the start of the image
+    Returns a tuple (width,height,channels)
+    """
+    head = fd.read(26)
+    if len(head) == 26 and head[:8] == _PNG_SIGNATURE and head[12:16] == b'IHDR':
+        w,h = struct.unpack('>II',head[16:24])
+        return (w,h,_png_channels.get(head[25],3))
+
+    from PIL import Image
+    fd.seek(0)
+    with Image.open(fd) as img:
+        w,h = img.size
+        return (w,h,_mode_channels.get(img.mode,3))
+
+def file_dims(path):
+    """
+    Dimensions (width,height,channels) of an image file, from its header
+    """
+    with open(path,'rb') as fd:
+        return image_dims(fd)
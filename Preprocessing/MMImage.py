@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import os
+import numpy as np
+
+from .SegImage import SegImage
+from .PackedStore import open_store
+
+class MMImage(SegImage):
+    """
+    Represents a tile kept inside a PackedStore. Data is a memory mapped view of the store array.
+    """
+    def __init__(self,path,index,keepImg=False,origin=None,coord=None,verbose=0):
+        """
+        @param path <str>: path to the store directory
+        @param index <int>: tile position in store
+        @param keepImg <bool>: keep image data in memory
+        @param origin <str>: current image is originated from origin
+        @param coord <tuple>: coordinates in original image
+        """
+        super().__init__(path,keepImg,verbose)
+        self._index = int(index)
+        self._coord = coord
+        self._origin = origin
+
+    def __str__(self):
+        """
+        String representation is (coord)-origin if exists, else, store index
+        """
+        if not (self._coord is None and self._origin is None):
+            return "{0}-{1}".format(self._coord,self._origin)
+        else:
+            return "{0}[{1}]".format(os.path.basename(self._path),self._index)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __eq__(self,other):
+        if not isinstance(other,MMImage):
+            return False
+        else:
+            return self._index == other._index and self._path == other.getPath()
+
+    def __hash__(self):
+        return hash((os.path.basename(self._path),self._index))
+
+    def getIndex(self):
+        return self._index
+
+    def readImage(self,keepImg=None,size=None,verbose=None,toFloat=True):
+        """
+        Returns a zero copy view of the tile if toFloat is False and no resizing is needed.
+        """
+        if not verbose is None:
+            self._verbose = verbose
+
+        if not self._data is None:
+            data = self._data
+        else:
+            data = open_store(self._path).view(self._index)
+
+        if not size is None and data.shape[:len(size)] != tuple(size):
+            from skimage import transform
+            data = np.rint(transform.resize(data,size,preserve_range=True)).astype(np.uint8)
+
+        if keepImg:
+            self.setKeepImg(keepImg)
+        if self._keep and self._data is None:
+            self._data = np.array(data)
+
+        if toFloat:
+            data = data.astype(np.float32)
+            data /= 255.0
+
+        return data
+
+    @staticmethod
+    def readBatch(items,size=None,verbose=0,toFloat=True):
+        """
+        Reads a list of MMImage instances with one fancy indexing operation per store.
+        Returns an array of shape (len(items),height,width,channels).
+        """
+        stores = {}
+        for k in range(len(items)):
+            stores.setdefault(items[k].getPath(),[]).append(k)
+
+        batch = None
+        for path in stores:
+            pos = stores[path]
+            data = open_store(path).read([items[k].getIndex() for k in pos])
+            if batch is None:
+                batch = np.empty((len(items),) + data.shape[1:],dtype=data.dtype)
+            batch[pos] = data
+
+        if not size is None and batch.shape[1:len(size)+1] != tuple(size):
+            from skimage import transform
+            batch = np.stack([np.rint(transform.resize(b,size,preserve_range=True)) for b in batch]).astype(np.uint8)
+
+        if toFloat:
+            batch = batch.astype(np.float32)
+            batch /= 255.0
+
+        return batch
+
+    def readImageRegion(self,x,y,dx,dy):
+        data = self.readImage(toFloat=False)
+
+        return data[y:(y+dy), x:(x+dx)]
+
+    def getImgDim(self):
+        """
+        Implements abstract method of SegImage. All tiles in a store have the same shape.
+        """
+        if self._dim is None:
+            h,w,c = open_store(self._path).shape()
+            self._dim = (w,h,c)
+        return self._dim
+
+    def getOrigin(self):
+        return self._origin
+
+    def getCoord(self):
+        if not self._coord is None:
+            return (int(self._coord[0]),int(self._coord[1]))
+        else:
+            return None
+
+class MMImageFactory(object):
+    """
+    TileTable view factory for packed stores (see PackedStore.columns). Item paths are of the form
+    <store path>/<tile position>.
+    """
+    def __init__(self,keepImg=False,verbose=0):
+        self.keepImg = keepImg
+        self.verbose = verbose
+
+    def __call__(self,path,origin,coord):
+        d,i = os.path.split(path)
+        return MMImage(d,int(i),keepImg=self.keepImg,origin=origin,coord=coord,verbose=self.verbose)
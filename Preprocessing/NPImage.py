@@ -3,6 +3,7 @@
 
 import os
 import numpy as np
+import skimage
 
 from .SegImage import SegImage
 
@@ -41,10 +42,12 @@ class NPImage(SegImage):
         # Hashes current dir and file name
         return hash((os.path.basename(self._path),self._origin,self._coord))
 
-    def readImage(self,keepImg=None,size=None,verbose=None):
-
+    def readImage(self,keepImg=None,size=None,verbose=None,toFloat=True):
+        """
+        Returns stored data as is, or converted to uint8 if toFloat is False.
+        """
         if not self._data is None:
-            return self._data
+            return self._data if toFloat else self._to_ubyte(self._data)
 
         data = None
         with np.load(self._path, allow_pickle=True) as f:
@@ -62,7 +65,12 @@ class NPImage(SegImage):
         if self._keep:
             self._data = data
 
-        return data
+        return data if toFloat else self._to_ubyte(data)
+
+    def _to_ubyte(self,data):
+        if data.dtype == np.uint8:
+            return data
+        return skimage.img_as_ubyte(data)
 
     def getImgDim(self):
         """
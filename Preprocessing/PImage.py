@@ -7,6 +7,8 @@ import skimage
 from skimage import io
 
 from .SegImage import SegImage
+from .ImageHeader import image_dims
+from .TileCache import tile_cache
 
 class PImage(SegImage):
     """
@@ -39,6 +41,18 @@ class PImage(SegImage):
         # Hashes current dir and file name
         return hash((self._path.split(os.path.sep)[-2],os.path.basename(self._path)))
     
+    def _read_file(self):
+        """
+        Decodes image file
+        """
+        return io.imread(self._path)
+
+    def _open_file(self):
+        """
+        Binary file object of the image file
+        """
+        return open(self._path,'rb')
+
     def readImage(self,keepImg=None,size=None,verbose=None,toFloat=True):
         
         data = None
@@ -51,11 +65,26 @@ class PImage(SegImage):
         if not verbose is None:
             self._verbose = verbose
             
-        if self._data is None:
+        cache = tile_cache()
+        key = (self._path,None if size is None else tuple(size),toFloat)
+        if self._data is None and not cache is None:
+            data = cache.get(key)
+
+        if self._data is None and not data is None:
+            if self._verbose > 1:
+                print("Cached image: {0}".format(self._path))
+
+            h,w,c = data.shape
+            self._dim = (w,h,c)
+
+            if self._keep:
+                self._data = data
+
+        elif self._data is None:
             if self._verbose > 1:
                 print("Reading image: {0}".format(self._path))
                 
-            data = io.imread(self._path);
+            data = self._read_file()
 
             #Convert data to float and also normalizes between [0,1]
             if toFloat:
@@ -67,10 +96,16 @@ class PImage(SegImage):
             if not size is None and data.shape != size:
                 if self._verbose > 1:
                     print("Resizing image {0} from {1} to {2}".format(os.path.basename(self._path),data.shape,size))
-                data = skimage.transform.resize(data,size)
+                if toFloat:
+                    data = skimage.transform.resize(data,size)
+                else:
+                    data = np.rint(skimage.transform.resize(data,size,preserve_range=True)).astype(data.dtype)
                 
             h,w,c = data.shape
             self._dim = (w,h,c)
+
+            if not cache is None:
+                cache.put(key,data)
             
             if self._keep:
                 self._data = data
@@ -95,7 +130,8 @@ class PImage(SegImage):
         
     def getImgDim(self):
         """
-        Implements abstract method of SegImage
+        Implements abstract method of SegImage. Dimensions are read from the file header; the image is only
+        decoded if the header can't be parsed.
         """
         h,w,c = 0,0,0
 
@@ -104,7 +140,14 @@ class PImage(SegImage):
         elif not self._data is None:
             h,w,c = self._data.shape
         else:
-            data = io.imread(self._path);
+            try:
+                with self._open_file() as fd:
+                    self._dim = image_dims(fd)
+                return self._dim
+            except (OSError,ValueError) as e:
+                if self._verbose > 1:
+                    print("[PImage] Could not parse header of {} ({}), decoding image".format(self._path,e))
+            data = self._read_file()
             if(data.shape[2] > 3): # remove the alpha
                 data = data[:,:,0:3];
             h,w,c = data.shape
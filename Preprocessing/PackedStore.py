@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import os
+import threading
+import concurrent.futures
+import numpy as np
+
+from tqdm import tqdm
+
+class PackedStore(object):
+    """
+    A whole dataset packed in a single contiguous uint8 array file (tiles.npy), of shape (N,height,width,channels),
+    accompanied by an index file (index.npz) with labels, origins and coordinates of each tile.
+
+    Tiles are served as memory mapped views, so no image decoding is done at read time.
+    """
+    data_file = 'tiles.npy'
+    index_file = 'index.npz'
+
+    def __init__(self,path,verbose=0):
+        """
+        @param path <str>: directory where store files are kept
+        @param verbose <int>: verbosity level
+        """
+        if not isinstance(path,str) or not os.path.isfile(os.path.join(path,self.data_file)):
+            raise ValueError("[PackedStore] Path does not contain a packed store ({0}).".format(path))
+
+        self.path = path
+        self._verbose = verbose
+        self._data = None
+        self._index = None
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    @staticmethod
+    def exists(path):
+        return os.path.isfile(os.path.join(path,PackedStore.data_file)) and \
+          os.path.isfile(os.path.join(path,PackedStore.index_file))
+
+    @property
+    def data(self):
+        """
+        Memory mapped array, opened read only on first access
+        """
+        if self._data is None:
+            self._data = np.load(os.path.join(self.path,self.data_file),mmap_mode='r')
+        return self._data
+
+    @property
+    def index(self):
+        """
+        Dictionary of index arrays: labels, origin (ids), origins (names), coords, paths, nclasses
+        """
+        if self._index is None:
+            with np.load(os.path.join(self.path,self.index_file)) as f:
+                self._index = {k:f[k] for k in f.files}
+        return self._index
+
+    def shape(self):
+        """
+        Shape of a single tile (height,width,channels)
+        """
+        return self.data.shape[1:]
+
+    def columns(self):
+        """
+        Metadata columns of all tiles (see Datasources.MetadataIndex), so a store can back a TileTable
+        without creating one object per tile. Tiles are named by their position in the store (see
+        MMImageFactory).
+        """
+        index = self.index
+        n = len(self)
+        h,w,c = self.shape()
+        origins = index['origins'] if index['origins'].shape[0] > 0 else np.array([''])
+        return {'prefixes':np.array([self.path],dtype=str),
+                'prefix_id':np.zeros(n,dtype=np.int32),
+                'names':np.arange(n).astype(bytes),
+                'labels':np.array(index['labels']),
+                'origins':np.asarray(origins,dtype=str),
+                'origin_id':index['origin'].astype(np.int32),
+                'coords':index['coords'].astype(np.int32),
+                'dims':np.tile(np.array([w,h,c],dtype=np.int32),(n,1))}
+
+    def view(self,i):
+        """
+        Zero copy view of tile i
+        """
+        return self.data[i]
+
+    def read(self,idx):
+        """
+        Reads a batch of tiles with a single fancy indexing operation. Indexes are sorted before
+        access so the underlying file is read sequentially, then returned in requested order.
+
+        @param idx <iterable>: tile indexes
+        """
+        idx = np.asarray(idx,dtype=np.int64)
+        order = np.argsort(idx,kind='mergesort')
+        batch = np.empty((idx.shape[0],) + self.shape(),dtype=self.data.dtype)
+        batch[order] = self.data[idx[order]]
+        return batch
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def open_store(path,verbose=0):
+    """
+    Returns a shared PackedStore instance for path. Stores are opened only once per process.
+    """
+    with _stores_lock:
+        if not path in _stores:
+            _stores[path] = PackedStore(path,verbose)
+        return _stores[path]
+
+def _pack_tile(img,dim):
+    """
+    Reads a tile as uint8 and resizes it to dim (height,width,channels) if needed.
+    """
+    import skimage
+    from skimage import transform
+
+    data = img.readImage(keepImg=False,size=None,toFloat=False)
+    if data.shape != dim:
+        data = transform.resize(data,dim,preserve_range=True)
+        data = np.rint(data).astype(np.uint8)
+    return data
+
+def build_store(X,Y,dst,dim,nclasses=2,workers=1,verbose=0,pbar=False):
+    """
+    Packs the images in X (SegImage instances) into a store placed in dst. Should be run once,
+    from the output of GenericDS.load_metadata.
+
+    @param X <list>: SegImage instances
+    @param Y <list>: labels
+    @param dst <str>: output directory
+    @param dim <tuple>: tile shape as (height,width,channels). Tiles of different shapes are resized.
+    @param nclasses <int>: number of classes in dataset
+    @param workers <int>: reading threads
+    """
+    if not os.path.isdir(dst):
+        os.makedirs(dst)
+
+    samples = len(X)
+    dim = tuple(dim)
+    data = np.lib.format.open_memmap(os.path.join(dst,PackedStore.data_file),mode='w+',
+                                         dtype=np.uint8,shape=(samples,)+dim)
+
+    #Index arrays
+    labels = np.asarray(Y,dtype=np.uint8)
+    origins = {}
+    origin = np.zeros(samples,dtype=np.int32)
+    coords = np.full((samples,2),-1,dtype=np.int32)
+    paths = []
+    for i in range(samples):
+        img = X[i]
+        o = img.getOrigin() if hasattr(img,'getOrigin') else None
+        o = '' if o is None else o
+        origin[i] = origins.setdefault(o,len(origins))
+        c = img.getCoord() if hasattr(img,'getCoord') else None
+        if not c is None:
+            coords[i] = c
+        paths.append(img.getPath())
+    o_names = [None]*len(origins)
+    for o in origins:
+        o_names[origins[o]] = o
+
+    if pbar:
+        l = tqdm(desc="Packing tiles...",total=samples,position=0)
+    elif verbose > 0:
+        print("[PackedStore] Packing {} tiles into {}".format(samples,dst))
+
+    #Bounded number of tiles in flight
+    window = max(1,workers)*4
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1,workers))
+    futures = {}
+    for i in range(samples):
+        futures[i] = executor.submit(_pack_tile,X[i],dim)
+        if len(futures) >= window or i == samples - 1:
+            for k in sorted(futures):
+                data[k] = futures[k].result()
+                if pbar:
+                    l.update(1)
+            futures.clear()
+    executor.shutdown()
+
+    if pbar:
+        l.close()
+
+    data.flush()
+    del(data)
+    _write_index(dst,labels,origin,o_names,coords,paths,nclasses)
+
+    return open_store(dst,verbose)
+
+def write_store(dst,data,labels,origin=None,origins=None,nclasses=2,block=65536,verbose=0):
+    """
+    Packs an array shaped dataset (e.g. MNIST) into a store placed in dst.
+
+    @param data <ndarray>: uint8 tiles (N,height,width,channels)
+    @param labels <ndarray>: labels
+    @param origin <ndarray>: origin id of each tile (index into origins)
+    @param origins <list>: origin names
+    @param block <int>: tiles copied at a time
+    """
+    if not os.path.isdir(dst):
+        os.makedirs(dst)
+
+    samples = data.shape[0]
+    if verbose > 0:
+        print("[PackedStore] Packing {} tiles into {}".format(samples,dst))
+    out = np.lib.format.open_memmap(os.path.join(dst,PackedStore.data_file),mode='w+',
+                                        dtype=np.uint8,shape=data.shape)
+    for i in range(0,samples,block):
+        out[i:i+block] = data[i:i+block]
+    out.flush()
+    del(out)
+
+    origin = np.zeros(samples,dtype=np.int32) if origin is None else np.asarray(origin,dtype=np.int32)
+    origins = [''] if origins is None else origins
+    _write_index(dst,np.asarray(labels,dtype=np.uint8),origin,origins,np.full((samples,2),-1,dtype=np.int32),
+                     [],nclasses)
+
+    return open_store(dst,verbose)
+
+def _write_index(dst,labels,origin,origins,coords,paths,nclasses):
+    #A previously opened store at dst would hold stale maps
+    with _stores_lock:
+        _stores.pop(dst,None)
+    np.savez(os.path.join(dst,PackedStore.index_file),labels=labels,origin=origin,origins=np.asarray(origins),
+                 coords=coords,paths=np.asarray(paths),nclasses=np.asarray(nclasses))
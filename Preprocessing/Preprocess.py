@@ -34,6 +34,11 @@ def preprocess_data(config,img_types):
     if not os.path.exists(config.predst):
         os.makedirs(config.predst)
 
+    #Packing works from Datasource metadata, no image tree scan needed
+    if config.pack:
+        make_packed_store(config)
+        return None
+
     #If SRC dir has already been scanned, no need to redo:
     cache_m = CacheManager(verbose=config.verbose)
     datatree = None
@@ -52,49 +57,170 @@ def preprocess_data(config,img_types):
             datatree = GenericData.ImageSource(None,config.presrc,img_types)
             cache_m.dump((datatree.getData(),datatree.getLabelsList(),config.presrc),'datatree.pik')
 
-    #Produce tiles from input images
-    #TODO: implement parallel tiling, choose between multiprocess tiling (multiple images processed in parallel) or single process (one image
-    #at a time, but work divided in threads
+    #Produce tiles from input images: multiprocess tiling shards slides among processes, single process
+    #tiling works one slide at a time. In both cases, tiles of a slide are extracted by a pool of threads.
     if config.tile:
         if config.multiprocess:
-            multiprocess_run(make_singleprocesstiling,(config,),datatree,step_size=20)
-            #make_multiprocesstiling(datatree,config)
+            make_multiprocesstiling(datatree,config)
         else:
             make_singleprocesstiling(datatree,config)
     elif not config.normalize is None:
         make_singleprocessnorm(datatree,config)
 
 
+def make_packed_store(config):
+    """
+    Packs the tiles parsed by the Datasource given in -data (from -presrc) into a single memory mapped
+    store, placed in -predst. Tiles are resized to -tdim if given, else to the smallest dataset dimension.
+    """
+    import importlib
+    from .PackedStore import build_store
+
+    dsname = config.data if config.data else 'CellRep'
+    dsm = importlib.import_module('Datasources',dsname)
+    ds = getattr(dsm,dsname)(config.presrc,False,config)
+    X,Y = ds.load_metadata()
+
+    if not config.tdim is None and len(config.tdim) == 2:
+        dim = tuple(config.tdim) + (3,)
+    elif not config.tdim is None:
+        dim = tuple(config.tdim)
+    else:
+        w,h,c = ds.get_dataset_dimensions(X)[0][1:]
+        dim = (h,w,c)
+
+    if config.info:
+        print("[Preprocess] Packing {} tiles of shape {} into {}".format(len(X),dim,config.predst))
+
+    return build_store(X,Y,config.predst,dim,nclasses=ds.nclasses,workers=config.cpu_count,
+                           verbose=config.verbose,pbar=config.progressbar)
+
+#Whole slide image formats handled by OpenSlide
+_slide_types = ('svs','tif','tiff','ndpi','mrxs','vms','scn','bif')
+
+def _slide_list(data):
+    """
+    Returns the SegImages to be tiled from a data tree. Whole slide images are read through OpenSlide.
+    """
+    from .SVSImage import SVSImage
+
+    slides = []
+    for img in data.getImgList():
+        if not isinstance(img,SVSImage) and img.getPath().split('.')[-1].lower() in _slide_types:
+            img = SVSImage(img.getPath())
+        slides.append(img)
+
+    return slides
+
+def _tiling_setup(data,config):
+    """
+    Returns (slides,tile size,normalizer,manifest path). Slides already listed in the tiling manifest are
+    removed from slides, so interrupted runs resume from the first unfinished slide.
+    """
+    if config.tdim is None:
+        tsize = (200,200)
+        if config.info:
+            print("[Preprocess] No tile dimensions given (-tdim), using {}".format(tsize))
+    else:
+        tsize = tuple(config.tdim[:2])
+
+    normalizer = ReinhardNormalizer(config.normalize) if not config.normalize is None else None
+    
+    manifest = os.path.join(config.predst,'tiling_manifest.txt')
+    done = set()
+    if os.path.isfile(manifest):
+        with open(manifest,'r') as fd:
+            done = set([l.split('\t')[0] for l in fd.read().splitlines() if l])
+
+    slides = [img for img in _slide_list(data) if not img.getImgName() in done]
+    if config.info and len(done) > 0:
+        print("[Preprocess] {} slides already tiled (see {}), {} remaining".format(len(done),manifest,len(slides)))
+
+    return slides,tsize,normalizer,manifest
+
+def _update_manifest(manifest,result):
+    """
+    Records a fully tiled slide: name, saved tiles, rejected (background) tiles and tiles skipped by tissue mask
+    """
+    with open(manifest,'a') as fd:
+        fd.write("\t".join([str(r) for r in result]) + "\n")
+
+def _report_slide(result):
+    total = sum(result[1:])
+    print("[Preprocess] Slide {0}: {1} tiles saved, {2} background tiles discarded, {3} skipped by tissue mask ({4:.1%})".format(
+        *result,result[3]/total if total > 0 else 0.0))
+
+def _tile_slide(img,tsize,normalizer,outdir,workers,verbose,progress_bar=False,position=0,mask_threshold=0.0):
+    """
+    Tiles a single slide, keeping one open OpenSlide handle shared by all tiling threads.
+    Returns (slide name, saved tiles, background tiles, tiles skipped by tissue mask)
+    """
+    tiles_dir = os.path.join(outdir,img.getImgName())
+    if not os.path.isdir(tiles_dir):
+        os.makedirs(tiles_dir)
+
+    img.setKeepImg(True)
+    try:
+        result,skipped = thread_pool_tiler(img,tsize,progress_bar,normalizer,outdir,workers,verbose,position,mask_threshold)
+    finally:
+        img.setKeepImg(False)
+
+    saved = len([r for r in result if not r is None])
+    return (img.getImgName(),saved,len(result)-saved,skipped)
+
 def make_multiprocesstiling(data,config):
     """
-    Generates tiles from input images using multiple processes (process pool).
+    Generates tiles from input images using multiple processes (process pool). Each process tiles one slide
+    at a time, with cpu_count/processes threads.
     """
-    step_size = 20
-    exec_function = thread_pool_tiler
-    dp_path,config.tdim,config.progressbar,config.verbose,process_counter+1
+    slides,tsize,normalizer,manifest = _tiling_setup(data,config)
+    if len(slides) == 0:
+        return None
+    
+    processes = min(config.cpu_count,len(slides))
+    workers = max(2,config.cpu_count // processes)
+    
+    if config.progressbar:
+        l = tqdm.tqdm(desc="Tiling slides...",total=len(slides),position=0)
+        
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(_tile_slide,img,tsize,normalizer,config.predst,workers,config.verbose,
+                                       mask_threshold=config.tissue_threshold) for img in slides]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            _update_manifest(manifest,result)
+            if config.progressbar:
+                l.update(1)
+            elif config.info:
+                _report_slide(result)
+
+    if config.progressbar:
+        l.close()
 
 def make_singleprocesstiling(data,config):
     """
     Generates tiles from one input image at a time, but in a multithreaded setup.
     """
-    normalizer = ReinhardNormalizer(config.normalize)
+    slides,tsize,normalizer,manifest = _tiling_setup(data,config)
     
-    for img in data:
-        tiles_dir = os.path.join(config.predst,img.getImgName())
-        if not os.path.isdir(tiles_dir):
-            os.makedirs(tiles_dir)
-        thread_pool_tiler(img,config.tdim,config.progressbar,normalizer,config.verbose)
+    for img in slides:
+        result = _tile_slide(img,tsize,normalizer,config.predst,config.cpu_count,config.verbose,config.progressbar,
+                                 mask_threshold=config.tissue_threshold)
+        _update_manifest(manifest,result)
+        if config.info:
+            _report_slide(result)
 
 
 def make_singleprocessnorm(data,config):
     """
-    Single process but multithreaded normalization
+    Single process but multithreaded normalization. Each thread normalizes a batch of tiles at once.
     """
     import shutil
     
     executor = concurrent.futures.ThreadPoolExecutor(max_workers=config.cpu_count)
     pool_result = []
     futures = []
+    batch_size = 32
 
     pimgs = data.getImgList()
     labels = data.getLabelsList()
@@ -109,15 +235,18 @@ def make_singleprocessnorm(data,config):
         subdir = os.path.join(config.predst,os.path.split(os.path.dirname(img.getPath()))[1])
         if not os.path.isdir(subdir):
             os.mkdir(subdir)
-        futures.append(executor.submit(save_normalize_tile,img,None,normalizer,config.predst,config.verbose))
+
+    for i in range(0,len(pimgs),batch_size):
+        futures.append(executor.submit(save_normalize_batch,pimgs[i:i+batch_size],normalizer,config.predst,config.verbose))
         
     #for future in concurrent.futures.as_completed(futures):
     for future in futures:
-        pool_result.append(future.result())
+        result = future.result()
+        pool_result.extend(result)
         if config.progressbar:
-            l.update(1)
+            l.update(len(result))
         elif config.info:
-            print('.',endl='')
+            print('.',end='')
             
     if config.progressbar:
         l.close()
@@ -129,62 +258,80 @@ def make_singleprocessnorm(data,config):
                         
     return pool_result    
 
-def thread_pool_tiler(img,tsize,progress_bar,normalizer,verbose):
+def thread_pool_tiler(img,tsize,progress_bar,normalizer,outdir,workers=2,verbose=0,position=0,mask_threshold=0.0):
     """
-    Creates a thread pool to make tiles of the given image
+    Creates a thread pool to make tiles of the given image. At most 2*workers tiles are in memory at any time.
+    Whole slide images are screened by a tissue mask first: background regions are never read.
 
     @param img <SegImage>: Any class that implements SegImage's methods
     @param tsize <tuple>: (width,height)
     @param progress_bar <bool>: display progress bars
-    @param normalizer <str>: Reinhard normalizer instance 
+    @param normalizer <ReinhardNormalizer>: Reinhard normalizer instance (None: no normalization)
+    @param outdir <str>: tiles are saved in outdir/<image name>
+    @param workers <int>: number of threads
+    @param position <int>: progress bar position
+    @param mask_threshold <float>: tissue mask threshold (see tissue_mask). 0 disables the mask
+    Returns (list of saved tile dimensions - None for background tiles -, number of tiles skipped by tissue mask)
     """
     img_size = img.getImgDim()
     width = img_size[0]
     height = img_size[1]
 
-    max_workers = (((width*height) // (tsize[0]*tsize[1]))/2)
-    max_workers = max_workers if max_workers > 1 else 2
-    
-    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
-    pool_result = []
-    counter = 0
-    futures = {}
-    tile_coords = []
-
-    #Tiles (x,y) top left corner points -
-    #TODO: some tiles will need padding later
-    margin = 10
-    for x in range(1, width, tsize[0]):
-        for y in range(1, height, tsize[1]):
-            if x + tsize[0] > width - margin:
-                pw_x = width - x - margin
-            else:
-                pw_x = pw
-            if y + tsize[1] > height - margin:
-                pw_y = height - y - margin
-            else:
-                pw_y = pw
-
-            if pw_x <= 0 or pw_y <= 0:
-                continue
-            tile_coords.append((x,y,pw_x,pw_y))
-            
-    for i in range(len(tile_coords)):
-        futures[executor.submit(save_normalize_tile,img,tile_coords[i],normalizer,verbose)] = i
+    def _tile_coords():
+        #Tiles (x,y) top left corner points -
+        #TODO: some tiles will need padding later
+        margin = 10
+        for x in range(1, width, tsize[0]):
+            for y in range(1, height, tsize[1]):
+                if x + tsize[0] > width - margin:
+                    pw_x = width - x - margin
+                else:
+                    pw_x = tsize[0]
+                if y + tsize[1] > height - margin:
+                    pw_y = height - y - margin
+                else:
+                    pw_y = tsize[1]
+
+                if pw_x <= 0 or pw_y <= 0:
+                    continue
+                yield (x,y,pw_x,pw_y)
+
+    from .SVSImage import SVSImage
+
+    coords = list(_tile_coords())
+    skipped = 0
+    if mask_threshold > 0 and isinstance(img,SVSImage) and len(coords) > 0:
+        tissue = tissue_mask(img,coords,tsize,mask_threshold)
+        skipped = len(coords) - int(tissue.sum())
+        coords = [coords[i] for i in np.flatnonzero(tissue)]
+        if verbose > 0:
+            print("[Preprocess] Tissue mask of {}: {} of {} tiles skipped ({:.1%})".format(img.getImgName(),skipped,
+                                                                                      len(coords)+skipped,skipped/(len(coords)+skipped)))
 
     if progress_bar:
-        l = tqdm(desc="Extracting tile...",total=len(tile_coords),position=position)
-        
-    #for future in concurrent.futures.as_completed(futures):
-    for future in futures:
-        pool_result.append(future.result())
-        if progress_bar:
-            l.update(1)
+        l = tqdm.tqdm(desc="Extracting tiles from {}...".format(img.getImgName()),total=len(coords),position=position)
+
+    pool_result = []
+    window = 2*workers
+    futures = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for coord in coords:
+            if len(futures) >= window:
+                finished,futures = concurrent.futures.wait(futures,return_when=concurrent.futures.FIRST_COMPLETED)
+                pool_result.extend([f.result() for f in finished])
+                if progress_bar:
+                    l.update(len(finished))
+            futures.add(executor.submit(save_normalize_tile,img,coord,normalizer,outdir,verbose))
+
+        for f in concurrent.futures.as_completed(futures):
+            pool_result.append(f.result())
+            if progress_bar:
+                l.update(1)
             
     if progress_bar:
         l.close()
 
-    return pool_result
+    return pool_result,skipped
 
 
 def save_normalize_tile(img,dimensions,normalizer,outdir,verbose):
@@ -193,6 +340,7 @@ def save_normalize_tile(img,dimensions,normalizer,outdir,verbose):
 
     @param img <SegImage>: any object that implements SegImage
     @param dimensions: tuple (x,y,dx,dy) -> (x,y) point; dw,dy: width,height. If dimensions is None, use x,y = 0,0 and dx,dy = img size
+    @param normalizer <ReinhardNormalizer>: normalizer instance (None: save tile as read)
     @param outdir <str>: path to output dir (save tiles here)
     @param verbose <int>: verbosity level
     """
@@ -215,7 +363,8 @@ def save_normalize_tile(img,dimensions,normalizer,outdir,verbose):
 
     #Normalize if whiteness proportion is below 25%:
     #if white_ratio(tile) < 0.05:
-    tile = normalizer.normalize(tile)
+    if not normalizer is None:
+        tile = normalizer.normalize(tile)
     
     #TODO: CHECK TILE SIZES AND PAD IF NECESSARY!
     
@@ -228,31 +377,128 @@ def save_normalize_tile(img,dimensions,normalizer,outdir,verbose):
     
     return dimensions
 
+def save_normalize_batch(imgs,normalizer,outdir,verbose):
+    """
+    Batched version of save_normalize_tile for whole images (keeps source directory structure).
+    Tiles with the same shape are normalized together.
+
+    @param imgs <list>: SegImage instances
+    @param normalizer <ReinhardNormalizer>: normalizer instance
+    @param outdir <str>: path to output dir (save tiles here)
+    @param verbose <int>: verbosity level
+    Returns a list of dimensions (None for background tiles), in imgs order
+    """
+    tiles = [img.readImage(keepImg=False,toFloat=False) for img in imgs]
+    result = [None] * len(imgs)
+    shapes = {}
+    for i in range(len(tiles)):
+        #Discard background tiles
+        if background(tiles[i]):
+            if verbose > 0:
+                print("Background: {}".format(imgs[i]))
+            continue
+        shapes.setdefault(tiles[i].shape,[]).append(i)
+
+    for shape in shapes:
+        pos = shapes[shape]
+        normalized = normalizer.normalize_batch(np.stack([tiles[i] for i in pos]))
+        for k,i in enumerate(pos):
+            subdir = os.path.join(outdir,os.path.split(os.path.dirname(imgs[i].getPath()))[1])
+            io.imsave(os.path.join(subdir,"{}.png".format(imgs[i].getImgName())),normalized[k],check_contrast=True)
+            result[i] = (0,0) + shape[:2]
+
+    return result
+
+def integral_image(data):
+    """
+    Summed-area tables of a (H,W,C) uint8 image: channel values and squared channel values.
+    Both are zero padded, shape (H+1,W+1,C), so that the sum of a window [y0:y1,x0:x1] is
+    t[y1,x1] - t[y0,x1] - t[y1,x0] + t[y0,x0]
+    """
+    h,w,c = data.shape
+    d = data.astype(np.int64)
+    sat = np.zeros((h+1,w+1,c),dtype=np.int64)
+    sq = np.zeros((h+1,w+1,c),dtype=np.int64)
+    np.cumsum(np.cumsum(d,axis=0),axis=1,out=sat[1:,1:])
+    np.cumsum(np.cumsum(d*d,axis=0),axis=1,out=sq[1:,1:])
+
+    return sat,sq
+
+def window_std(sat,sq,y0,x0,y1,x1):
+    """
+    Mean of channel standard deviations for windows [y0:y1,x0:x1] (arrays of window limits), O(1) per window.
+    Equivalent to background's whiteness measure.
+    """
+    def _sum(t):
+        return t[y1,x1] - t[y0,x1] - t[y1,x0] + t[y0,x0]
+
+    n = ((y1 - y0) * (x1 - x0)).astype(np.float64)[:,None]
+    mean = _sum(sat) / n
+    var = _sum(sq) / n - mean**2
+    return np.sqrt(np.maximum(var,0)).mean(axis=1)
+
+def tissue_mask(img,coords,tsize,threshold=8.0):
+    """
+    Screens tile regions of a whole slide image using a low resolution thumbnail. Returns a boolean array,
+    True where a region may contain tissue (should be read).
+
+    Thumbnail scale is chosen so that each tile covers about 8x8 thumbnail pixels. Downsampling smooths
+    texture, so threshold should be lower than the one used by background.
+
+    @param img <SVSImage>: slide
+    @param coords <list>: tile regions (x,y,dx,dy) at full resolution
+    @param tsize <tuple>: tile size (width,height)
+    @param threshold <float>: regions with thumbnail whiteness (see background) below this are background
+    """
+    scale = max(1,min(64,min(tsize) // 8))
+    thumb = img.readImage(scale=scale)
+    width,height = img.getImgDim()[:2]
+    th,tw = thumb.shape[:2]
+    sat,sq = integral_image(thumb[:,:,:3])
+
+    c = np.asarray(coords,dtype=np.float64)
+    x0 = np.clip(np.floor(c[:,0] * tw / width),0,tw-1).astype(np.int64)
+    y0 = np.clip(np.floor(c[:,1] * th / height),0,th-1).astype(np.int64)
+    x1 = np.clip(np.ceil((c[:,0] + c[:,2]) * tw / width),x0+1,tw).astype(np.int64)
+    y1 = np.clip(np.ceil((c[:,1] + c[:,3]) * th / height),y0+1,th).astype(np.int64)
+
+    return window_std(sat,sq,y0,x0,y1,x1) >= threshold
+
 #From https://github.com/SBU-BMI/quip_cnn_segmentation
 def white_ratio(pat):
     """
     Foreground/background ratio according to article:
     Spatial Organization And Molecular Correlation Of Tumor-Infiltrating Lymphocytes Using Deep Learning On Pathology Images
 
+    Sub-window statistics are computed from 100x100 block sums.
+
     @param pat <np.array>: tile as a numpy array.
     """
-    white_count = 0.0
-    total_count = 0.001
-
     if pat.shape[0] < 200 or pat.shape[1] < 200:
         whiteness = background(pat)
         if whiteness:
             return 1.0
         else:
             return 0.0
-        
-    for x in range(0, pat.shape[0]-200, 100):
-        for y in range(0, pat.shape[1]-200, 100):
-            p = pat[x:x+200, y:y+200, :]
-            whiteness = background(p)
-            if whiteness:
-                white_count += 1.0
-            total_count += 1.0
+
+    #Windows of 200x200 with stride 100 are made of 2x2 blocks of 100x100 pixels
+    nx = len(range(0, pat.shape[0]-200, 100))
+    ny = len(range(0, pat.shape[1]-200, 100))
+    if nx == 0 or ny == 0:
+        return 0.0
+
+    sub = pat[:(nx+1)*100,:(ny+1)*100,:3].astype(np.float64)
+    sub = sub.reshape(nx+1,100,ny+1,100,3).transpose(0,2,1,3,4).reshape(nx+1,ny+1,10000,3)
+    ones = np.ones(10000)
+    sums = np.matmul(ones,sub)
+    sq = np.matmul(ones,np.square(sub))
+    sums = sums[:-1,:-1] + sums[1:,:-1] + sums[:-1,1:] + sums[1:,1:]
+    sq = sq[:-1,:-1] + sq[1:,:-1] + sq[:-1,1:] + sq[1:,1:]
+    mean = sums / 40000.0
+    whiteness = np.sqrt(np.maximum(sq / 40000.0 - mean**2,0)).mean(axis=-1)
+
+    white_count = float(np.sum(whiteness < 18))
+    total_count = 0.001 + nx*ny
     return white_count/total_count
 
 def background(pat):
@@ -10,6 +10,93 @@ import skimage
 from skimage import color
 from .PImage import PImage
 
+### Color space constants (sRGB, D65 illuminant, same as skimage.color) ###
+_xyz_from_rgb = np.array([[0.412453, 0.357580, 0.180423],
+                          [0.212671, 0.715160, 0.072169],
+                          [0.019334, 0.119193, 0.950227]])
+_rgb_from_xyz = np.linalg.inv(_xyz_from_rgb)
+_d65 = np.array([0.95047, 1., 1.08883])
+
+#Scale of the white point folded into the conversion matrices
+_lab_from_rgb = (_xyz_from_rgb / _d65[:,None]).T.astype(np.float32)
+_rgb_from_yxz = (_rgb_from_xyz * _d65[None,:]).T[[1,0,2]].astype(np.float32)
+
+def _srgb_lut():
+    """
+    sRGB linearization of every uint8 value
+    """
+    v = np.arange(256,dtype=np.float64) / 255.0
+    return np.where(v > 0.04045, np.power((v + 0.055) / 1.055, 2.4), v / 12.92).astype(np.float32)
+
+_linear_lut = _srgb_lut()
+
+def rgb2lab_batch(batch,lut=True):
+    """
+    Float32 RGB to CIE LAB conversion of uint8 images (any leading shape, last axis are channels)
+
+    @param batch <ndarray>: uint8 images
+    @param lut <bool>: use lookup table for sRGB linearization
+    """
+    if lut:
+        lab = np.take(_linear_lut,batch)
+    else:
+        v = batch.astype(np.float32)
+        v /= 255.0
+        lab = v + 0.055
+        lab /= 1.055
+        np.power(lab,2.4,out=lab)
+        v /= 12.92
+        np.copyto(lab,v,where=v <= 0.04045 / 12.92)
+
+    shape = lab.shape
+    lab = np.dot(lab.reshape(-1,3),_lab_from_rgb).reshape(shape)
+
+    #XYZ to LAB
+    f = np.cbrt(lab)
+    lab *= 7.787
+    lab += 16. / 116.
+    np.copyto(lab,f,where=f > np.cbrt(0.008856))
+    fy = lab[...,1].copy()
+    lab[...,1] -= lab[...,2]
+    lab[...,2] = lab[...,1] * 200.
+    lab[...,1] = lab[...,0] - fy
+    lab[...,1] *= 500.
+    lab[...,0] = fy * 116. - 16.
+
+    return lab
+
+def lab2rgb_batch(lab):
+    """
+    Float32 CIE LAB to uint8 RGB conversion, done in place over lab (any leading shape, last axis are channels)
+    """
+    fy = lab[...,0]
+    fy += 16.
+    fy /= 116.
+    lab[...,1] /= 500.
+    lab[...,1] += fy
+    lab[...,2] /= -200.
+    lab[...,2] += fy
+    np.maximum(lab[...,2],0,out=lab[...,2])
+
+    #Channels are (y,x,z) from here
+    f = lab ** 3
+    lab -= 16. / 116.
+    lab /= 7.787
+    np.copyto(lab,f,where=f > 0.2068966 ** 3)
+    shape = lab.shape
+    rgb = np.dot(lab.reshape(-1,3),_rgb_from_yxz).reshape(shape)
+
+    lin = rgb * 12.92
+    np.maximum(rgb,0,out=rgb)
+    np.power(rgb,1 / 2.4,out=rgb)
+    rgb *= 1.055
+    rgb -= 0.055
+    np.copyto(rgb,lin,where=lin <= 0.0031308 * 12.92)
+    np.clip(rgb,0,1,out=rgb)
+    rgb *= 255.0
+
+    return np.rint(rgb).astype(np.uint8)
+
 ### Main class ###
 
 class Normalizer(object):
@@ -94,6 +181,60 @@ class Normalizer(object):
         norm3 = ((I3 - means[2]) * (self.target_stds[2] / (1e-10+stds[2]))) + self.target_means[2]
         return self._merge_back(norm1, norm2, norm3)
 
+    def _standardize_brightness_batch(self,batch):
+        """
+        Per tile 90th percentile brightness standardization, computed from uint8 histograms.
+        Same interpolation as np.percentile.
+        """
+        n = batch.shape[0]
+        flat = batch.reshape(n,-1)
+        size = flat.shape[1]
+        counts = np.bincount((flat + (np.arange(n) * 256)[:,None]).ravel(),minlength=n*256).reshape(n,256)
+        cdf = np.cumsum(counts,axis=1)
+        pos = 0.9 * (size - 1)
+        lo = int(np.floor(pos))
+        hi = min(lo + 1,size - 1)
+        v_lo = (cdf <= lo).sum(axis=1)
+        v_hi = (cdf <= hi).sum(axis=1)
+        p = v_lo + (pos - lo) * (v_hi - v_lo)
+
+        I = flat * (255.0 / p)[:,None]
+        np.clip(I,0,255,out=I)
+        return I.astype(np.uint8).reshape(batch.shape)
+
+    def transform_batch(self,batch,lut=True):
+        """
+        Normalizes a batch of tiles. Statistics are computed per tile, as in transform.
+
+        @param batch <ndarray>: uint8 array of shape (N,H,W,3)
+        @param lut <bool>: use lookup table for sRGB linearization
+        Returns normalized uint8 array of shape (N,H,W,3)
+        """
+        n = batch.shape[0]
+        I = self._standardize_brightness_batch(batch)
+        lab = rgb2lab_batch(I,lut)
+        lab[...,0] /= 2.55
+        lab[...,1:] -= 128.0
+
+        #Per tile means and stds as BLAS reductions over pixels
+        pixels = lab.reshape(n,-1,3)
+        ones = np.ones(pixels.shape[1],dtype=np.float32)
+        means = np.matmul(ones,pixels) / pixels.shape[1]
+        lab -= means[:,None,None,:]
+        stds = np.sqrt(np.matmul(ones,np.square(pixels)) / pixels.shape[1])
+
+        #Centered data is scaled and moved to target means, then back to RGB scale: L * 2.55, (a,b) + 128
+        scale = np.asarray(self.target_stds) / (1e-10 + stds)
+        shift = np.asarray(self.target_means)[None,:].repeat(n,axis=0)
+        scale[:,0] *= 2.55
+        shift[:,0] *= 2.55
+        shift[:,1:] += 128.0
+        lab *= scale[:,None,None,:].astype(np.float32)
+        lab += shift[:,None,None,:].astype(np.float32)
+        np.clip(lab,0,255,out=lab)
+
+        return lab2rgb_batch(lab)
+
 class ReinhardNormalizer(object):
     def __init__(self, target_file):
         """
@@ -110,3 +251,9 @@ class ReinhardNormalizer(object):
     def normalize(self, image):
         # image RGB in uint8
         return self.n_40X.transform(image)
+
+    def normalize_batch(self, images):
+        """
+        @param images <ndarray>: (N,H,W,3) uint8 array, or list of uint8 images with same shape
+        """
+        return self.n_40X.transform_batch(np.asarray(images))
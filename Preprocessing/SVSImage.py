@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 #-*- coding: utf-8
 
+import threading
+import numpy as np
 import openslide
 from .SegImage import SegImage
 
@@ -15,27 +17,47 @@ class SVSImage( SegImage ):
         """
         super().__init__(path,keepImg,verbose)
         self._oslide = None
+        self._lock = threading.Lock()
+
+    def __hash__(self):
+        return hash(self._path)
+
+    def __getstate__(self):
+        """
+        OpenSlide handles are not transferable, reopen after unpickling.
+        """
+        state = super().__getstate__()
+        state['_oslide'] = None
+        del state['_lock']
+
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
 
     def __checkOpen(self):
         
-        if self._oslide is None:
-            self._oslide = openslide.OpenSlide(self._path)
+        with self._lock:
+            if self._oslide is None:
+                self._oslide = openslide.OpenSlide(self._path)
 
     def __checkClose(self):
 
-        if not self._keep and not self._oslide is None:
-            self._oslide.close()
-            self._oslide = None
+        with self._lock:
+            if not self._keep and not self._oslide is None:
+                self._oslide.close()
+                self._oslide = None
             
-    def readImage(self):
+    def readImage(self,scale=64):
         """
-        Returns a low resolution version of the hole image. Currently, returned image has size
-        equal to the highest resolution adjusted by a scale factor of 64.
+        Returns a low resolution version of the hole image. Returned image has size
+        equal to the highest resolution adjusted by a scale factor (default: 64).
         """
 
         self.__checkOpen()
             
-        data = self._oslide.get_thumbnail((self._oslide.dimensions[0]//64,self._oslide.dimensions[1]//64)).convert('RGB')
+        data = self._oslide.get_thumbnail((self._oslide.dimensions[0]//scale,self._oslide.dimensions[1]//scale)).convert('RGB')
         #Convert data to numpy array
         data = np.array(data)
         
@@ -77,9 +99,10 @@ class SVSImage( SegImage ):
         """
         
         if not keep:
-            if not self._oslide is None:
-                self._oslide.close()
-            self._oslide = None
+            with self._lock:
+                if not self._oslide is None:
+                    self._oslide.close()
+                self._oslide = None
             self._data = None
 
         self._keep = keep
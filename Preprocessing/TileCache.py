@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import os
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+
+class TileCache(object):
+    """
+    Size aware LRU cache of decoded (and resized) tiles, shared by SegImage.readImage implementations.
+
+    Memory tier is bounded by a byte budget. Tiles evicted from memory may be spilled to a disk directory
+    (also bounded, LRU) and are promoted back to memory when requested again.
+    """
+    def __init__(self,budget,spill_dir=None,spill_budget=0,verbose=0):
+        """
+        @param budget <int>: memory budget in bytes
+        @param spill_dir <str>: spill evicted tiles to this directory (None: no disk tier)
+        @param spill_budget <int>: disk budget in bytes (0: unlimited)
+        @param verbose <int>: verbosity level
+        """
+        self.budget = budget
+        self.spill_dir = spill_dir
+        self.spill_budget = spill_budget
+        self._verbose = verbose
+
+        self._mem = OrderedDict()
+        self._mem_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if not spill_dir is None and not os.path.isdir(spill_dir):
+            os.makedirs(spill_dir)
+
+    def __len__(self):
+        return len(self._mem)
+
+    def _spill_path(self,key):
+        return os.path.join(self.spill_dir,"{}.npy".format(hashlib.sha1(repr(key).encode()).hexdigest()))
+
+    def get(self,key):
+        """
+        Returns cached tile or None
+        """
+        with self._lock:
+            if key in self._mem:
+                self._mem.move_to_end(key)
+                self.hits += 1
+                return self._mem[key]
+            in_disk = key in self._disk
+
+        if in_disk:
+            try:
+                data = np.load(self._spill_path(key))
+            except (IOError,ValueError):
+                data = None
+            if not data is None:
+                with self._lock:
+                    self.disk_hits += 1
+                self.put(key,data)
+                return data
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self,key,data):
+        """
+        Inserts tile in memory tier, evicting least recently used tiles if budget is exceeded.
+        """
+        nbytes = data.nbytes
+        if nbytes > self.budget:
+            return
+
+        evicted = []
+        with self._lock:
+            if key in self._mem:
+                self._mem.move_to_end(key)
+                return
+            self._mem[key] = data
+            self._mem_bytes += nbytes
+            while self._mem_bytes > self.budget:
+                k,v = self._mem.popitem(last=False)
+                self._mem_bytes -= v.nbytes
+                self.evictions += 1
+                evicted.append((k,v))
+
+        if not self.spill_dir is None:
+            for k,v in evicted:
+                self._spill(k,v)
+
+    def _spill(self,key,data):
+        """
+        Writes an evicted tile to the disk tier
+        """
+        with self._lock:
+            if key in self._disk:
+                self._disk.move_to_end(key)
+                return
+        try:
+            np.save(self._spill_path(key),data)
+        except IOError as e:
+            if self._verbose > 1:
+                print("[TileCache] Could not spill tile to disk: {}".format(e))
+            return
+
+        removed = []
+        with self._lock:
+            self._disk[key] = data.nbytes
+            self._disk_bytes += data.nbytes
+            while self.spill_budget > 0 and self._disk_bytes > self.spill_budget:
+                k,b = self._disk.popitem(last=False)
+                self._disk_bytes -= b
+                removed.append(k)
+
+        for k in removed:
+            try:
+                os.remove(self._spill_path(k))
+            except OSError:
+                pass
+
+    def clear(self):
+        """
+        Empties both tiers, removing spilled tiles from disk
+        """
+        with self._lock:
+            self._mem.clear()
+            self._mem_bytes = 0
+            spilled = list(self._disk.keys())
+            self._disk.clear()
+            self._disk_bytes = 0
+
+        for k in spilled:
+            try:
+                os.remove(self._spill_path(k))
+            except OSError:
+                pass
+
+    def stats(self):
+        """
+        Returns a dictionary of cache statistics
+        """
+        with self._lock:
+            total = self.hits + self.disk_hits + self.misses
+            return {'hits':self.hits,
+                    'disk_hits':self.disk_hits,
+                    'misses':self.misses,
+                    'hit_rate':(self.hits + self.disk_hits)/total if total > 0 else 0.0,
+                    'evictions':self.evictions,
+                    'tiles':len(self._mem),
+                    'bytes':self._mem_bytes,
+                    'disk_tiles':len(self._disk),
+                    'disk_bytes':self._disk_bytes}
+
+    def report(self):
+        s = self.stats()
+        return "[TileCache] {0} hits ({1} from disk), {2} misses, hit rate {3:.2%}; {4} tiles in memory ({5:.1f} MB), " \
+          "{6} on disk ({7:.1f} MB); {8} evictions".format(s['hits']+s['disk_hits'],s['disk_hits'],s['misses'],s['hit_rate'],
+                                                            s['tiles'],s['bytes']/2**20,s['disk_tiles'],s['disk_bytes']/2**20,
+                                                            s['evictions'])
+
+_instance = None
+
+def configure_tile_cache(config):
+    """
+    Creates the process wide tile cache from configuration (-tcache, -tcache_dir, -tcache_spill), if not yet created.
+    Returns the cache or None if caching is disabled.
+    """
+    global _instance
+    if _instance is None and not config is None and config.tile_cache > 0:
+        _instance = TileCache(config.tile_cache*2**20,config.tile_cache_dir,config.tile_cache_spill*2**20,config.verbose)
+        if config.info:
+            print("[TileCache] Caching decoded tiles (memory budget: {} MB; spill dir: {})".format(config.tile_cache,config.tile_cache_dir))
+
+    return _instance
+
+def tile_cache():
+    """
+    Returns the process wide tile cache, None if not configured
+    """
+    return _instance
+
+def tile_cache_params():
+    """
+    Parameters of the process wide tile cache (None if not configured), to be passed to worker processes
+    (see worker_tile_cache)
+    """
+    if _instance is None:
+        return None
+    return (_instance.budget,_instance.spill_dir,_instance.spill_budget,_instance._verbose)
+
+def worker_tile_cache(params):
+    """
+    Creates the tile cache of a worker process from its parent's parameters (see tile_cache_params). Each
+    worker has its own memory budget and spills to its own subdirectory of the spill directory.
+    """
+    global _instance
+    if _instance is None and not params is None:
+        budget,spill_dir,spill_budget,verbose = params
+        if not spill_dir is None:
+            spill_dir = os.path.join(spill_dir,'worker-{}'.format(os.getpid()))
+        _instance = TileCache(budget,spill_dir,spill_budget,verbose)
+    return _instance
+
+def release_worker_tile_cache():
+    """
+    Empties a worker's tile cache and removes its spill subdirectory (see worker_tile_cache)
+    """
+    if _instance is None:
+        return
+    _instance.clear()
+    if not _instance.spill_dir is None:
+        try:
+            os.rmdir(_instance.spill_dir)
+        except OSError:
+            pass
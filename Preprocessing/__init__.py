@@ -4,3 +4,4 @@
 #from .CVImage import CVImage
 from .PImage import PImage
 from .NPImage import NPImage
+from .MMImage import MMImage
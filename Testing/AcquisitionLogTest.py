@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from Utils.AcquisitionLog import AcquisitionLog
+
+def test_round_trip(rounds=6,query=20):
+    """
+    Records written by one log instance are read back by another, including optional scores and clusters
+    """
+    root = tempfile.mkdtemp()
+    path = os.path.join(root,'acquisitions.log')
+    try:
+        log = AcquisitionLog(path)
+        log.reset()
+        written = {}
+        for r in range(rounds):
+            idx = np.random.choice(1000,query,replace=False)
+            scores = np.random.random(query) if r % 2 == 0 else None
+            clusters = np.random.randint(0,5,query) if r % 3 == 0 else None
+            log.append(r,idx,scores,clusters)
+            written[r] = (idx,scores,clusters)
+
+        log = AcquisitionLog(path)
+        assert len(log) == rounds
+        assert log.rounds() == list(range(rounds))
+        for r in range(rounds):
+            idx,scores,clusters = written[r]
+            assert np.array_equal(log.acquired(r),idx)
+            if scores is None:
+                assert log.scores(r) is None
+            else:
+                assert np.allclose(log.scores(r),scores)
+            if clusters is None:
+                assert log.clusters(r) is None
+            else:
+                assert np.array_equal(log.clusters(r),clusters)
+
+        assert log.acquired(rounds).shape[0] == 0
+        assert np.array_equal(log.diff(1,3),np.concatenate((written[1][0],written[2][0])))
+        initial = np.arange(5)
+        assert np.array_equal(log.train_indexes(2,initial),np.concatenate((initial,written[0][0],written[1][0])))
+
+        #A truncated last record (interrupted run) is ignored
+        size = os.path.getsize(path)
+        log.append(rounds,np.arange(query))
+        with open(path,'r+b') as fd:
+            fd.truncate(size + (os.path.getsize(path) - size)//2)
+        log = AcquisitionLog(path)
+        assert log.rounds() == list(range(rounds))
+
+        #Reset discards everything
+        log.reset()
+        assert len(AcquisitionLog(path)) == 0
+        print("AcquisitionLog round trip: OK")
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    test_round_trip()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import os
+import time
+import pickle
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import concurrent.futures
+import numpy as np
+from skimage import io
+
+from Preprocessing.ArchiveStore import ArchiveStore,is_archive
+from Preprocessing.ArchImage import ArchImage
+
+def _make_tree(root,n=12):
+    """
+    Creates PNG tiles in two directories, plus a label file. Returns the source directory and the tiles
+    """
+    src = os.path.join(root,'src')
+    tiles = {}
+    for i in range(n):
+        member = os.path.join('dir{}'.format(i%2),'{}.png'.format(i))
+        path = os.path.join(src,member)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        tiles[member] = np.random.randint(0,256,(10,14,3)).astype(np.uint8)
+        io.imsave(path,tiles[member],check_contrast=False)
+    with open(os.path.join(src,'dir0','label.txt'),'w') as fd:
+        fd.write('0.png 1\n')
+    return src,tiles
+
+def _archive(src,dst,kind):
+    if kind == 'zip':
+        with zipfile.ZipFile(dst,'w',compression=zipfile.ZIP_DEFLATED) as zf:
+            for d,_,files in os.walk(src):
+                for f in files:
+                    zf.write(os.path.join(d,f),os.path.relpath(os.path.join(d,f),src))
+    else:
+        with tarfile.open(dst,'w') as tf:
+            for d in sorted(os.listdir(src)):
+                tf.add(os.path.join(src,d),arcname=d)
+    return dst
+
+def _check_store(store,src,tiles):
+    members = sorted(store.members())
+    expected = sorted([os.path.relpath(os.path.join(d,f),src) for d,_,files in os.walk(src) for f in files])
+    assert members == expected
+    assert sorted(store.members('dir0')) == sorted([m for m in expected if m.startswith('dir0/')])
+    for m in members:
+        with open(os.path.join(src,m),'rb') as fd:
+            assert store.read(m) == fd.read()
+    assert store.has('./dir0/label.txt')
+    assert not store.has('dir0/missing.png')
+    try:
+        store.read('dir0/missing.png')
+    except KeyError:
+        pass
+    else:
+        raise AssertionError("Missing member should raise KeyError")
+
+    #Concurrent reads use one handle per thread
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as ex:
+        data = list(ex.map(store.read,list(tiles.keys())*4))
+    assert data == [store.read(m) for m in list(tiles.keys())*4]
+
+def test_archives():
+    root = tempfile.mkdtemp()
+    try:
+        src,tiles = _make_tree(root)
+        for kind in ('tar','zip'):
+            path = _archive(src,os.path.join(root,'tiles.{}'.format(kind)),kind)
+            assert is_archive(path)
+            assert not is_archive(src)
+
+            store = ArchiveStore(path)
+            assert os.path.isfile(path + '.idx.npz')
+            _check_store(store,src,tiles)
+
+            #Index is reused while the archive is unchanged and is picklable
+            mtime = os.path.getmtime(store.index_path)
+            store = pickle.loads(pickle.dumps(ArchiveStore(path)))
+            assert os.path.getmtime(store.index_path) == mtime
+            _check_store(store,src,tiles)
+
+            #Images are decoded from members
+            for m in tiles:
+                img = ArchImage(os.path.join(path,m),path)
+                assert np.array_equal(img.readImage(toFloat=False),tiles[m])
+                assert img.getImgDim() == (14,10,3)
+
+            #Changed archive rebuilds the index
+            time.sleep(0.01)
+            os.remove(os.path.join(src,'dir1','1.png'))
+            _archive(src,path,kind)
+            store = ArchiveStore(path)
+            assert not store.has('dir1/1.png')
+            os.remove(path)
+            os.remove(path + '.idx.npz')
+            src,tiles = _make_tree(root)
+            print("ArchiveStore {}: OK".format(kind))
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    test_archives()
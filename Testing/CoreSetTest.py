@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import numpy as np
+
+from AL.CoreSet import kcenter_greedy
+
+def _brute_force(features,query,labeled=None,first=None):
+    """
+    Reference k-center greedy with full float64 distance matrices
+    """
+    x = features.astype(np.float64)
+    centers = [] if labeled is None else [c for c in labeled.astype(np.float64)]
+    selected,dist = [],[]
+    for i in range(query):
+        if len(centers) == 0:
+            c = first
+            d = 0.0
+        else:
+            cm = np.asarray(centers)
+            dm = np.sqrt(((x[:,None,:] - cm[None,:,:])**2).sum(axis=-1)).min(axis=1)
+            dm[selected] = -1.0
+            c = int(np.argmax(dm))
+            d = dm[c]
+        selected.append(c)
+        dist.append(d)
+        centers.append(x[c])
+    return np.array(selected),np.array(dist)
+
+def test_kcenter_greedy(n=600,dim=12,query=40,labeled_n=30):
+    """
+    Blocked selection matches brute force; each selected item's distance is its distance to the closest
+    previous center, and distances never increase
+    """
+    rng = np.random.RandomState(7)
+    features = rng.standard_normal((n,dim)).astype(np.float32)
+    labeled = rng.standard_normal((labeled_n,dim)).astype(np.float32)
+
+    sel,dist = kcenter_greedy(features,query,labeled,block=64,center_block=7)
+    ref_sel,ref_dist = _brute_force(features,query,labeled)
+    assert np.array_equal(sel,ref_sel)
+    assert np.allclose(dist,ref_dist,rtol=1e-4,atol=1e-4)
+    assert np.unique(sel).shape[0] == query
+    assert np.all(np.diff(dist) <= 1e-5)
+
+    centers = np.concatenate((labeled,features[sel]))
+    for i in range(query):
+        prev = centers[:labeled_n+i]
+        d = np.sqrt(((prev - features[sel[i]])**2).sum(axis=1)).min()
+        assert abs(d - dist[i]) < 1e-3
+
+    #Covering radius after selection is the next distance greedy would select
+    radius = np.sqrt(((features[:,None,:] - centers[None,:,:])**2).sum(axis=-1)).min(axis=1).max()
+    nsel,ndist = kcenter_greedy(features,query+1,labeled,block=64)
+    assert abs(radius - ndist[-1]) < 1e-3
+
+    #Without labeled items, the first center is a (seeded) random pool item
+    sel,dist = kcenter_greedy(features,query,None,block=100,seed=3)
+    ref_sel,ref_dist = _brute_force(features,query,None,first=np.random.RandomState(3).randint(n))
+    assert np.array_equal(sel,ref_sel)
+    assert np.isinf(dist[0])
+    assert np.allclose(dist[1:],ref_dist[1:],rtol=1e-4,atol=1e-4)
+
+    #Query larger than the pool selects everything
+    sel,_ = kcenter_greedy(features[:20],50,labeled)
+    assert np.array_equal(np.sort(sel),np.arange(20))
+    print("k-center greedy: OK")
+
+if __name__ == "__main__":
+    test_kcenter_greedy()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import os
+import shutil
+import tempfile
+import threading
+import numpy as np
+from skimage import io
+
+from keras.preprocessing.image import ImageDataGenerator
+from Preprocessing import PImage
+from Trainers.BatchGenerator import ThreadedGenerator,ProcessGenerator
+
+def _make_tiles(root,n,dim=(12,12,3)):
+    tiles = np.random.randint(0,256,(n,)+dim).astype(np.uint8)
+    X = []
+    for i in range(n):
+        path = os.path.join(root,'{}.png'.format(i))
+        io.imsave(path,tiles[i],check_contrast=False)
+        X.append(PImage(path))
+    return tiles,X
+
+def _epoch(gen):
+    """
+    All batches of an epoch, in Sequence order
+    """
+    xs,ys = [],[]
+    for i in range(len(gen)):
+        x,y = gen[i]
+        xs.append(x)
+        ys.append(y)
+    return np.concatenate(xs),np.concatenate(ys)
+
+def test_array_data(n=100,batch_size=16):
+    """
+    Array datasets are served in index order, including the last (partial) batch
+    """
+    data = np.random.random((n,8,8,1)).astype(np.float32)
+    labels = np.random.randint(0,3,n)
+    gen = ProcessGenerator((data,labels),3,batch_size=batch_size,shuffle=False,workers=2,prefetch=2)
+    try:
+        x,y = _epoch(gen)
+        assert x.shape == data.shape
+        assert np.allclose(x,data)
+        assert np.array_equal(y.argmax(axis=-1),labels)
+
+        #Sequential access wraps around epochs
+        for _ in range(len(gen) + 1):
+            x,y = gen.next()
+        assert np.allclose(x,data[:batch_size])
+
+        #Arbitrary index arrays
+        x,y = gen.returnDataInOrder(5)
+        assert np.allclose(x,data[5:5+batch_size])
+        print("ProcessGenerator array data: OK")
+    finally:
+        gen.close()
+
+def test_against_threaded(n=70,batch_size=8):
+    """
+    Batches read from files by worker processes match ThreadedGenerator ones, with float and uint8 pipelines
+    """
+    root = tempfile.mkdtemp()
+    try:
+        tiles,X = _make_tiles(root,n)
+        Y = np.random.randint(0,2,n)
+        idg = ImageDataGenerator()
+
+        tg = ThreadedGenerator((X,Y),2,dim=tiles.shape[1:3],batch_size=batch_size,image_generator=idg,shuffle=False)
+        ref_x,ref_y = _epoch(tg)
+        assert np.allclose(ref_x,tiles/255.0)
+
+        for uint8 in (False,True):
+            gen = ProcessGenerator((X,Y),2,dim=tiles.shape[1:3],batch_size=batch_size,image_generator=idg,shuffle=False,
+                                       uint8=uint8,workers=3,prefetch=3)
+            try:
+                x,y = _epoch(gen)
+                assert x.dtype == ref_x.dtype
+                assert np.allclose(x,ref_x,atol=1e-6)
+                assert np.array_equal(y,ref_y)
+            finally:
+                gen.close()
+        print("ProcessGenerator against ThreadedGenerator: OK")
+    finally:
+        shutil.rmtree(root)
+
+def test_failed_start(n=20):
+    """
+    A worker that can't be started (labels can't be pickled) raises the original error and leaves no
+    workers behind
+    """
+    data = np.random.random((n,8,8,1)).astype(np.float32)
+    labels = np.array([threading.Lock() for _ in range(n)],dtype=object)
+    gen = ProcessGenerator((data,labels),2,batch_size=4,shuffle=False,workers=2)
+    try:
+        gen[0]
+    except TypeError as e:
+        print("ProcessGenerator failed start raised: {}".format(repr(e)))
+    else:
+        raise AssertionError("Unpicklable data should not start workers")
+    assert gen._procs is None
+    gen.close()
+    print("ProcessGenerator failed start: OK")
+
+if __name__ == "__main__":
+    test_array_data()
+    test_against_threaded()
+    test_failed_start()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import os
+import shutil
+import tempfile
+from PIL import Image
+from skimage import io
+
+from Preprocessing.ImageHeader import file_dims
+from Preprocessing import PImage
+
+#Format -> PIL modes to test
+_formats = {'png':('L','LA','RGB','RGBA','P','I;16'),
+            'jpg':('L','RGB','CMYK'),
+            'tif':('L','RGB','RGBA')}
+
+def test_dims(sizes=((17,9),(256,100),(1,1))):
+    """
+    Header dimensions match the image size reported by PIL and the shape of decoded images
+    """
+    root = tempfile.mkdtemp()
+    try:
+        for fmt in _formats:
+            for mode in _formats[fmt]:
+                for w,h in sizes:
+                    path = os.path.join(root,'{}x{}_{}.{}'.format(w,h,mode.replace(';',''),fmt))
+                    Image.new(mode,(w,h)).save(path)
+                    dims = file_dims(path)
+                    with Image.open(path) as img:
+                        assert dims[:2] == img.size,"{}: {} != {}".format(path,dims,img.size)
+
+                    #Channels of the decoded image (as read by PImage), alpha removed
+                    data = io.imread(path)
+                    c = 1 if data.ndim == 2 else min(3,data.shape[2])
+                    assert (data.shape[1],data.shape[0],c) == dims,"{}: {} != {}".format(path,dims,data.shape)
+                    assert PImage(path).getImgDim() == dims
+            print("ImageHeader {}: OK".format(fmt))
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    test_dims()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from Datasources.MetadataIndex import MetadataIndex,label_array
+
+def _columns(d,n,label=0):
+    """
+    Columns of n fake items in directory d
+    """
+    return {'prefixes':np.array([d],dtype=str),
+            'prefix_id':np.zeros(n,dtype=np.int32),
+            'names':np.array(["{}.png".format(i).encode() for i in range(n)],dtype=bytes),
+            'labels':label_array(np.full(n,label)),
+            'origins':np.array([os.path.basename(d)],dtype=str),
+            'origin_id':np.zeros(n,dtype=np.int32),
+            'coords':np.full((n,2),-1,dtype=np.int32),
+            'dims':np.full((n,3),-1,dtype=np.int32)}
+
+def _make_dirs(root,names):
+    dirs = [os.path.join(root,n) for n in names]
+    for d in dirs:
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    return dirs
+
+def _touch(d):
+    #Changes the directory signature
+    st = os.stat(d)
+    os.utime(d,(st.st_atime,st.st_mtime + 10))
+
+def test_update():
+    """
+    Checks MetadataIndex.update with added, removed and unparsable directories
+    """
+    root = tempfile.mkdtemp()
+    index_file = os.path.join(root,'cache','metadata-index.npz')
+    try:
+        a,b,c = _make_dirs(root,['a','b','c'])
+
+        #First run: everything is parsed
+        index = MetadataIndex(root,index_file)
+        changed,sigs = index.changed([a,b])
+        assert changed == [a,b]
+        index.update([a,b],{a:_columns(a,3,0),b:_columns(b,2,1)},sigs)
+        index.save()
+        assert index.dirs == [a,b]
+        assert index.offsets.tolist() == [0,3,5]
+        assert index.columns()['labels'].tolist() == [0,0,0,1,1]
+
+        #Reload: nothing changed
+        index = MetadataIndex(root,index_file)
+        changed,sigs = index.changed([a,b])
+        assert changed == []
+        index.update([a,b],{},sigs)
+        assert index.columns()['labels'].tolist() == [0,0,0,1,1]
+
+        #Added directory (c), removed directory (a)
+        changed,sigs = index.changed([b,c])
+        assert changed == [c]
+        index.update([b,c],{c:_columns(c,4,2)},sigs)
+        assert index.dirs == [b,c]
+        assert index.offsets.tolist() == [0,2,6]
+        assert index.columns()['labels'].tolist() == [1,1,2,2,2,2]
+        assert index.columns()['origins'][index.columns()['origin_id']].tolist() == ['b']*2 + ['c']*4
+        index.save()
+
+        #New directory that could not be parsed (d) is left out of the index
+        d, = _make_dirs(root,['d'])
+        changed,sigs = index.changed([b,c,d])
+        assert changed == [d]
+        index.update([b,c,d],{},sigs)
+        assert index.dirs == [b,c]
+        assert index.signatures.shape[0] == 2
+        assert index.offsets.tolist() == [0,2,6]
+
+        #Modified directory that could not be parsed (c) keeps its previous entries and signature
+        _touch(c)
+        old_sig = index.signatures[1]
+        changed,sigs = index.changed([b,c])
+        assert changed == [c]
+        index.update([b,c],{},sigs)
+        assert index.dirs == [b,c]
+        assert index.columns()['labels'].tolist() == [1,1,2,2,2,2]
+        assert index.signatures[1] == old_sig
+        changed,sigs = index.changed([b,c])
+        assert changed == [c]
+
+        #Save/reload round trip
+        index.save()
+        index = MetadataIndex(root,index_file)
+        assert index.dirs == [b,c]
+        assert index.columns()['names'].tolist() == [b'0.png',b'1.png',b'0.png',b'1.png',b'2.png',b'3.png']
+        print("MetadataIndex update: OK")
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    test_update()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import os
+import shutil
+import tempfile
+import numpy as np
+from skimage import io
+
+from Preprocessing import PImage,MMImage
+from Preprocessing.PackedStore import PackedStore,open_store,build_store,write_store
+
+def _random_tiles(n,dim=(16,12,3)):
+    return np.random.randint(0,256,(n,)+dim).astype(np.uint8)
+
+def test_build_store(n=50,workers=3):
+    """
+    Packs PNG tiles read by PImage and checks they are read back unchanged, with labels and origins
+    """
+    root = tempfile.mkdtemp()
+    try:
+        tiles = _random_tiles(n)
+        X,Y = [],np.random.randint(0,2,n)
+        for i in range(n):
+            path = os.path.join(root,'tiles','{}.png'.format(i))
+            if i == 0:
+                os.makedirs(os.path.dirname(path))
+            io.imsave(path,tiles[i],check_contrast=False)
+            X.append(PImage(path,origin='slide{}'.format(i%3),coord=(str(i),str(2*i))))
+
+        dst = os.path.join(root,'store')
+        store = build_store(X,Y,dst,tiles.shape[1:],nclasses=2,workers=workers)
+        assert PackedStore.exists(dst)
+        assert open_store(dst) is store
+        assert len(store) == n
+        assert store.shape() == tiles.shape[1:]
+        assert np.array_equal(np.asarray(store.data),tiles)
+        assert np.array_equal(store.index['labels'],Y)
+        assert store.index['paths'].tolist() == [x.getPath() for x in X]
+        origins = store.index['origins'][store.index['origin']]
+        assert origins.tolist() == [x.getOrigin() for x in X]
+        assert store.index['coords'].tolist() == [list(x.getCoord()) for x in X]
+
+        #Batch reads return requested order
+        idx = np.random.permutation(n)[:20]
+        assert np.array_equal(store.read(idx),tiles[idx])
+        assert np.array_equal(store.view(7),tiles[7])
+
+        #Columns back a table of MMImages
+        cols = store.columns()
+        assert cols['names'].tolist() == [str(i).encode() for i in range(n)]
+        assert np.array_equal(cols['labels'],Y)
+        h,w,c = tiles.shape[1:]
+        assert np.all(cols['dims'] == [w,h,c])
+
+        items = [MMImage(dst,i) for i in idx]
+        assert np.array_equal(MMImage.readBatch(items,toFloat=False),tiles[idx])
+        assert np.allclose(MMImage.readBatch(items),tiles[idx]/255.0)
+        assert np.array_equal(items[0].readImage(toFloat=False),tiles[idx[0]])
+        assert items[0].getImgDim() == (w,h,c)
+        print("PackedStore build/read: OK")
+    finally:
+        shutil.rmtree(root)
+
+def test_write_store(n=300,block=64):
+    """
+    Packs an array shaped dataset in blocks and reads it back
+    """
+    root = tempfile.mkdtemp()
+    try:
+        tiles = _random_tiles(n,(8,8,1))
+        labels = np.random.randint(0,10,n)
+        store = write_store(root,tiles,labels,nclasses=10,block=block)
+        assert np.array_equal(store.read(np.arange(n)[::-1]),tiles[::-1])
+        assert np.array_equal(store.index['labels'],labels)
+        assert int(store.index['nclasses']) == 10
+
+        #Rewriting the store drops the previously opened instance
+        store2 = write_store(root,tiles[:10],labels[:10],nclasses=10,block=block)
+        assert not store2 is store
+        assert len(store2) == 10
+        print("PackedStore write/read: OK")
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    test_build_store()
+    test_write_store()
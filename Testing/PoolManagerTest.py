@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import numpy as np
+
+from Trainers.PoolManager import PoolManager
+
+def test_transitions(n=200):
+    """
+    Set membership through assignment and acquisitions, checked against explicit list bookkeeping
+    """
+    X = np.array(['item{}'.format(i) for i in range(n)],dtype=object)
+    Y = np.random.randint(0,2,n)
+    pm = PoolManager(X,Y)
+    assert pm.size(PoolManager.POOL) == n
+
+    #Initial split
+    perm = np.random.permutation(n)
+    pm.assign(perm[:20],PoolManager.TRAIN)
+    pm.assign(perm[20:40],PoolManager.VAL)
+    pm.assign(perm[40:60],PoolManager.TEST)
+    pool = sorted(perm[60:].tolist())
+    train = sorted(perm[:20].tolist())
+    assert pm.members(PoolManager.POOL).tolist() == pool
+    assert pm.members(PoolManager.TRAIN).tolist() == train
+    assert pm.size(PoolManager.VAL) == 20 and pm.size(PoolManager.TEST) == 20
+
+    x,y = pm.view(PoolManager.POOL)
+    assert x.tolist() == X[pool].tolist()
+    assert np.array_equal(y,Y[pool])
+
+    #Acquisitions: indexes are relative to the pool view
+    for _ in range(5):
+        x_pool,_ = pm.view(PoolManager.POOL)
+        idx = np.random.choice(len(x_pool),10,replace=False)
+        acquired = [x_pool[i] for i in idx]
+        master = pm.move(idx)
+        assert X[master].tolist() == acquired
+        pool = [p for p in pool if not p in set(master.tolist())]
+        train = sorted(train + master.tolist())
+        assert pm.members(PoolManager.POOL).tolist() == pool
+        assert pm.members(PoolManager.TRAIN).tolist() == train
+        assert pm.view(PoolManager.TRAIN)[0].tolist() == X[train].tolist()
+
+    #Every item belongs to exactly one set
+    sizes = [pm.size(s) for s in (PoolManager.POOL,PoolManager.TRAIN,PoolManager.VAL,PoolManager.TEST)]
+    assert sum(sizes) == n
+    assert sizes[1] == 70
+
+    #Snapshot keeps the assignment, not a reference to it
+    snap = pm.snapshot()
+    pm.assign(pm.members(PoolManager.POOL)[:5],PoolManager.TRAIN)
+    assert np.count_nonzero(snap['state'] == PoolManager.TRAIN) == 70
+    assert pm.size(PoolManager.TRAIN) == 75
+    print("PoolManager transitions: OK")
+
+def test_candidates(n=300,size=50):
+    """
+    Least recently scored pool items are selected first, split among groups by pool size
+    """
+    pm = PoolManager(np.arange(n),np.zeros(n))
+    pm.assign(np.arange(50),PoolManager.TRAIN)
+
+    seen = set()
+    for r in range(5):
+        c = pm.candidates(size)
+        assert c.shape[0] == size
+        assert np.all(pm.state[c] == PoolManager.POOL)
+        assert np.all(np.diff(c) > 0)
+        assert seen.isdisjoint(c.tolist())
+        seen.update(c.tolist())
+        pm.mark_scored(c,r)
+    assert len(seen) == 250
+
+    groups = np.repeat(np.arange(3),n//3)
+    c = pm.candidates(size,groups)
+    counts = np.bincount(groups[c],minlength=3)
+    pool_counts = np.bincount(groups[pm.members(PoolManager.POOL)],minlength=3)
+    assert c.shape[0] == size
+    assert np.all(np.abs(counts - size*pool_counts/pool_counts.sum()) <= 1)
+
+    assert pm.candidates(n).shape[0] == pm.size(PoolManager.POOL)
+    print("PoolManager candidates: OK")
+
+if __name__ == "__main__":
+    test_transitions()
+    test_candidates()
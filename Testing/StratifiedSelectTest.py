@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import numpy as np
+
+from AL.Common import stratified_select
+
+def _reference(ranked,groups,query,quotas=None,cap=0,cap_groups=None):
+    """
+    Item by item round-robin, followed by backfill in ranked order
+    """
+    members = {}
+    for i in ranked:
+        members.setdefault(groups[i],[]).append(i)
+    used,selected = {},[]
+    eligible = lambda i: cap <= 0 or used.get(cap_groups[i],0) < cap
+    def take(i):
+        selected.append(i)
+        if cap > 0:
+            used[cap_groups[i]] = used.get(cap_groups[i],0) + 1
+
+    taken = {k:0 for k in members}
+    limit = {k:(len(members[k]) if quotas is None else quotas[k]) for k in members}
+    progress = True
+    while progress and len(selected) < query:
+        progress = False
+        for k in sorted(members):
+            if taken[k] >= limit[k] or len(selected) >= query:
+                continue
+            cand = [i for i in members[k] if not i in selected and eligible(i)]
+            if len(cand) > 0:
+                take(cand[0])
+                taken[k] += 1
+                progress = True
+    for i in ranked:
+        if len(selected) >= query:
+            break
+        if not i in selected and eligible(i):
+            take(i)
+    return np.array(selected)
+
+def test_stratified_select(n=400,clusters=6,wsis=9,query=60,trials=20):
+    for t in range(trials):
+        rng = np.random.RandomState(t)
+        ranked = rng.permutation(n)
+        groups = rng.randint(0,clusters,n)
+        cap_groups = rng.randint(0,wsis,n)
+        cap = rng.randint(1,10)
+        quotas = rng.randint(0,20,clusters) if t % 2 == 0 else None
+
+        sel = stratified_select(ranked,groups,query,quotas=quotas,cap=cap,cap_groups=cap_groups)
+        ref = _reference(ranked,groups,query,quotas,cap,cap_groups)
+        assert np.array_equal(sel,ref),"Trial {}: {} != {}".format(t,sel,ref)
+        assert np.bincount(cap_groups[sel],minlength=wsis).max() <= cap
+        assert sel.shape[0] == min(query,cap*wsis)
+
+        sel = stratified_select(ranked,groups,query,quotas=quotas)
+        assert np.array_equal(sel,_reference(ranked,groups,query,quotas))
+        assert sel.shape[0] == query
+    print("Stratified selection: OK")
+
+if __name__ == "__main__":
+    test_stratified_select()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from Preprocessing.TileCache import TileCache
+
+def _tile(v,nbytes=1000):
+    return np.full(nbytes,v,dtype=np.uint8)
+
+def test_lru_eviction():
+    """
+    Memory tier keeps the most recently used tiles within budget
+    """
+    cache = TileCache(3000)
+    for k in range(3):
+        cache.put(k,_tile(k))
+    assert len(cache) == 3
+
+    #Touch 0, so 1 is the least recently used
+    assert cache.get(0)[0] == 0
+    cache.put(3,_tile(3))
+    assert len(cache) == 3
+    assert cache.get(1) is None
+    for k in (0,2,3):
+        assert cache.get(k)[0] == k
+
+    #Tiles larger than the budget are not cached
+    cache.put(4,_tile(4,4000))
+    assert cache.get(4) is None
+
+    s = cache.stats()
+    assert s['evictions'] == 1
+    assert s['bytes'] == 3000
+    assert s['hits'] == 4 and s['misses'] == 2
+    print("TileCache LRU eviction: OK")
+
+def test_spill():
+    """
+    Evicted tiles go to disk, are promoted back when requested and are removed by clear
+    """
+    spill_dir = tempfile.mkdtemp()
+    try:
+        cache = TileCache(2000,spill_dir,spill_budget=2000)
+        for k in range(4):
+            cache.put(k,_tile(k))
+
+        #0 and 1 were spilled
+        s = cache.stats()
+        assert s['tiles'] == 2 and s['disk_tiles'] == 2
+        assert len(os.listdir(spill_dir)) == 2
+
+        #Promoting 0 evicts 2 to disk, which pushes the (least recent) disk copy of 0 out of the disk budget
+        assert cache.get(0)[0] == 0
+        assert cache.stats()['disk_hits'] == 1
+        assert cache.stats()['disk_tiles'] == 2
+        assert cache.get(1)[0] == 1
+        assert cache.get(2)[0] == 2
+        s = cache.stats()
+        assert s['disk_hits'] == 3 and s['misses'] == 0
+        assert s['disk_bytes'] <= 2000
+        assert len(os.listdir(spill_dir)) == s['disk_tiles']
+
+        cache.clear()
+        s = cache.stats()
+        assert s['tiles'] == 0 and s['disk_tiles'] == 0 and s['disk_bytes'] == 0
+        assert len(os.listdir(spill_dir)) == 0
+        assert cache.get(3) is None
+        print("TileCache spill: OK")
+    finally:
+        shutil.rmtree(spill_dir)
+
+if __name__ == "__main__":
+    test_lru_eviction()
+    test_spill()
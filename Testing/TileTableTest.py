@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import os
+import pickle
+import shutil
+import tempfile
+import numpy as np
+from skimage import io
+
+from Preprocessing import PImage
+from Datasources.TileTable import TileTable,PImageFactory,take_items,delete_items,concat_items
+
+def _images(n,dirs=3):
+    X,Y = [],[]
+    for i in range(n):
+        d = os.path.join('/data','dir{}'.format(i%dirs))
+        if i % 2 == 0:
+            X.append(PImage(os.path.join(d,'{}.png'.format(i)),origin='slide{}'.format(i%dirs),coord=(str(i),str(i+1))))
+        else:
+            X.append(PImage(os.path.join(d,'{}.png'.format(i))))
+        Y.append(i%2)
+    return X,np.array(Y)
+
+def _same(table,X):
+    assert len(table) == len(X)
+    for i in range(len(X)):
+        t = table[i]
+        assert t.getPath() == X[i].getPath()
+        assert t.getOrigin() == X[i].getOrigin()
+        assert t.getCoord() == X[i].getCoord()
+        assert t == X[i]
+
+def test_table(n=40):
+    """
+    TileTable views and selections behave like the SegImage arrays they replace
+    """
+    X,Y = _images(n)
+    table = TileTable.from_images(X,Y)
+    _same(table,X)
+    assert np.array_equal(table.labels,Y)
+    assert table.labels.dtype == np.uint8
+    assert table.paths() == [x.getPath() for x in X]
+    assert table[-1] == X[-1]
+    assert np.all(table.dims == -1)
+
+    #Selections return tables
+    idx = np.random.permutation(n)[:15]
+    Xa = np.asarray(X)
+    _same(table[idx],Xa[idx])
+    _same(table[5:20:3],X[5:20:3])
+    mask = Y == 1
+    _same(table[mask],Xa[mask])
+    _same(take_items(table,idx),take_items(X,idx))
+    _same(delete_items(table,idx),delete_items(X,idx))
+    _same(concat_items(table[:10],table[30:]),concat_items(Xa[:10],Xa[30:]))
+    assert np.array_equal(concat_items(table[:10],table[30:]).labels,np.concatenate((Y[:10],Y[30:])))
+
+    try:
+        table[n]
+    except IndexError:
+        pass
+    else:
+        raise AssertionError("Out of range index should raise IndexError")
+
+    #Relocation applies to every directory
+    t = table.copy()
+    t.change_root(lambda s,d: os.path.join(d,os.path.basename(os.path.dirname(s)),os.path.basename(s)),'/new')
+    assert t.paths() == [os.path.join('/new',os.path.relpath(x.getPath(),'/data')) for x in X]
+    assert table.paths() == [x.getPath() for x in X]
+
+    #Tables are picklable (shipped to worker processes)
+    t = pickle.loads(pickle.dumps(table[idx]))
+    _same(t,Xa[idx])
+    print("TileTable: OK")
+
+def test_keep_images(n=10):
+    """
+    With keepImg, image data read through a view stays in memory: reading an item again (from the same
+    table or from a derived one) does not read the file
+    """
+    root = tempfile.mkdtemp()
+    try:
+        tiles = np.random.randint(0,256,(n,8,8,3)).astype(np.uint8)
+        X = []
+        for i in range(n):
+            path = os.path.join(root,'{}.png'.format(i))
+            io.imsave(path,tiles[i],check_contrast=False)
+            X.append(PImage(path))
+
+        table = TileTable.from_images(X,np.zeros(n),PImageFactory(keepImg=True))
+        for i in range(n):
+            assert np.array_equal(table[i].readImage(toFloat=False),tiles[i])
+        shutil.rmtree(root)
+        for i in range(n):
+            assert table[i] is table[i]
+            assert np.array_equal(table[i].readImage(toFloat=False),tiles[i])
+        assert np.array_equal(table[3:][0].readImage(toFloat=False),tiles[3])
+        assert np.array_equal(concat_items(table[:2],table[5:])[2].readImage(toFloat=False),tiles[5])
+
+        #Retained data is not pickled
+        t = pickle.loads(pickle.dumps(table))
+        assert len(t._kept) == 0
+
+        #Without keepImg views are not retained
+        table = TileTable.from_images(X,np.zeros(n))
+        assert not table[0] is table[0]
+        print("TileTable keepImg: OK")
+    finally:
+        if os.path.isdir(root):
+            shutil.rmtree(root)
+
+if __name__ == "__main__":
+    test_table()
+    test_keep_images()
@@ -41,6 +41,67 @@ def test_varratios(data_size,dp_steps,query,gen_random=True):
     print("Indexes: {0}".format(x_pool_index))
     print("Sorted a_1d: {0}".format(a_1d[x_pool_index]))
 
+def test_vectorized_varratios(data_size,dp_steps,classes):
+    """
+    Checks AL.Common.varratios against the per item mode loop
+    """
+    from AL.Common import vote_dtype,varratios
+
+    votes = np.random.randint(0,classes,(data_size,dp_steps)).astype(vote_dtype(classes))
+    Variation = np.zeros(shape=(data_size))
+    for t in range(data_size):
+        Predicted_Class, Mode = mode(votes[t])
+        Variation[t] = 1 - Mode/float(dp_steps)
+
+    vectorized = varratios(votes,classes)
+    print("Max difference between loop and vectorized variations: {0}".format(np.abs(Variation - vectorized).max()))
+    assert vectorized.shape == Variation.shape
+    assert np.allclose(vectorized,Variation,atol=1e-6)
+
+    #Small chunks give the same result
+    assert np.allclose(varratios(votes,classes,chunk=7),vectorized)
+
+def test_streaming_scorers(data_size,passes,classes,query,batch_size=64):
+    """
+    Checks AL.Scoring streaming scorers (batch by batch, all passes) against dense computations
+    """
+    from AL.Common import vote_dtype,varratios
+    from AL.Scoring import VarRatiosScorer,BALDScorer,top_k
+
+    probs = np.random.dirichlet(np.ones(classes),size=(passes,data_size)).astype(np.float32)
+    variation = varratios(probs.argmax(axis=-1).T.astype(vote_dtype(classes)),classes)
+    entropy = lambda p: -np.sum(p*np.log2(p),axis=-1)
+    bald = entropy(probs.mean(axis=0)) - entropy(probs).mean(axis=0)
+
+    vr = VarRatiosScorer(data_size,classes,passes,query)
+    bd = BALDScorer(data_size,classes,passes,query,keep_scores=False)
+    for start in range(0,data_size,batch_size):
+        for d in range(passes):
+            vr.update(d,start,probs[d,start:start+batch_size])
+            bd.update(d,start,probs[d,start:start+batch_size])
+
+    #Variation ratios have ties, compare selected scores
+    idx,scores = vr.result()
+    vr_match = np.allclose(np.sort(variation[idx]),np.sort(variation)[-query:])
+    print("Variation ratios top k matches argsort: {0}".format(vr_match))
+    assert vr_match
+    assert idx.shape[0] == min(query,data_size)
+    assert np.unique(idx).shape[0] == idx.shape[0]
+    assert np.allclose(variation[idx],scores,atol=1e-6)
+    assert np.all(np.diff(scores) <= 0)
+
+    idx,scores = bd.result()
+    bd_match = set(idx.tolist()) == set(np.argsort(bald)[-query:].tolist())
+    print("BALD top k matches argsort: {0}".format(bd_match))
+    print("Max BALD score difference: {0}".format(np.abs(bald[idx] - scores).max()))
+    assert bd_match
+    assert np.allclose(bald[idx],scores,atol=1e-5)
+    assert np.all(np.diff(scores) <= 0)
+
+    #top_k alone
+    x = np.random.random(data_size)
+    assert np.array_equal(top_k(x,query),np.argsort(x)[::-1][:query])
+
 def test_databalance(img_rows=28,img_cols=28):
     from keras.datasets import mnist
     
@@ -125,4 +186,6 @@ def test_databalance(img_rows=28,img_cols=28):
     
 if __name__ == "__main__":
     test_varratios(200,5,10,gen_random=False)
+    test_vectorized_varratios(2000,100,10)
+    test_streaming_scorers(5000,10,3,50)
     test_databalance()
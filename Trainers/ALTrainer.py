@@ -15,9 +15,12 @@ from keras.preprocessing.image import ImageDataGenerator
 #Local
 from .GenericTrainer import Trainer
 from .Predictions import Predictor
+from .PoolManager import PoolManager
 
 #Module
-from Utils import Exitcodes,CacheManager
+from Datasources.TileTable import take_items
+from Utils import Exitcodes,CacheManager,AcquisitionLog
+from Preprocessing.TileCache import tile_cache
 
 def run_training(config,locations=None):
     """
@@ -47,52 +50,72 @@ class ActiveLearningTrainer(Trainer):
         """
         super().__init__(config)
 
-        self.pool_x = None
-        self.pool_y = None
-        self.train_x = None
-        self.train_y = None
-        self.val_x = None
-        self.val_y = None
-        self.test_x = None
-        self.test_y = None
+        #Set membership (see PoolManager), defined in configure_sets
+        self._pool = None
+        self._log = None
+        #Candidate subset scoring (-candidates): current size and log of scored items
+        self._cand_size = None
+        self._clog = None
+
+    #Training, validation, test and pool sets are views of the master table
+    @property
+    def train_x(self):
+        return self._pool.view(PoolManager.TRAIN)[0]
+
+    @property
+    def train_y(self):
+        return self._pool.view(PoolManager.TRAIN)[1]
+
+    @property
+    def val_x(self):
+        return self._pool.view(PoolManager.VAL)[0]
+
+    @property
+    def val_y(self):
+        return self._pool.view(PoolManager.VAL)[1]
+
+    @property
+    def test_x(self):
+        return self._pool.view(PoolManager.TEST)[0]
+
+    @property
+    def test_y(self):
+        return self._pool.view(PoolManager.TEST)[1]
+
+    @property
+    def pool_x(self):
+        return self._pool.view(PoolManager.POOL)[0]
+
+    @property
+    def pool_y(self):
+        return self._pool.view(PoolManager.POOL)[1]
 
 
     def _balance_classes(self,X,Y):
         """
         Returns a tuple (X,Y) of balanced classes
 
-        X and Y are lists
+        X may be a list or a TileTable, Y a list or array of labels
         """
-        #Work with NP arrays
-        if isinstance(X,list):
-            X = np.asarray(X)
-        if isinstance(Y,list):
-            Y = np.asarray(Y)
+        Y = np.asarray(Y)
             
         #Count the occurrences of each class
         unique,count = np.unique(Y,return_counts=True)
-
-        #Extracts the positions of each class in the dataset
-        class_members = {i:np.where(Y == i)[0] for i in unique}
-
-        #Remount the lists
-        nX,nY = ([],[])
         mcount = count.min()
+
+        #Selects mcount positions of each class
+        sel = []
         for c in unique:
-            if count[c] > mcount:
-                ids = np.random.choice(count[c],mcount,replace=False)
-                nX.extend(X[class_members[c][ids]])
-                nY.extend(Y[class_members[c][ids]])
-            else:
-                nX.extend(X[class_members[c]])
-                nY.extend(Y[class_members[c]])
+            members = np.where(Y == c)[0]
+            if members.shape[0] > mcount:
+                members = np.random.choice(members,mcount,replace=False)
+            sel.append(members)
 
         #Reshufle all elements
-        combined = list(zip(nX,nY))
-        random.shuffle(combined)
-        nX[:],nY[:] = zip(*combined)
+        sel = np.concatenate(sel)
+        np.random.shuffle(sel)
 
-        return nX,nY
+        return take_items(X,sel),Y[sel]
         
     def configure_sets(self):
         """
@@ -116,11 +139,8 @@ class ActiveLearningTrainer(Trainer):
             
         #Test set is extracted from the last items and is not changed for the whole run
         t_idx = int(self._config.split[-1:][0] * len(X))
-        self.test_x = X[- t_idx:]
-        self.test_y = Y[- t_idx:]
-
-        self.pool_x = X[:-t_idx]
-        self.pool_y = Y[:-t_idx]
+        self._pool = PoolManager(X,Y)
+        self._pool.assign(np.arange(len(X) - t_idx,len(X)),PoolManager.TEST)
 
         #Initial training set will be choosen at random from pool
         cache_m = CacheManager()
@@ -133,28 +153,105 @@ class ActiveLearningTrainer(Trainer):
             if not self._config.load_train and self._config.balance and self._config.info:
                 print("[ALTrainer] Dataset balancing and initial train set loading not possible at the same time.")
                 
-            train_idx = np.random.choice(len(self.pool_x),self._config.init_train,replace=False)
+            train_idx = np.random.choice(self._pool.size(PoolManager.POOL),self._config.init_train,replace=False)
             cache_m.dump(train_idx,'initial_train.pik')
-            
-        pool_ar_x = np.asarray(self.pool_x)
-        pool_ar_y = np.asarray(self.pool_y)
-        self.train_x = pool_ar_x[train_idx]
-        self.train_y = pool_ar_y[train_idx]
-
-        #Remove choosen elements from the pool
-        self.pool_x = np.delete(pool_ar_x,train_idx)
-        self.pool_y = np.delete(pool_ar_y,train_idx)
-        del(pool_ar_x)
-        del(pool_ar_y)
+
+        #Move choosen elements from the pool
+        self._pool.move(train_idx,PoolManager.TRAIN)
         
         #Initial validation set - keeps the same split ratio for train/val as defined in the configuration
         val_samples = int((self._config.init_train*self._config.split[1])/self._config.split[0])
         val_samples = max(val_samples,100)
-        val_idx = np.random.choice(self.pool_x.shape[0],val_samples,replace=False)
-        self.val_x = self.pool_x[val_idx]
-        self.val_y = self.pool_y[val_idx]
-        self.pool_x = np.delete(self.pool_x,val_idx)
-        self.pool_y = np.delete(self.pool_y,val_idx)
+        val_idx = np.random.choice(self._pool.size(PoolManager.POOL),val_samples,replace=False)
+        self._pool.move(val_idx,PoolManager.VAL)
+
+    def save_sets(self,net):
+        """
+        Saves the master table and initial set membership (al-pool-<net>.pik) and starts the acquisition
+        log (al-log-<net>.npl), where each acquisition only adds the indexes of acquired items. With -candidates,
+        scored items are logged in al-candidates-<net>.npl.
+        """
+        cache_m = CacheManager()
+        fid = 'al-pool-{}.pik'.format(net)
+        cache_m.registerFile(os.path.join(self._config.logdir,fid),fid)
+        cache_m.dump(self._pool.snapshot(),fid)
+
+        fid = 'al-log-{}.npl'.format(net)
+        cache_m.registerFile(os.path.join(self._config.logdir,fid),fid)
+        self._log = AcquisitionLog(cache_m.fileLocation(fid),self._config.verbose)
+        self._log.reset()
+
+        if self._config.candidates > 0:
+            fid = 'al-candidates-{}.npl'.format(net)
+            cache_m.registerFile(os.path.join(self._config.logdir,fid),fid)
+            self._clog = AcquisitionLog(cache_m.fileLocation(fid),self._config.verbose)
+            self._clog.reset()
+
+    def add_acquired(self,pooled_idx,record,r,scored=None):
+        """
+        Moves acquired items to the training set and records the acquisition.
+
+        @param pooled_idx <ndarray>: acquired indexes, relative to the scored items
+        @param record <dict>: scored items aligned 'scores' and 'clusters' made available by the acquisition function
+        @param r <int>: acquisition number
+        @param scored <ndarray>: master indexes of scored items (None: the whole pool)
+        """
+        if scored is None:
+            master = self._pool.move(pooled_idx,PoolManager.TRAIN)
+        else:
+            master = scored[np.asarray(pooled_idx,dtype=np.intp)]
+            self._pool.assign(master,PoolManager.TRAIN)
+        scores,clusters = [None if record.get(k) is None else np.asarray(record[k])[pooled_idx] for k in ('scores','clusters')]
+        if scores is None and not record.get('acquired_scores') is None:
+            scores = np.asarray(record['acquired_scores'])
+        self._log.append(r,master,scores,clusters)
+
+    def scoring_set(self):
+        """
+        Pool items to be scored by the acquisition function: the whole pool or, with -candidates, a subset of
+        candidates (randomly or WSI stratified, see -cand_strat).
+
+        Returns (master indexes,X,Y)
+        """
+        if self._config.candidates <= 0:
+            return (self._pool.members(PoolManager.POOL),self.pool_x,self.pool_y)
+
+        if self._cand_size is None:
+            self._cand_size = self._config.candidates * self._config.acquire
+        groups = self._pool.origins() if self._config.cand_strat == 'wsi' else None
+        idx = self._pool.candidates(self._cand_size,groups)
+        if self._config.info:
+            print("[ALTrainer] Scoring {} candidates (pool size: {})".format(idx.shape[0],self._pool.size(PoolManager.POOL)))
+        return (idx,take_items(self._pool.X,idx),self._pool.Y[idx])
+
+    def update_candidates(self,scored,record,r):
+        """
+        Records scored candidates and their scores (al-candidates-<net>.npl) and adapts candidate set size.
+        If the top of the score distribution is flat (the acquire-th best score is close to the maximum), 
+        candidates do not discriminate the best items: the set doubles (up to 8x -candidates). Otherwise it 
+        shrinks back towards its base size.
+        """
+        if self._config.candidates <= 0:
+            return
+        
+        self._pool.mark_scored(scored,r)
+        scores = record.get('scores')
+        self._clog.append(r,scored,scores)
+        if scores is None or scored.shape[0] == 0:
+            return
+
+        base = self._config.candidates * self._config.acquire
+        scores = np.asarray(scores)
+        k = min(self._config.acquire,scores.shape[0])
+        kth = np.partition(scores,-k)[-k]
+        srange = scores.max() - scores.min()
+        spread = (scores.max() - kth)/srange if srange > 0 else 0.0
+        if spread < 0.05:
+            self._cand_size = min(2*self._cand_size,8*base)
+        else:
+            self._cand_size = max(base,self._cand_size//2)
+        if self._config.verbose > 0:
+            print("[ALTrainer] Top scores spread: {:.3f}; next candidate set size: {}".format(spread,self._cand_size))
 
     def run(self):
         """
@@ -169,6 +266,7 @@ class ActiveLearningTrainer(Trainer):
         self._rex = self._rex.format(model.name)
         #Define initial sets
         self.configure_sets()
+        self.save_sets(model.name)
         #AL components
         cache_m = CacheManager()
         predictor = Predictor(self._config,keepImg=True)
@@ -190,10 +288,6 @@ class ActiveLearningTrainer(Trainer):
                 print("[ALTrainer] Starting acquisition step {0}/{1}".format(r+1,self._config.acquisition_steps))
                 stime = time.time()
 
-            #Save current dataset and report partial result (requires multi load for reading)
-            fid = 'al-metadata-{1}-r{0}.pik'.format(r,model.name)
-            cache_m.registerFile(os.path.join(self._config.logdir,fid),fid)
-            cache_m.dump(((self.train_x,self.train_y),(self.val_x,self.val_y),(self.test_x,self.test_y)),fid)
                 
             sw_thread = self.train_model(model,(self.train_x,self.train_y),(self.val_x,self.val_y))            
             
@@ -218,6 +312,8 @@ class ActiveLearningTrainer(Trainer):
                 etime = time.time()
                 td = timedelta(seconds=(etime-stime))
                 print("Acquisition step took: {0}".format(td))
+                if not tile_cache() is None:
+                    print(tile_cache().report())
                 
             if end_train:
                 return None
@@ -229,10 +325,10 @@ class ActiveLearningTrainer(Trainer):
 
         Returns True if acquisition was sucessful
         """
-        from Trainers import ThreadedGenerator
+        from Trainers import ThreadedGenerator,ProcessGenerator
         #An acquisition function should return a NP array with the indexes of all items from the pool that 
         #should be inserted into training and validation sets
-        if self.pool_x.shape[0] < self._config.acquire:
+        if self._pool.size(PoolManager.POOL) < self._config.acquire:
             return False
 
         if kwargs is None:
@@ -253,17 +349,29 @@ class ActiveLearningTrainer(Trainer):
             samplewise_center=self._config.batch_norm,
             samplewise_std_normalization=self._config.batch_norm)
 
+        #Items to be scored (whole pool or candidates)
+        scored,scored_x,scored_y = self.scoring_set()
+
         #Acquisition functions that require a generator to load data
         generator_params = {
-            'dps':(self.pool_x,self.pool_y),
+            'dps':(scored_x,scored_y),
             'classes':self._ds.nclasses,
             'dim':fix_dim,
             'batch_size':self._config.gpu_count * self._config.batch_size if self._config.gpu_count > 0 else self._config.batch_size,
             'image_generator':pool_prep,
             'shuffle':False, #DO NOT SET TRUE!
-            'verbose':self._config.verbose}
+            'verbose':self._config.verbose,
+            'normalizer':self.stain_normalizer(),
+            'uint8':self._config.uint8}
+
+        if self._config.process_gen:
+            generator = ProcessGenerator(workers=self._config.cpu_count,prefetch=self._config.prefetch,**generator_params)
+        else:
+            generator = ThreadedGenerator(**generator_params)
 
-        generator = ThreadedGenerator(**generator_params)
+        #Labeled set, only for functions that compare pool and training items
+        if self._config.ac_function == 'core_set':
+            kwargs['train_generator'] = ThreadedGenerator(**dict(generator_params,dps=(self.train_x,self.train_y)))
 
         if self._config.gpu_count > 1:
             pred_model = model.parallel
@@ -271,19 +379,25 @@ class ActiveLearningTrainer(Trainer):
             pred_model = model.single
 
         if self._config.verbose > 0:
-            print("\nStarting acquisition...(pool size: {})".format(self.pool_x.shape[0]))
+            print("\nStarting acquisition...(pool size: {})".format(self._pool.size(PoolManager.POOL)))
 
         if self._config.verbose > 1:
             print("Starting acquisition using model: {0}".format(hex(id(pred_model))))
         
-        pooled_idx = function(pred_model,generator,self.pool_x.shape[0],**kwargs)
+        #Master indexes of scored items (tile ids), in generator order
+        kwargs['pool_index'] = scored
+        #Acquisition functions may store scored items aligned scores and cluster ids here (acquisition log)
+        kwargs['record'] = {}
+        #Scores of all scored items are only needed by the candidates log
+        kwargs['all_scores'] = self._config.candidates > 0
+        pooled_idx = function(pred_model,generator,scored.shape[0],**kwargs)
+        if hasattr(generator,'close'):
+            generator.close()
         if pooled_idx is None:
             if self._config.info:
                 print("[ALTrainer] No indexes returned. Something is wrong.")
             sys.exit(1)
-        self.train_x = np.concatenate((self.train_x,self.pool_x[pooled_idx]),axis=0)
-        self.train_y = np.concatenate((self.train_y,self.pool_y[pooled_idx]),axis=0)
-        self.pool_x = np.delete(self.pool_x,pooled_idx)
-        self.pool_y = np.delete(self.pool_y,pooled_idx)
+        self.add_acquired(pooled_idx,kwargs['record'],kwargs.get('acquisition'),scored)
+        self.update_candidates(scored,kwargs['record'],kwargs.get('acquisition'))
 
         return True
@@ -13,10 +13,36 @@ from keras import backend as K
 
 #System modules
 import concurrent.futures
+import multiprocessing as mp
+import threading
 import numpy as np
 import imgaug as ia
 from imgaug import augmenters as iaa
 
+from Preprocessing.TileCache import tile_cache_params,worker_tile_cache,release_worker_tile_cache
+
+def stain_normalize(normalizer,examples):
+    """
+    Stain normalization of examples with the same shape. Float ([0,1]) examples give a float32 array,
+    uint8 examples an uint8 array.
+    """
+    batch = np.asarray(examples)
+    if batch.dtype == np.uint8:
+        return normalizer.normalize_batch(batch)
+    batch = batch * 255.0
+    np.clip(batch,0,255,out=batch)
+    batch = normalizer.normalize_batch(np.rint(batch).astype(np.uint8)).astype(np.float32)
+    batch /= 255.0
+    return batch
+
+def to_float(batch):
+    """
+    Converts an uint8 batch to K.floatx(), normalized to [0,1]
+    """
+    batch = batch.astype(K.floatx())
+    batch /= 255.0
+    return batch
+
 class GenericIterator(Iterator):
     """
         RHDIterator is actually a generator, yielding the data tuples from a data source as a correlation list.
@@ -33,6 +59,9 @@ class GenericIterator(Iterator):
         data_mean: float, dataset mean for zero centering
         verbose: verbosity level.
         input_n: number of input sources (for multiple submodels in ensemble)
+        normalizer: ReinhardNormalizer instance, applies stain normalization to examples read from disk
+        uint8: examples are read, augmented and batched as uint8; batches are converted to float ([0,1])
+            only when assembled, right before standardization
     """
 
     def __init__(self,
@@ -46,7 +75,9 @@ class GenericIterator(Iterator):
                      seed=173,
                      data_mean=0.0,
                      verbose=0,
-                     input_n=1):
+                     input_n=1,
+                     normalizer=None,
+                     uint8=False):
 
         self.data = data
         self.classes = classes
@@ -56,6 +87,9 @@ class GenericIterator(Iterator):
         self.verbose = verbose
         self.extra_aug = extra_aug
         self.input_n = input_n
+        self.normalizer = normalizer
+        self.uint8 = uint8
+        self._batch_dtype = np.uint8 if uint8 else K.floatx()
 
         #Keep information of example shape as soon as the information is available
         self.shape = None
@@ -118,9 +152,10 @@ class GenericIterator(Iterator):
 
     def returnDataAsArray(self):
         """
-        Return all data as a tuple of ndarrays: (X,Y)
+        Return all data as a tuple of ndarrays: (X,Y). TileTables are returned as is.
         """
-
+        if hasattr(self.data[0],'columns'):
+            return (self.data[0],np.asarray(self.data[1]))
         return (np.asarray(self.data[0]),np.asarray(self.data[1]))
 
 class SingleGenerator(GenericIterator):
@@ -139,7 +174,9 @@ class SingleGenerator(GenericIterator):
                      data_mean=0.0,
                      verbose=0,
                      variable_shape=False,
-                     input_n=1):
+                     input_n=1,
+                     normalizer=None,
+                     uint8=False):
         
         #Set True if examples in the same dataset can have variable shapes
         self.variable_shape = variable_shape
@@ -154,7 +191,9 @@ class SingleGenerator(GenericIterator):
                                                 seed=seed,
                                                 data_mean=data_mean,
                                                 verbose=verbose,
-                                                input_n=input_n)
+                                                input_n=input_n,
+                                                normalizer=normalizer,
+                                                uint8=uint8)
 
 
     def _get_batches_of_transformed_samples(self,index_array):
@@ -173,7 +212,7 @@ class SingleGenerator(GenericIterator):
         # calculate dimensions of each data point
         #Should only create the batches of appropriate size
         if not self.shape is None:
-            batch_x = np.zeros(tuple([len(index_array)] + list(self.shape)), dtype=K.floatx())
+            batch_x = np.zeros(tuple([len(index_array)] + list(self.shape)), dtype=self._batch_dtype)
         else:
             batch_x = None
         y = np.zeros(tuple([len(index_array)]),dtype=int)
@@ -187,13 +226,15 @@ class SingleGenerator(GenericIterator):
 
             #If not an ndarray, readimage
             if not isinstance(t_x,np.ndarray):
-                example = t_x.readImage(size=self.dim,verbose=self.verbose)
+                example = t_x.readImage(size=self.dim,verbose=self.verbose,toFloat=not self.uint8)
+                if not self.normalizer is None:
+                    example = stain_normalize(self.normalizer,[example])[0]
             else:
                 example = t_x
             
             if batch_x is None:
                 self.shape = example.shape
-                batch_x = np.zeros(tuple([len(index_array)] + list(self.shape)),dtype=K.floatx())
+                batch_x = np.zeros(tuple([len(index_array)] + list(self.shape)),dtype=self._batch_dtype)
             
             #TEST PURPOSES ONLY - This is slow given the sizes
             #involved
@@ -204,6 +245,8 @@ class SingleGenerator(GenericIterator):
             # add point to x_batch and diagnoses to y
             batch_x[i] = example
             y[i] = t_y
+        if self.uint8:
+            batch_x = to_float(batch_x)
         batch_x = self.image_generator.standardize(batch_x)
         #Center data
         #batch_x -= self.mean
@@ -235,7 +278,9 @@ class ThreadedGenerator(GenericIterator):
                      data_mean=0.0,
                      verbose=0,
                      variable_shape=False,
-                     input_n=1):
+                     input_n=1,
+                     normalizer=None,
+                     uint8=False):
         
         #Set True if examples in the same dataset can have variable shapes
         self.variable_shape = variable_shape
@@ -252,7 +297,9 @@ class ThreadedGenerator(GenericIterator):
                                                 seed=seed,
                                                 data_mean=data_mean,
                                                 verbose=verbose,
-                                                input_n=input_n)
+                                                input_n=input_n,
+                                                normalizer=normalizer,
+                                                uint8=uint8)
 
 
     def _get_batches_of_transformed_samples(self,index_array):
@@ -282,7 +329,7 @@ class ThreadedGenerator(GenericIterator):
         # calculate dimensions of each data point
         #Should only create the batches of appropriate size
         if not self.shape is None:
-            batch_x = np.zeros(tuple([len(index_array)] + list(self.shape)), dtype=K.floatx())
+            batch_x = np.zeros(tuple([len(index_array)] + list(self.shape)), dtype=self._batch_dtype)
         else:
             batch_x = None
         y = np.zeros(tuple([len(index_array)]),dtype=int)
@@ -292,21 +339,40 @@ class ThreadedGenerator(GenericIterator):
         Y = self.data[1]
         futures = []
 
+        #Items are fetched once: TileTables create a new view on each access
+        items = [X[j] for j in index_array]
+
+        #Batch readable sources (packed stores) are read with a single fancy indexing operation
+        examples = None
+        if hasattr(items[0],'readBatch'):
+            examples = items[0].readBatch(items,size=self.dim,verbose=self.verbose,toFloat=not self.uint8)
+        elif not self.normalizer is None:
+            examples = list(self._executor.map(lambda t_x: t_x.readImage(size=self.dim,verbose=self.verbose,toFloat=not self.uint8),items))
+
+        #Stain normalization is done for the whole batch at once
+        if not examples is None and not self.normalizer is None:
+            examples = stain_normalize(self.normalizer,examples)
+
         for i,j in enumerate(index_array):
-            t_x = X[j]
+            t_x = items[i]
             t_y = Y[j]
-            futures.append(self._executor.submit(self._thread_run_images,t_x,t_y))
+            if examples is None:
+                futures.append(self._executor.submit(self._thread_run_images,t_x,t_y))
+            else:
+                futures.append(self._executor.submit(self._thread_run_transform,examples[i],t_y))
             
         for i in range(len(futures)):
             # add point to x_batch and diagnoses to y
             example,t_y = futures[i].result()
             if batch_x is None:
                 self.shape = example.shape
-                batch_x = np.zeros(tuple([len(index_array)] + list(self.shape)),dtype=K.floatx())            
+                batch_x = np.zeros(tuple([len(index_array)] + list(self.shape)),dtype=self._batch_dtype)            
             batch_x[i] = example
             y[i] = t_y
 
         #Always normalize
+        if self.uint8:
+            batch_x = to_float(batch_x)
         batch_x = self.image_generator.standardize(batch_x)
         #Apply extra augmentation
         if self.extra_aug:
@@ -328,10 +394,332 @@ class ThreadedGenerator(GenericIterator):
         return output
 
     def _thread_run_images(self,t_x,t_y):
-        example = t_x.readImage(size=self.dim,verbose=self.verbose)
-            
+        example = t_x.readImage(size=self.dim,verbose=self.verbose,toFloat=not self.uint8)
+
+        return self._thread_run_transform(example,t_y)
+
+    def _thread_run_transform(self,example,t_y):
         if not self.image_generator is None:
             example = self.image_generator.random_transform(example,self.seed)
             #example = self.image_generator.standardize(example)
 
         return (example,t_y)
+
+def _process_worker(X,Y,dim,seed,image_generator,extra_aug,normalizer,uint8,x_slots,y_slots,shape,tasks,results,cache_params,verbose):
+    """
+    ProcessGenerator worker: reads, augments and standardizes batches directly into shared memory slots.
+    uint8 batches are only read and augmented, standardization is left to the consumer. Workers have their
+    own tile cache, configured as the parent's (see Preprocessing.TileCache).
+    Should not be called directly.
+    """
+    worker_tile_cache(cache_params)
+    x_views = [np.frombuffer(b,dtype=np.uint8 if uint8 else np.float32).reshape((-1,) + shape) for b in x_slots]
+    y_views = [np.frombuffer(b,dtype=np.int32) for b in y_slots]
+    aug = None
+    if extra_aug and not uint8:
+        aug = iaa.Sometimes(0.5,iaa.ContrastNormalization((0.75,1.5)))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        key,slot,index_array = task
+        n = len(index_array)
+        try:
+            items = [X[j] for j in index_array]
+            examples = None
+            if hasattr(items[0],'readBatch'):
+                examples = items[0].readBatch(items,size=dim,verbose=verbose,toFloat=not uint8)
+            elif not normalizer is None:
+                examples = [t_x if isinstance(t_x,np.ndarray) else t_x.readImage(size=dim,verbose=verbose,toFloat=not uint8) for t_x in items]
+            if not examples is None and not normalizer is None:
+                examples = stain_normalize(normalizer,examples)
+
+            for i,j in enumerate(index_array):
+                if not examples is None:
+                    example = examples[i]
+                elif isinstance(items[i],np.ndarray):
+                    example = items[i]
+                else:
+                    example = items[i].readImage(size=dim,verbose=verbose,toFloat=not uint8)
+                if not image_generator is None:
+                    example = image_generator.random_transform(example,seed)
+                x_views[slot][i] = example
+                y_views[slot][i] = Y[j]
+
+            if not image_generator is None and not uint8:
+                x_views[slot][:n] = image_generator.standardize(x_views[slot][:n])
+            if not aug is None:
+                x_views[slot][:n] = aug(images=x_views[slot][:n])
+            results.put((key,slot,n,None))
+        except Exception as e:
+            results.put((key,slot,0,repr(e)))
+
+    release_worker_tile_cache()
+
+class ProcessGenerator(GenericIterator):
+    """
+    Generates batches of images in worker processes, applies augmentation, resizing, centering...the whole shebang.
+
+    Workers write batches into a ring of shared memory slots (one batch each). Up to prefetch batches ahead of
+    the last requested one are produced in background. Batches are always returned in index order, so results
+    are deterministic when shuffle is False. Examples must have the same shape.
+    """
+    def __init__(self, 
+                     dps,
+                     classes,
+                     dim=None,
+                     batch_size=8,
+                     image_generator=None,
+                     extra_aug=False,
+                     shuffle=True,
+                     seed=173,
+                     data_mean=0.0,
+                     verbose=0,
+                     variable_shape=False,
+                     input_n=1,
+                     normalizer=None,
+                     uint8=False,
+                     workers=4,
+                     prefetch=4):
+
+        if variable_shape:
+            raise ValueError("[ProcessGenerator] Variable shape examples are not supported")
+
+        self.variable_shape = False
+        self.workers = max(1,workers)
+        self.prefetch = max(1,prefetch)
+        self._procs = None
+        self._collector = None
+        self._aug = None
+        self._cond = threading.Condition()
+        self._epoch = 0
+        self._direct = 0
+        self._next_batch = 0
+        self._free = []
+        self._inflight = {}
+        self._ready = {}
+        self._waiting = set()
+        
+        super(ProcessGenerator, self).__init__(data=dps,
+                                                classes=classes,
+                                                dim=dim,
+                                                batch_size=batch_size,
+                                                image_generator=image_generator,
+                                                extra_aug=extra_aug,
+                                                shuffle=shuffle,
+                                                seed=seed,
+                                                data_mean=data_mean,
+                                                verbose=verbose,
+                                                input_n=input_n,
+                                                normalizer=normalizer,
+                                                uint8=uint8)
+
+    def _start(self):
+        """
+        Allocates shared memory slots and starts worker processes (once).
+        """
+        with self._cond:
+            if not self._procs is None:
+                return
+
+            X,Y = self.data
+            if isinstance(X,np.ndarray) and X.dtype != object:
+                self.shape = X.shape[1:]
+            else:
+                self.shape = X[0].readImage(size=self.dim,verbose=self.verbose).shape
+            
+            ctx = mp.get_context('spawn')
+            slots = self.prefetch + 1
+            x_size = self.batch_size * int(np.prod(self.shape))
+            self._x_slots = [ctx.RawArray('B' if self.uint8 else 'f',x_size) for _ in range(slots)]
+            self._y_slots = [ctx.RawArray('i',self.batch_size) for _ in range(slots)]
+            self._x_views = [np.frombuffer(b,dtype=np.uint8 if self.uint8 else np.float32).reshape((-1,) + self.shape) for b in self._x_slots]
+            self._y_views = [np.frombuffer(b,dtype=np.int32) for b in self._y_slots]
+            self._free = list(range(slots))
+            self._tasks = ctx.Queue()
+            self._results = ctx.Queue()
+
+            #Workers that did start are stopped if something fails (e.g. data can't be pickled)
+            self._procs = []
+            try:
+                for _ in range(self.workers):
+                    p = ctx.Process(target=_process_worker,args=(X,Y,self.dim,self.seed,self.image_generator,self.extra_aug,self.normalizer,
+                                                                     self.uint8,self._x_slots,self._y_slots,self.shape,
+                                                                     self._tasks,self._results,tile_cache_params(),self.verbose))
+                    p.daemon = True
+                    p.start()
+                    self._procs.append(p)
+
+                self._collector = threading.Thread(target=self._collect,name='pgen_collector',daemon=True)
+                self._collector.start()
+            except Exception:
+                self.close()
+                raise
+
+            if self.verbose > 0:
+                print("[ProcessGenerator] Started {} workers ({} slots of {} examples)".format(self.workers,slots,self.batch_size))
+
+    def _collect(self):
+        """
+        Receives finished batches from workers. Batches from a previous epoch that nobody waits for are discarded.
+        """
+        while True:
+            r = self._results.get()
+            if r is None:
+                break
+            key,slot,n,err = r
+            with self._cond:
+                self._inflight.pop(key,None)
+                if key in self._waiting or key[0] == self._epoch:
+                    self._ready[key] = (slot,n,err)
+                else:
+                    self._free.append(slot)
+                self._cond.notify_all()
+
+    def _schedule(self,key,index_array,evict=True):
+        """
+        Sends a batch to workers if a slot is available. Should be called with condition held.
+        Prefetched batches nobody waits for are evicted if needed.
+        Returns True if batch was scheduled.
+        """
+        if not self._free and evict:
+            for k in list(self._ready.keys()):
+                if not k in self._waiting:
+                    self._free.append(self._ready.pop(k)[0])
+                    break
+        if not self._free:
+            return False
+        slot = self._free.pop()
+        self._inflight[key] = slot
+        self._tasks.put((key,slot,np.asarray(index_array)))
+        return True
+
+    def _batch_indexes(self,idx):
+        return self.index_array[self.batch_size * idx:self.batch_size * (idx + 1)]
+
+    def _wait(self,key,index_array):
+        """
+        Waits for batch identified by key and copies it out of its slot.
+        """
+        with self._cond:
+            self._waiting.add(key)
+            while not key in self._ready:
+                if not key in self._inflight:
+                    self._schedule(key,index_array)
+                self._cond.wait()
+            slot,n,err = self._ready.pop(key)
+            self._waiting.discard(key)
+
+        if err is None:
+            if self.uint8:
+                batch_x = self._standardize(to_float(self._x_views[slot][:n]))
+            else:
+                batch_x = np.array(self._x_views[slot][:n],dtype=K.floatx())
+            y = self._y_views[slot][:n].copy()
+
+        with self._cond:
+            self._free.append(slot)
+            self._cond.notify_all()
+
+        if not err is None:
+            raise RuntimeError("[ProcessGenerator] Worker failed to produce batch: {}".format(err))
+
+        return self._output(batch_x,y)
+
+    def _standardize(self,batch_x):
+        """
+        Standardization and extra augmentation of uint8 batches, done after conversion (workers only read and
+        transform them)
+        """
+        if not self.image_generator is None:
+            batch_x = self.image_generator.standardize(batch_x)
+        if self.extra_aug:
+            if self._aug is None:
+                self._aug = iaa.Sometimes(0.5,iaa.ContrastNormalization((0.75,1.5)))
+            batch_x = self._aug(images=batch_x)
+        return batch_x
+
+    def _output(self,batch_x,y):
+        if self.input_n > 1:
+            batch_x = [batch_x for _ in range(self.input_n)]
+
+        return (batch_x, keras.utils.to_categorical(y, self.classes))
+
+    def __getitem__(self,idx):
+        if idx >= len(self):
+            raise ValueError('Asked to retrieve element {idx}, but the Sequence has length {length}'.format(idx=idx,length=len(self)))
+        self._start()
+
+        with self.lock:
+            if self.index_array is None:
+                self._set_index_array()
+
+        with self._cond:
+            key = (self._epoch,idx)
+            index_array = self._batch_indexes(idx)
+            if not key in self._inflight and not key in self._ready:
+                self._schedule(key,index_array)
+            #Prefetch following batches of the same epoch, only into free slots
+            for k in range(idx+1,min(idx+1+self.prefetch,len(self))):
+                pk = (self._epoch,k)
+                if pk in self._inflight or pk in self._ready:
+                    continue
+                if not self._schedule(pk,self._batch_indexes(k),evict=False):
+                    break
+
+        return self._wait(key,index_array)
+
+    def on_epoch_end(self):
+        with self._cond:
+            self._epoch += 1
+            for k in list(self._ready.keys()):
+                if not k in self._waiting:
+                    self._free.append(self._ready.pop(k)[0])
+        super(ProcessGenerator, self).on_epoch_end()
+
+    def next(self):
+        """
+        Sequential access, benefits from prefetching.
+        """
+        with self.lock:
+            idx = self._next_batch
+            self._next_batch = (idx + 1) % len(self)
+        batch = self.__getitem__(idx)
+        if idx == len(self) - 1:
+            self.on_epoch_end()
+        return batch
+
+    def _get_batches_of_transformed_samples(self,index_array):
+        """
+        Arbitrary index arrays are produced by workers without prefetching
+        """
+        self._start()
+        with self._cond:
+            self._direct += 1
+            key = ('direct',self._direct)
+        return self._wait(key,index_array)
+
+    def close(self):
+        """
+        Stops worker processes. Generator can not be used afterwards.
+        """
+        if self._procs is None:
+            return
+        for _ in self._procs:
+            self._tasks.put(None)
+        for p in self._procs:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+        if not self._collector is None:
+            self._results.put(None)
+            self._collector.join(timeout=5)
+            self._collector = None
+        self._procs = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
@@ -5,6 +5,9 @@ import os,sys
 import numpy as np
 import importlib
 import random
+import copy
+import multiprocessing as mp
+import multiprocessing.connection
 from multiprocessing import Pool, Queue
 
 #Filter warnings
@@ -25,10 +28,48 @@ if tf.__version__ >= '1.14.0':
 #Local
 from .ALTrainer import ActiveLearningTrainer
 from .Predictions import Predictor
+from .PoolManager import PoolManager
 
 #Module
 from Utils import Exitcodes,CacheManager
 
+def _member_devices(config,procs):
+    """
+    Splits GPUs (or CPU cores if no GPUs are available) among procs member training processes.
+    Returns a list of (gpu ids,cpu count), one per process.
+    """
+    cpus = max(1,config.cpu_count // procs)
+    if config.gpu_count > 0:
+        gpus = np.array_split(np.arange(config.gpu_count),min(procs,config.gpu_count))
+        return [(g.tolist(),cpus) for g in gpus]
+    else:
+        return [([],cpus) for _ in range(procs)]
+
+def _train_member(config,locations,m,train_data,val_data,gpus,cpus):
+    """
+    Trains ensemble member m in a spawned process. Weights are saved as numpy files, from where
+    acquisition functions load them.
+    """
+    os.environ['CUDA_VISIBLE_DEVICES'] = ",".join([str(g) for g in gpus])
+    cache_m = CacheManager(locations=locations)
+
+    m_config = copy.copy(config)
+    m_config.gpu_count = len(gpus)
+    m_config.cpu_count = cpus
+    m_config.info = config.info and config.verbose > 0
+    
+    trainer = EnsembleALTrainer(m_config)
+    model = trainer.load_modules()
+    #Metadata comes from cache, needed for dataset dimensions
+    trainer._ds.load_metadata()
+    trainer._rex = trainer._rex.format(model.name)
+    trainer._initializer(len(gpus),cpus)
+    model.register_ensemble(m)
+    sw_thread = trainer.train_model(model,train_data,val_data,set_session=False,stats=False,summary=False,
+                                        clear_sess=True,save_numpy=True,allocated_gpus=len(gpus))
+    sw_thread.join()
+    sys.exit(Exitcodes.ALL_GOOD)
+    
 def run_training(config,locations=None):
     """
     Main training function, to work as a new process
@@ -59,7 +100,12 @@ class EnsembleALTrainer(ActiveLearningTrainer):
         self.tower = None
 
     def _initializer(self,gpus,processes):
+        """
+        Creates the session of the current process.
 
+        @param gpus <int>: number of (visible) GPUs to use
+        @param processes <int>: number of CPU cores
+        """
         #initialize tensorflow session
         gpu_options = None
         if gpus > 0:
@@ -68,10 +114,11 @@ class EnsembleALTrainer(ActiveLearningTrainer):
             gpu_options.Experimental.use_unified_memory = False
             gpu_options.visible_device_list = ",".join([str(g) for g in range(gpus)])
 
+        threads = min(3,processes) if gpus > 0 else processes
         sess = tf.Session(config=tf.ConfigProto(
             device_count={"CPU":processes,"GPU":gpus},
-            intra_op_parallelism_threads=3, 
-            inter_op_parallelism_threads=3,
+            intra_op_parallelism_threads=threads, 
+            inter_op_parallelism_threads=threads,
             log_device_placement=False,
             gpu_options=gpu_options
             ))
@@ -100,6 +147,56 @@ class EnsembleALTrainer(ActiveLearningTrainer):
         print("Train set: {0} items".format(len(train_data[0])))
         print("Validate set: {0} items".format(len(val_data[0])))
         
+    def _train_parallel(self,model):
+        """
+        Trains all ensemble members concurrently, in spawned processes (see -eprocs). Each process gets its
+        own devices (_member_devices); members are scheduled on the first free process slot.
+        Returns after all members have saved their weights.
+        """
+        ctx = mp.get_context('spawn')
+        cache_m = CacheManager()
+        slots = _member_devices(self._config,self._config.ensemble_procs)
+        free = list(range(len(slots)))
+        running = {}
+        pending = list(range(self._config.emodels))
+        train_data = (self.train_x,self.train_y)
+        val_data = (self.val_x,self.val_y)
+
+        if self._config.info:
+            print("[EnsembleTrainer] Training {} members in {} concurrent processes ({})".format(
+                self._config.emodels,len(slots),", ".join(["GPUs {}".format(g) if len(g) > 0 else "{} CPUs".format(c) for g,c in slots])))
+
+        failed = []
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(free) > 0:
+                m = pending.pop(0)
+                slot = free.pop(0)
+                gpus,cpus = slots[slot]
+                proc = ctx.Process(target=_train_member,args=(self._config,cache_m.getLocations(),m,train_data,val_data,gpus,cpus))
+                proc.start()
+                running[m] = (proc,slot)
+
+            #Wait for any member to finish
+            mp.connection.wait([p.sentinel for p,_ in running.values()])
+            for m in [m for m,(p,_) in running.items() if not p.is_alive()]:
+                proc,slot = running.pop(m)
+                proc.join()
+                free.append(slot)
+                if proc.exitcode != Exitcodes.ALL_GOOD:
+                    failed.append(m)
+                elif self._config.info:
+                    print("[EnsembleTrainer] Member {} done".format(m))
+
+        #Members' weights are collected from the numpy files
+        for m in range(self._config.emodels):
+            model.register_ensemble(m)
+            if hasattr(model,'get_npweights_cache') and not os.path.isfile(model.get_npweights_cache(add_ext=True)):
+                failed.append(m)
+
+        if len(failed) > 0:
+            print("[EnsembleTrainer] Ensemble members failed to train: {}".format(sorted(set(failed))))
+            sys.exit(Exitcodes.RUNTIME_ERROR)
+
     def run(self):
         """
         Coordenates the AL process
@@ -113,6 +210,7 @@ class EnsembleALTrainer(ActiveLearningTrainer):
         self._rex = self._rex.format(model.name)
         #Define initial sets
         self.configure_sets()
+        self.save_sets(model.name)
         #AL components
         cache_m = CacheManager()
         predictor = Predictor(self._config,keepImg=True,build_ensemble=True)
@@ -135,45 +233,44 @@ class EnsembleALTrainer(ActiveLearningTrainer):
                 print("[EnsembleTrainer] Starting acquisition step {0}/{1}".format(r+1,self._config.acquisition_steps))
                 stime = time.time()
 
-            #Save current dataset and report partial result (requires multi load for reading)
-            fid = 'al-metadata-{1}-r{0}.pik'.format(r,model.name)
-            cache_m.registerFile(os.path.join(self._config.logdir,fid),fid)
-            cache_m.dump(((self.train_x,self.train_y),(self.val_x,self.val_y),(self.test_x,self.test_y)),fid)
 
             self._print_stats((self.train_x,self.train_y),(self.val_x,self.val_y))
             sw_thread = None
-            for m in range(self._config.emodels):
-                #Some models may take too long to save weights
-                if not sw_thread is None:
-                    if self._config.info:
-                        print("[EnsembleTrainer] Waiting for model weights.", end='')
-                    while True:
-                        pst = '.'
-                        if sw_thread[-1].is_alive():
-                            if self._config.info:
-                                pst = "{}{}".format(pst,'.')
-                                print(pst,end='')
-                            sw_thread[-1].join(60.0)
-                        else:
-                            print('')
-                            break
+            if self._config.ensemble_procs > 0:
+                self._train_parallel(model)
+            else:
+                for m in range(self._config.emodels):
+                    #Some models may take too long to save weights
+                    if not sw_thread is None:
+                        if self._config.info:
+                            print("[EnsembleTrainer] Waiting for model weights.", end='')
+                        while True:
+                            pst = '.'
+                            if sw_thread[-1].is_alive():
+                                if self._config.info:
+                                    pst = "{}{}".format(pst,'.')
+                                    print(pst,end='')
+                                sw_thread[-1].join(60.0)
+                            else:
+                                print('')
+                                break
                     
-                if hasattr(model,'register_ensemble'):
-                    model.register_ensemble(m)
-                else:
-                    print("Model not ready for ensembling. Implement register_ensemble method")
-                    raise AttributeError
+                    if hasattr(model,'register_ensemble'):
+                        model.register_ensemble(m)
+                    else:
+                        print("Model not ready for ensembling. Implement register_ensemble method")
+                        raise AttributeError
 
-                if self._config.info:
-                    print("[EnsembleTrainer] Starting model {} training".format(m))
+                    if self._config.info:
+                        print("[EnsembleTrainer] Starting model {} training".format(m))
                     
-                st = self.train_model(model,(self.train_x,self.train_y),(self.val_x,self.val_y),
-                                                set_session=False,stats=False,summary=False,
-                                                clear_sess=True,save_numpy=True)
-                if sw_thread is None:
-                    sw_thread = [st]
-                else:
-                    sw_thread.append(st)
+                    st = self.train_model(model,(self.train_x,self.train_y),(self.val_x,self.val_y),
+                                                    set_session=False,stats=False,summary=False,
+                                                    clear_sess=True,save_numpy=True)
+                    if sw_thread is None:
+                        sw_thread = [st]
+                    else:
+                        sw_thread.append(st)
             
             if r == (self._config.acquisition_steps - 1) or not self.acquire(function,model,acquisition=r,sw_thread=sw_thread):
                 if self._config.info:
@@ -201,10 +298,10 @@ class EnsembleALTrainer(ActiveLearningTrainer):
 
         Returns True if acquisition was sucessful
         """
-        from Trainers import ThreadedGenerator
+        from Trainers import ThreadedGenerator,ProcessGenerator
         #An acquisition function should return a NP array with the indexes of all items from the pool that 
         #should be inserted into training and validation sets
-        if self.pool_x.shape[0] < self._config.acquire:
+        if self._pool.size(PoolManager.POOL) < self._config.acquire:
             return False
 
         if kwargs is None:
@@ -225,33 +322,47 @@ class EnsembleALTrainer(ActiveLearningTrainer):
             samplewise_center=self._config.batch_norm,
             samplewise_std_normalization=self._config.batch_norm)
 
+        #Items to be scored (whole pool or candidates)
+        scored,scored_x,scored_y = self.scoring_set()
+
         #Acquisition functions that require a generator to load data
         generator_params = {
-            'dps':(self.pool_x,self.pool_y),
+            'dps':(scored_x,scored_y),
             'classes':self._ds.nclasses,
             'dim':fix_dim,
             'batch_size':self._config.gpu_count * self._config.batch_size if self._config.gpu_count > 0 else self._config.batch_size,
             'image_generator':pool_prep,
             'shuffle':False, #DO NOT SET TRUE!
             'verbose':self._config.verbose,
-            'input_n':1}
+            'input_n':1,
+            'normalizer':self.stain_normalizer(),
+            'uint8':self._config.uint8}
 
-        generator = ThreadedGenerator(**generator_params)
+        if self._config.process_gen:
+            generator = ProcessGenerator(workers=self._config.cpu_count,prefetch=self._config.prefetch,**generator_params)
+        else:
+            generator = ThreadedGenerator(**generator_params)
 
         if self._config.verbose > 0:
-            print("\nStarting acquisition...(pool size: {})".format(self.pool_x.shape[0]))
+            print("\nStarting acquisition...(pool size: {})".format(self._pool.size(PoolManager.POOL)))
 
         if self._config.verbose > 1:
             print("Starting acquisition using model: {0}".format(hex(id(pred_model))))
         
-        pooled_idx = function(None,generator,self.pool_x.shape[0],**kwargs)
+        #Master indexes of scored items (tile ids), in generator order
+        kwargs['pool_index'] = scored
+        #Acquisition functions may store scored items aligned scores and cluster ids here (acquisition log)
+        kwargs['record'] = {}
+        #Scores of all scored items are only needed by the candidates log
+        kwargs['all_scores'] = self._config.candidates > 0
+        pooled_idx = function(None,generator,scored.shape[0],**kwargs)
+        if hasattr(generator,'close'):
+            generator.close()
         if pooled_idx is None:
             if self._config.info:
                 print("[EnsembleTrainer] No indexes returned. Something is wrong.")
             sys.exit(1)
-        self.train_x = np.concatenate((self.train_x,self.pool_x[pooled_idx]),axis=0)
-        self.train_y = np.concatenate((self.train_y,self.pool_y[pooled_idx]),axis=0)
-        self.pool_x = np.delete(self.pool_x,pooled_idx)
-        self.pool_y = np.delete(self.pool_y,pooled_idx)
+        self.add_acquired(pooled_idx,kwargs['record'],kwargs.get('acquisition'),scored)
+        self.update_candidates(scored,kwargs['record'],kwargs.get('acquisition'))
 
         return True        
@@ -14,6 +14,7 @@ warnings.filterwarnings('ignore')
 from Datasources.CellRep import CellRep
 from Utils import SaveLRCallback,CalculateF1Score,EnsembleModelCallback
 from Utils import Exitcodes,CacheManager
+from Preprocessing.TileCache import configure_tile_cache
 
 #Keras
 from keras import backend as K
@@ -77,6 +78,20 @@ class Trainer(object):
         self._ds = None
         self._rex = r'{0}-t(?P<try>[0-9]+)e(?P<epoch>[0-9]+).h5'
 
+        #Decoded tiles are shared among epochs and acquisitions
+        configure_tile_cache(config)
+        self._normalizer = None
+
+    def stain_normalizer(self):
+        """
+        Returns a ReinhardNormalizer if on the fly stain normalization was requested (-onorm), else None
+        """
+        if self._normalizer is None and not self._config.online_norm is None:
+            from Preprocessing.ReinhardNormalizer import ReinhardNormalizer
+            self._normalizer = ReinhardNormalizer(self._config.online_norm)
+
+        return self._normalizer
+
     def load_modules(self):
         net_name = self._config.network
         if net_name is None or net_name == '':
@@ -150,31 +165,49 @@ class Trainer(object):
             fix_dim = self._ds.get_dataset_dimensions()[0][1:] #Only smallest image dimensions matter here
 
         if self._config.delay_load:
-            from Trainers import ThreadedGenerator
+            from Trainers import ThreadedGenerator,ProcessGenerator
+
+            if self._config.process_gen:
+                generator_class = ProcessGenerator
+                pgen_params = {'workers':self._config.cpu_count,'prefetch':self._config.prefetch}
+            else:
+                generator_class = ThreadedGenerator
+                pgen_params = {}
             
-            train_generator = ThreadedGenerator(dps=train_data,
+            train_generator = generator_class(dps=train_data,
                                                 classes=self._ds.nclasses,
                                                 dim=fix_dim,
                                                 batch_size=self._config.batch_size,
                                                 image_generator=train_prep,
                                                 extra_aug=self._config.augment,
                                                 shuffle=True,
-                                                verbose=self._verbose)
+                                                verbose=self._verbose,
+                                                normalizer=self.stain_normalizer(),
+                                                uint8=self._config.uint8,
+                                                **pgen_params)
             
-            val_generator = ThreadedGenerator(dps=val_data,
+            val_generator = generator_class(dps=val_data,
                                                 classes=self._ds.nclasses,
                                                 dim=fix_dim,
                                                 batch_size=self._config.batch_size,
                                                 image_generator=val_prep,
                                                 extra_aug=self._config.augment,
                                                 shuffle=True,
-                                                verbose=self._verbose)
+                                                verbose=self._verbose,
+                                                normalizer=self.stain_normalizer(),
+                                                uint8=self._config.uint8,
+                                                **pgen_params)
         else:
             #Loads training images and validation images
             x_train,y_train = self._ds.load_data(split=None,keepImg=self._config.keepimg,data=train_data)
             
             x_val,y_val = self._ds.load_data(split=None,keepImg=self._config.keepimg,data=val_data)
 
+            #uint8 data is rescaled by the image generators
+            if self._config.uint8:
+                train_prep.rescale = 1./255
+                val_prep.rescale = 1./255
+
             #Labels should be converted to categorical representation
             y_train = to_categorical(y_train,self._ds.nclasses)
             y_val = to_categorical(y_val,self._ds.nclasses)
@@ -341,6 +374,11 @@ class Trainer(object):
             callbacks=callbacks,
             )
 
+        #Stop generator worker processes, if any
+        for g in (train_generator,val_generator):
+            if hasattr(g,'close'):
+                g.close()
+
         if self._verbose > 1:
             print("Done training model: {0}".format(hex(id(training_model))))
 
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import numpy as np
+
+from Datasources.TileTable import take_items
+from AL.Common import group_ranks,proportional_quotas
+
+class PoolManager(object):
+    """
+    Active learning set bookkeeping over an immutable master table. Set membership is kept in a
+    state array (one byte per item); sets are views, materialized on demand and cached until membership
+    changes. Moving k items between sets costs O(k), nothing is deleted or concatenated.
+    """
+    POOL = 0
+    TRAIN = 1
+    VAL = 2
+    TEST = 3
+
+    def __init__(self,X,Y):
+        """
+        @param X <TileTable or list>: master table (all items), never modified
+        @param Y <list or ndarray>: labels
+        """
+        self.X = X if hasattr(X,'columns') else np.asarray(X)
+        self.Y = np.asarray(Y)
+        self.state = np.zeros(len(self.Y),dtype=np.int8)
+        #Last acquisition in which each item was scored (-1: never), see candidates
+        self.scored = np.full(len(self.Y),-1,dtype=np.int32)
+        self._origins = None
+        self._members = {}
+        self._views = {}
+
+    def __len__(self):
+        return self.Y.shape[0]
+
+    def _invalidate(self,*sets):
+        for s in sets:
+            self._members.pop(s,None)
+            self._views.pop(s,None)
+
+    def members(self,s):
+        """
+        Returns master indexes of set s, in master order
+        """
+        if not s in self._members:
+            self._members[s] = np.flatnonzero(self.state == s)
+        return self._members[s]
+
+    def size(self,s):
+        return self.members(s).shape[0]
+
+    def view(self,s):
+        """
+        Returns set s as a tuple (X,Y)
+        """
+        if not s in self._views:
+            idx = self.members(s)
+            self._views[s] = (take_items(self.X,idx),self.Y[idx])
+        return self._views[s]
+
+    def assign(self,idx,s):
+        """
+        Assigns items (master indexes) to set s
+        """
+        idx = np.asarray(idx,dtype=np.intp)
+        previous = np.unique(self.state[idx])
+        self.state[idx] = s
+        self._invalidate(s,*previous.tolist())
+
+    def move(self,idx,s=TRAIN):
+        """
+        Moves items from the pool to set s.
+
+        @param idx <ndarray>: indexes relative to the current pool view (as returned by acquisition functions)
+        Returns the master indexes of moved items
+        """
+        master = self.members(PoolManager.POOL)[np.asarray(idx,dtype=np.intp)]
+        self.assign(master,s)
+        return master
+
+    def origins(self):
+        """
+        Origin (WSI) id of every item
+        """
+        if self._origins is None:
+            if hasattr(self.X,'columns'):
+                self._origins = self.X.columns()['origin_id']
+            else:
+                _,self._origins = np.unique([str(x.getOrigin()) for x in self.X],return_inverse=True)
+        return self._origins
+
+    def candidates(self,size,groups=None):
+        """
+        Selects at most size pool items to be scored. Least recently scored items come first (random order
+        among equals), so unscored items rotate into later acquisitions.
+
+        @param groups <ndarray>: group of every item (e.g. origins): candidates are split among groups
+        proportionally to their pool sizes
+        Returns sorted master indexes
+        """
+        pool = self.members(PoolManager.POOL)
+        if size >= pool.shape[0]:
+            return pool
+
+        order = np.lexsort((np.random.random(pool.shape[0]),self.scored[pool]))
+        if groups is None:
+            sel = order[:size]
+        else:
+            g = np.asarray(groups)[pool[order]]
+            quotas = proportional_quotas(np.bincount(g),size)
+            sel = order[group_ranks(g) < quotas[g]]
+        return np.sort(pool[sel])
+
+    def mark_scored(self,idx,r):
+        self.scored[idx] = r
+
+    def snapshot(self):
+        """
+        Initial assignment of the master table, to be stored once. Later rounds are replayed from the
+        acquisition log (see Utils.AcquisitionLog).
+        """
+        return {'X':self.X,'Y':self.Y,'state':self.state.copy()}
@@ -7,9 +7,10 @@ from tqdm import tqdm
 import numpy as np
 
 from Datasources.CellRep import CellRep
-from .BatchGenerator import SingleGenerator
+from .BatchGenerator import SingleGenerator,stain_normalize
 from Utils import SaveLRCallback
 from Utils import Exitcodes,CacheManager,PrintConfusionMatrix
+from Preprocessing.TileCache import configure_tile_cache
 
 #Keras
 from keras import backend as K
@@ -89,6 +90,7 @@ class Predictor(object):
         self._verbose = config.verbose
         self._ds = None
         self._keep = keepImg
+        configure_tile_cache(config)
 
         if 'build_ensemble' in kwargs:
             self._ensemble = kwargs['build_ensemble']
@@ -164,6 +166,12 @@ class Predictor(object):
             print("Test set: {} items".format(len(y_test)))
             
         X,Y = self._ds.load_data(data=(x_test,y_test),keepImg=self._keep)
+        #Test data should be normalized as training data was
+        if not self._config.online_norm is None:
+            from Preprocessing.ReinhardNormalizer import ReinhardNormalizer
+            normalizer = ReinhardNormalizer(self._config.online_norm)
+            for i in range(0,X.shape[0],256):
+                X[i:i+256] = stain_normalize(normalizer,X[i:i+256])
         if self._config.verbose > 1:
             print("Y original ({1}):\n{0}".format(Y,Y.shape))        
         Y = to_categorical(Y,self._ds.nclasses)
@@ -212,8 +220,10 @@ class Predictor(object):
         bsize = self._config.batch_size
         stp = round((len(X) / bsize) + 0.5)
 
+        #uint8 test data (-u8) is rescaled along with standardization
         image_generator = ImageDataGenerator(samplewise_center=self._config.batch_norm, 
-                                            samplewise_std_normalization=self._config.batch_norm)
+                                            samplewise_std_normalization=self._config.batch_norm,
+                                            rescale=1./255 if self._config.uint8 else None)
 
         if self._ensemble:
             if not self._config.tdim is None:
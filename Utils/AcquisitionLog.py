@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8
+
+import os
+import numpy as np
+
+class AcquisitionLog(object):
+    """
+    Append only record of active learning acquisitions. Each acquisition stores only the indexes of the
+    acquired items in a fixed master table (see Trainers.PoolManager), optionally with their acquisition
+    scores and cluster ids.
+
+    File format: a sequence of records, each one made of four consecutive npy arrays:
+    header [round,n] (int64), indexes (int64), scores (float32, empty if not given), clusters (int32, empty if not given).
+    A truncated last record (interrupted run) is ignored.
+    """
+    def __init__(self,path,verbose=0):
+        """
+        @param path <str>: log file
+        @param verbose <int>: verbosity level
+        """
+        self.path = path
+        self._verbose = verbose
+        self._records = {}
+
+        if os.path.isfile(path):
+            self._read()
+
+    def __len__(self):
+        return len(self._records)
+
+    def _read(self):
+        with open(self.path,'rb') as fd:
+            while True:
+                try:
+                    header = np.load(fd)
+                    idx = np.load(fd)
+                    scores = np.load(fd)
+                    clusters = np.load(fd)
+                except (EOFError,ValueError,OSError):
+                    break
+                r,n = header.tolist()
+                self._records[r] = (idx,scores if scores.shape[0] == n else None,clusters if clusters.shape[0] == n else None)
+
+        if self._verbose > 0:
+            print("[AcquisitionLog] Read {} acquisitions from {}".format(len(self._records),self.path))
+
+    def reset(self):
+        """
+        Starts a new log, discarding existing records
+        """
+        self._records = {}
+        with open(self.path,'wb') as fd:
+            pass
+
+    def append(self,r,indexes,scores=None,clusters=None):
+        """
+        Records acquisition r.
+
+        @param indexes <ndarray>: master table indexes of acquired items
+        @param scores <ndarray>: acquisition score of each acquired item
+        @param clusters <ndarray>: cluster id of each acquired item
+        """
+        indexes = np.asarray(indexes,dtype=np.int64)
+        n = indexes.shape[0]
+        scores = np.zeros(0,dtype=np.float32) if scores is None else np.asarray(scores,dtype=np.float32)
+        clusters = np.zeros(0,dtype=np.int32) if clusters is None else np.asarray(clusters,dtype=np.int32)
+
+        with open(self.path,'ab') as fd:
+            for a in (np.array([r,n],dtype=np.int64),indexes,scores,clusters):
+                np.save(fd,a)
+            fd.flush()
+            os.fsync(fd.fileno())
+
+        self._records[r] = (indexes,scores if scores.shape[0] == n else None,clusters if clusters.shape[0] == n else None)
+
+    def rounds(self):
+        """
+        Returns the sorted list of recorded acquisitions
+        """
+        return sorted(self._records.keys())
+
+    def acquired(self,r):
+        """
+        Master indexes acquired in acquisition r (empty if not recorded)
+        """
+        if r in self._records:
+            return self._records[r][0]
+        return np.zeros(0,dtype=np.int64)
+
+    def scores(self,r):
+        return self._records[r][1] if r in self._records else None
+
+    def clusters(self,r):
+        return self._records[r][2] if r in self._records else None
+
+    def diff(self,r1,r2):
+        """
+        Master indexes acquired from acquisition r1 (inclusive) to r2 (exclusive)
+        """
+        idx = [self.acquired(r) for r in self.rounds() if r1 <= r < r2]
+        return np.concatenate(idx) if len(idx) > 0 else np.zeros(0,dtype=np.int64)
+
+    def train_indexes(self,r,initial):
+        """
+        Master indexes of the training set used in round r: the initial training set plus everything
+        acquired before r.
+
+        @param initial <ndarray>: master indexes of initial training set
+        """
+        return np.concatenate((np.asarray(initial,dtype=np.int64),self.diff(0,r)))
@@ -9,6 +9,66 @@ import math
 import argparse
 import pickle
 from sklearn.cluster import KMeans
+
+from Datasources.TileTable import TileTable,take_items
+from Utils.AcquisitionLog import AcquisitionLog
+
+#Set membership code of training items in al-pool files (PoolManager.TRAIN)
+_TRAIN = 1
+    
+def _item_paths(X):
+    if isinstance(X,TileTable):
+        return X.paths()
+    return [img.getPath() for img in X]
+
+def _load_dataset_metadata(cache_file):
+    """
+    Returns (X,Y) from a datasource metadata file. Index based datasources store metadata as columns.
+    """
+    with open(cache_file,'rb') as fd:
+        data = pickle.load(fd)
+    if len(data) == 2:
+        X = TileTable(data[0])
+        return X,X.labels
+    return data[0],data[1]
+    
+def _load_al_pool(sdir,net):
+    """
+    Master table and initial set membership of an AL experiment (al-pool-<net>.pik)
+    """
+    with open(os.path.join(sdir,'al-pool-{}.pik'.format(net)),'rb') as fd:
+        return pickle.load(fd)
+
+def _acquisitions_from_log(sdir,net):
+    """
+    Returns the images acquired in each acquisition, as stored in the acquisition log (al-log-<net>.npl)
+    """
+    pool = _load_al_pool(sdir,net)
+    log = AcquisitionLog(os.path.join(sdir,'al-log-{}.npl'.format(net)))
+    ac_imgs = {}
+    for r in log.rounds():
+        idx = log.acquired(r)
+        print("Acquired {} images in acquisition {}".format(idx.shape[0],r))
+        ac_imgs[r] = (take_items(pool['X'],idx),pool['Y'][idx])
+
+    return ac_imgs
+
+def _load_al_train(path):
+    """
+    Returns a training set (X,Y). path is either an acquisition log (final training set is replayed over the
+    master table kept in the same directory) or a full al-metadata dump.
+    """
+    if path.endswith('.npl'):
+        sdir,f = os.path.split(path)
+        pool = _load_al_pool(sdir,f[len('al-log-'):-len('.npl')])
+        log = AcquisitionLog(path)
+        r = log.rounds()[-1] + 1 if len(log) > 0 else 0
+        idx = log.train_indexes(r,np.flatnonzero(pool['state'] == _TRAIN))
+        return take_items(pool['X'],idx),pool['Y'][idx]
+
+    with open(path,'rb') as fd:
+        train,_,_ = pickle.load(fd)
+    return train
     
 def _process_al_metadata(config):
     """
@@ -20,6 +80,13 @@ def _process_al_metadata(config):
 
     files = os.listdir(config.sdir)
 
+    #Acquisition logs are used when available
+    logs = [f[len('al-log-'):-len('.npl')] for f in files if f.startswith('al-log-') and f.endswith('.npl')]
+    logs = [net for net in logs if config.net is None or config.net == net]
+    if len(logs) > 0:
+        logs.sort()
+        return _acquisitions_from_log(config.sdir,logs[0])
+    
     acfiles = {}
     for f in files:
         if f.startswith('al-metadata'):
@@ -35,17 +102,19 @@ def _process_al_metadata(config):
     for k in ordered_k:
         with open(acfiles[k],'rb') as fd:
             train,val,test = pickle.load(fd)
-            
+
+        #Training sets are compared by image paths (TileTables give them without creating image objects)
+        paths = np.asarray(_item_paths(train[0]))
         if initial_set is None:
             #Acquisitions are obtained from keys k and k-1
-            initial_set = list(train[0])
+            initial_set = paths
         else:
-            mask = np.isin(list(train[0]),initial_set,assume_unique=True,invert=True)
+            mask = np.isin(paths,initial_set,invert=True)
             imgs = train[0][mask]
-            labels = train[1][mask]
-            print("Acquired {} images in acquisition {}".format(imgs.shape[0],k-1))
+            labels = np.asarray(train[1])[mask]
+            print("Acquired {} images in acquisition {}".format(len(imgs),k-1))
             ac_imgs[k-1] = (imgs,labels)
-            initial_set = list(train[0])    
+            initial_set = paths
 
     return ac_imgs
 
@@ -195,8 +264,7 @@ def process_wsi_metadata(config):
     ds_wsis = {}
     print("\n"+" "*10+"DATASET PATCHES STATISTICS")
     if not config.cache_file is None:
-        with open(config.cache_file,'rb') as fd:
-            X,Y,_ = pickle.load(fd)
+        X,Y = _load_dataset_metadata(config.cache_file)
         ac_patches = len(X)
         for ic in range(ac_patches):
             img = X[ic]
@@ -327,15 +395,15 @@ def process_cluster_metadata(config):
         with open(acfiles[k],'rb') as fd:
             pool,un_clusters,un_indexes = pickle.load(fd)
     
+        #Position of each item in the uncertainty ranking
+        un_indexes = np.asarray(un_indexes)
+        un_pos = np.empty(un_indexes.max()+1,dtype=np.int64)
+        un_pos[un_indexes] = np.arange(un_indexes.shape[0])
         for cln in range(len(un_clusters)):
             ind = np.asarray(un_clusters[cln])
             print("Cluster {}, # of items: {}".format(cln,ind.shape[0]))
-            posa = np.ndarray(shape=(1,),dtype=np.int32)
-            for ii in range(min(ind.shape[0],config.n)):
-                if ii == 0:
-                    posa[0] = np.where(un_indexes == ind[ii])[0]
-                else:
-                    posa = np.hstack((posa,np.where(un_indexes == ind[ii])[0]))
+            posa = un_pos[ind[:config.n]]
+            for ii in range(posa.shape[0]):
                 #Copy image
                 _copy_img(config.out_dir,k,cln,pool[0][ind[ii]],posa[ii],config.cp_orig)
             print("Cluster {} first items positions in index array (at most {}): {}".format(cln,config.n,posa))
@@ -348,8 +416,7 @@ def process_train_set(config):
         if not os.path.isfile(f):
             print("File not found: {}".format(f))
             return None
-        with open(f,'rb') as fd:
-            train,_,_ = pickle.load(fd)
+        train = _load_al_train(f)
         for i in train[0]:
             if i in trainsets:
                 trainsets[i] += 1
@@ -383,7 +450,7 @@ if __name__ == "__main__":
     parser.add_argument('--wsi', dest='wsi', action='store_true', 
         help='Identify the patches of each WSI in the acquisitions.', default=False)
     parser.add_argument('--train_set', dest='trainset', type=str, nargs=2,
-        help='Check if the training sets of two experiments are the same.', default=None)
+        help='Check if the training sets of two experiments are the same (al-log or al-metadata files).', default=None)
         
     parser.add_argument('-ac', dest='ac_n', nargs='?', type=int, const=[-1],
         help='Acquisitions to obtain images.', default=None, required=True)
@@ -7,3 +7,4 @@ from .CustomCallbacks import CalculateF1Score
 from .CustomCallbacks import EnsembleModelCallback
 from .ParallelUtils import multiprocess_run
 from .Output import PrintConfusionMatrix
+from .AcquisitionLog import AcquisitionLog
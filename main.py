@@ -151,7 +151,8 @@ if __name__ == "__main__":
     pre_args.add_argument('-presrc', dest='presrc', type=str,default='', 
         help='Input image or directory of images (runs recursively)',required=False)
     pre_args.add_argument('-predst', dest='predst', type=str,default='tiles', 
-        help='Output tiles go to this directory')
+        help='Output tiles go to this directory. Datasources read tiles from here; it may also be a tar or zip archive \
+        (read without extraction).')
     pre_args.add_argument('-img_type', dest='img_type', nargs='+', type=str, 
         help='Input image types to consider (list): svs, dicom, nii.', default=None)
     pre_args.add_argument('-mag', dest='magnification', type=int, 
@@ -162,6 +163,12 @@ if __name__ == "__main__":
         default=None, metavar=('Width', 'Height'))
     pre_args.add_argument('-norm', dest='normalize', type=str, nargs='?', default=None, const='Preprocessing/target_40X.png',
         help='Normalize tiles based on reference image (given)')
+    pre_args.add_argument('-tmask', dest='tissue_threshold', type=float, 
+        help='Skip whole slide regions whose thumbnail whiteness (mean channel std) is below this value before reading them. \
+        Disabled by default; 8.0 is a reasonable threshold (Default: 0).',
+        default=0.0)
+    pre_args.add_argument('-pack', action='store_true', dest='pack', default=False, 
+        help='Pack tiles from -presrc (parsed by -data Datasource) into a memory mapped store in -predst (use -data Packed to read it).')
     
 
     ##Training options
@@ -197,6 +204,14 @@ if __name__ == "__main__":
     train_args.add_argument('-sample', dest='sample', type=float, 
         help='Use a sample of the whole data for training (Default: 100.0%% - use floats [0.0-1.0]).',
         default=1.0)
+    train_args.add_argument('-pgen', action='store_true', dest='process_gen',
+        help='Read and augment delayed load batches in worker processes (one per -cpu core).',default=False)
+    train_args.add_argument('-onorm', dest='online_norm', type=str, nargs='?', default=None, const='Preprocessing/target_40X.png',
+        help='Stain normalize batches on the fly, based on reference image (given), when images are loaded by generators.')
+    train_args.add_argument('-u8', action='store_true', dest='uint8',
+        help='Read, keep (-k), cache and batch images as uint8; conversion to float is done on assembled batches.',default=False)
+    train_args.add_argument('-prefetch', dest='prefetch', type=int, 
+        help='Number of batches prepared ahead by process generators (Default: 4).', default=4)
     
     ##Active Learning options
     al_args = parser.add_argument_group('AL','Active Learning options')
@@ -216,22 +231,42 @@ if __name__ == "__main__":
         help='Run active learning for this many cycles (Default: 10).', default=10)
     al_args.add_argument('-emodels', dest='emodels', type=int, 
         help='Number of ensemble submodels (Default: 3).', default=3)
+    al_args.add_argument('-eprocs', dest='ensemble_procs', type=int, 
+        help='Train this many ensemble submodels concurrently, each in its own process. GPUs are split among processes; \
+        with no GPUs, CPU cores are (Default: 0 = train sequentially).', default=0)
     al_args.add_argument('-acquire', dest='acquire', type=int, 
         help='Acquire this many samples at each acquisition step (Default: 1000).', default=1000)
     al_args.add_argument('-dropout_steps', dest='dropout_steps', type=int, 
         help='For Bayesian CNNs, sample the network this many times (Default: 100).', default=100)
+    al_args.add_argument('-sp', action='store_true', dest='single_pass',
+        help='MC dropout and ensemble predictions in a single pass: each pool batch is loaded once and sampled -dropout_steps times \
+        (or fed to every ensemble member).',default=False)
     al_args.add_argument('-bal', action='store_true', dest='balance',
         help='Balance dataset samples between classes.',default=False)
     al_args.add_argument('-sv', action='store_true', dest='save_var',
         help='Save aquisition variations/probability/clusters arrays and selected items indexes.',default=False)
+    al_args.add_argument('-candidates', dest='candidates', type=int, 
+        help='Score only a candidate subset of the pool, this many times the acquisition size. Grows adaptively \
+        and rotates unscored items into later acquisitions (Default: 0 (score the whole pool)).',default=0)
+    al_args.add_argument('-cand_strat', dest='cand_strat', type=str, choices=['random','wsi'],
+        help='Candidate selection: random or stratified by WSI (Default: random).',default='random')
     al_args.add_argument('-clusters', dest='clusters', type=int, 
         help='Number of clusters to form in similarity selections (Default 0).', default=0)
     al_args.add_argument('-recluster', dest='recluster', type=int, 
         help='Re-cluster data every X acquisitions (Default:all).',default=0)
+    al_args.add_argument('-kmstrat', dest='kmstrat', type=str, choices=['rr','prop'],
+        help='Cluster stratification in similarity selections: rr (round-robin) or prop (quotas proportional to \
+        cluster sizes) (Default: rr).',default='rr')
+    al_args.add_argument('-wsicap', dest='wsicap', type=int, 
+        help='Acquire at most this many items from each WSI in similarity selections (Default: 0 (no limit)).',default=0)
     al_args.add_argument('-ffeat', dest='ffeat', type=str,
         help='Use a fixed pre-trained model to extract features.',default=None)
     al_args.add_argument('-pca', dest='pca', type=int, 
-        help='Apply PCA to extracted features before clustering (Default: 0 (not used)).',default=0)
+        help='Apply incremental PCA to extracted features before clustering (Default: 0 (not used)).',default=0)
+    al_args.add_argument('-cs_proj', dest='cs_proj', type=int, 
+        help='Random projection of extracted features to this many dimensions in core-set selection (Default: 0 (not used)).',default=0)
+    al_args.add_argument('-fdtype', dest='fdtype', type=str, choices=['float16','float32'],
+        help='Storage type of extracted features (Default: float32).',default='float32')
     al_args.add_argument('-load_train', dest='load_train', action='store_true', default=False,
         help='Use the same initial training set as produced by a previous experiment.')    
     
@@ -268,6 +303,13 @@ if __name__ == "__main__":
         help='Base dir to store all temporary data and general output',required=True)
     parser.add_argument('-cache', dest='cache', type=str,default='cache', 
         help='Keeps caches in this directory',required=False)
+    parser.add_argument('-tcache', dest='tile_cache', type=int,default=0, 
+        help='Memory budget (MB) of the decoded tile LRU cache, shared by epochs and acquisitions. With -pgen, each generator \
+        worker process has its own cache of this size; -lproc load workers do not use it (Default: 0, disabled).')
+    parser.add_argument('-tcache_dir', dest='tile_cache_dir', type=str,default=None, 
+        help='Spill tiles evicted from tile cache to this directory.')
+    parser.add_argument('-tcache_spill', dest='tile_cache_spill', type=int,default=0, 
+        help='Disk budget (MB) of tile cache spill directory (Default: 0, unlimited).')
     parser.add_argument('-v', action='count', default=0, dest='verbose',
         help='Amount of verbosity (more \'v\'s means more verbose).')
     parser.add_argument('-i', action='store_true', dest='info', default=False, 
@@ -282,6 +324,12 @@ if __name__ == "__main__":
         help='Keep loaded images in memory.')
     parser.add_argument('-d', action='store_true', dest='delay_load', default=False, 
         help='Delay the loading of images to the latest moment possible (memory efficiency).')
+    parser.add_argument('-lworkers', dest='load_workers', type=int, default=7, 
+        help='Number of workers that read images when loading is not delayed (Default: 7).')
+    parser.add_argument('-lproc', action='store_true', dest='load_procs', default=False, 
+        help='Images are read by worker processes instead of threads when loading is not delayed.')
+    parser.add_argument('-lmmap', action='store_true', dest='load_mmap', default=False, 
+        help='Keep loaded images in a disk backed array (in logdir), for datasets larger than RAM.')
     parser.add_argument('-db', action='store_true', dest='debug',
         help='Runs debugging procedures.',default=False)
     
@@ -318,6 +366,7 @@ if __name__ == "__main__":
         'datatree.pik':os.path.join(config.cache,'{}-datatree.pik'.format(config.data)),
         'tcga.pik':os.path.join(config.cache,'tcga.pik'),
         'metadata.pik':os.path.join(config.cache,'{0}-metadata.pik'.format(config.data)),
+        'metadata_index.npz':os.path.join(config.cache,'{0}-metadata_index.npz'.format(config.data)),
         'sampled_metadata.pik':os.path.join(config.cache,'{0}-sampled_metadata.pik'.format(config.data)),
         'initial_train.pik':os.path.join(config.cache,'{0}-inittrain.pik'.format(config.data)),
         'split_ratio.pik':os.path.join(config.cache,'{0}-split_ratio.pik'.format(config.data)),